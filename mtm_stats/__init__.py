@@ -1,5 +1,14 @@
 from __future__ import absolute_import
 from .mtm_stats import *
 from . import sparse_block_array
+from . import npy_shards
+from . import roaring
+from . import index_file
+from . import streaming
+from . import query
+from . import reorder
+from . import profiling
+from . import incremental
+from . import sharding
 from . import testing_utils
 from ._version import *
@@ -0,0 +1,233 @@
+'''Reproducible benchmarks of each stage of mtm_stats with JSON output
+
+run_benchmarks sweeps a grid of parameters (see DEFAULT_GRID) over test
+sets from testing_utils.generate_test_set and times each stage separately:
+  ingestion: extract the sets and the indices of the connections
+  compression: build the rows (the packed SBA, or dense rows)
+  base_counts: count the bits of each row
+  intersections: the intersection counts kernel
+  output: convert the results to the iu_counts dictionary
+The results (and where they were measured, see get_environment) are saved
+as JSON, and compare_benchmarks flags the stages that got slower
+
+Command line:
+    python -m mtm_stats.benchmark run results.json --sizeA 1000 2000 --num-threads 1 2
+    python -m mtm_stats.benchmark compare baseline.json results.json
+'''
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import argparse
+import subprocess
+import numpy as np
+
+from .mtm_stats import (extract_indices, convert_indices_to_binary,
+                        convert_indices_to_sba_packed, _mtm_intersection_counts,
+                        get_iu_counts_dict, ExecutionContext,
+                        get_default_num_threads)
+from .testing_utils import generate_test_set
+from ._version import __version__
+from . import cy_mtm_stats
+
+BENCHMARK_FORMAT_VERSION = 1
+
+STAGES = ('ingestion', 'compression', 'base_counts', 'intersections', 'output')
+
+# The parameters that get swept (each one is a list of values)
+DEFAULT_GRID = {'sizeA': [1000],
+                'sizeB': [100000],
+                'num_connections': [100000],
+                'chunk_length_64': [1],
+                'dense_input': [False],
+                'num_threads': [None]}
+
+# compare_benchmarks ignores stages faster than this (in seconds)
+# and flags the ones that got more than REGRESSION_THRESHOLD slower
+MIN_COMPARE_TIME = 1e-3
+REGRESSION_THRESHOLD = 0.1
+
+def get_environment():
+    '''Where the benchmarks ran: versions, cpus and the git commit (if any)'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'mtm_stats_version': __version__,
+            'git_commit': commit,
+            'python_version': platform.python_version(),
+            'numpy_version': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'default_num_threads': get_default_num_threads(),
+            'popcount_impl': cy_mtm_stats.cy_get_popcount_impl(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+def get_grid_cases(grid):
+    '''All the combinations of the values in a grid (a list of parameter dicts)'''
+    names = sorted(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[name] for name in names])]
+
+def time_stages(connections, chunk_length_64=1, dense_input=False, num_threads=None, cutoff=0):
+    '''Run mtm_stats once on connections and time each stage (see STAGES)
+       The compression, base counts and intersections run with num_threads threads
+       Returns a dictionary of {stage: seconds}'''
+    times = {}
+    t = time.time()
+    setA, setB, ia, ib = extract_indices(connections)
+    times['ingestion'] = time.time() - t
+    
+    with ExecutionContext(num_threads) as context:
+        t = time.time()
+        if dense_input:
+            rows = convert_indices_to_binary(ia, ib, len(setA), len(setB))
+        else:
+            rows = convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64, context)
+        times['compression'] = time.time() - t
+        
+        t = time.time()
+        if dense_input:
+            base_counts = cy_mtm_stats.cy_compute_counts_dense_input(rows, context)
+        else:
+            base_counts = cy_mtm_stats.cy_compute_counts(rows, chunk_length_64, context)
+        times['base_counts'] = time.time() - t
+        
+        t = time.time()
+        intersection_counts_list = _mtm_intersection_counts(rows, chunk_length_64, cutoff=cutoff, dense_input=dense_input,
+                                                            context=context)
+        times['intersections'] = time.time() - t
+    
+    t = time.time()
+    get_iu_counts_dict(base_counts, intersection_counts_list, setA)
+    times['output'] = time.time() - t
+    return times
+
+def run_benchmark_case(case, repeats=3, seed=0):
+    '''Time every stage of one case of the grid repeats times
+       Returns the case with the 'min' and 'median' time of each stage
+       and the size of the generated test set'''
+    connections = generate_test_set(case['sizeA'], case['sizeB'], case['num_connections'], seed=seed)
+    all_times = [time_stages(connections, case['chunk_length_64'], case['dense_input'], case['num_threads'])
+                 for _ in range(repeats)]
+    result = {'params': case,
+              'num_unique_connections': len(connections),
+              'repeats': repeats,
+              'min': {},
+              'median': {}}
+    for stage in STAGES:
+        stage_times = [times[stage] for times in all_times]
+        result['min'][stage] = min(stage_times)
+        result['median'][stage] = float(np.median(stage_times))
+    return result
+
+def run_benchmarks(grid=None, repeats=3, seed=0, output_path=None, verbose=False):
+    '''Run every case of the grid (DEFAULT_GRID updated with grid)
+       Returns the results (and saves them as JSON to output_path):
+         {'format_version', 'environment', 'seed', 'results': [...]}
+       see run_benchmark_case for each result'''
+    full_grid = dict(DEFAULT_GRID)
+    full_grid.update(grid or {})
+    results = []
+    for case in get_grid_cases(full_grid):
+        result = run_benchmark_case(case, repeats, seed)
+        if verbose:
+            print(json.dumps(case, sort_keys=True),
+                  ' '.join('{}={:.4f}'.format(stage, result['min'][stage]) for stage in STAGES))
+        results.append(result)
+    benchmarks = {'format_version': BENCHMARK_FORMAT_VERSION,
+                  'environment': get_environment(),
+                  'seed': seed,
+                  'results': results}
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(benchmarks, f, indent=1, sort_keys=True)
+    return benchmarks
+
+def load_benchmarks(path):
+    with open(path) as f:
+        benchmarks = json.load(f)
+    if benchmarks.get('format_version') != BENCHMARK_FORMAT_VERSION:
+        raise ValueError('unsupported benchmark format version {!r}'.format(benchmarks.get('format_version')))
+    return benchmarks
+
+def compare_benchmarks(baseline, current, threshold=REGRESSION_THRESHOLD, min_time=MIN_COMPARE_TIME):
+    '''Compare the min time of each stage of the cases that are in both runs
+       (the output of run_benchmarks, or the paths of the JSON files)
+       Returns a list of comparisons, one per case and stage:
+         {'params', 'stage', 'baseline', 'current', 'ratio', 'regression'}
+       where regression means current is more than threshold slower
+       (stages faster than min_time in both runs are never regressions)'''
+    baseline = load_benchmarks(baseline) if not isinstance(baseline, dict) else baseline
+    current = load_benchmarks(current) if not isinstance(current, dict) else current
+    get_key = lambda result: json.dumps(result['params'], sort_keys=True)
+    baseline_results = {get_key(result): result for result in baseline['results']}
+    comparisons = []
+    for result in current['results']:
+        baseline_result = baseline_results.get(get_key(result))
+        if baseline_result is None:
+            continue
+        for stage in STAGES:
+            before = baseline_result['min'][stage]
+            after = result['min'][stage]
+            comparisons.append({'params': result['params'],
+                                'stage': stage,
+                                'baseline': before,
+                                'current': after,
+                                'ratio': after / before if before > 0 else float('inf'),
+                                'regression': (max(before, after) >= min_time and
+                                               after > before * (1 + threshold))})
+    return comparisons
+
+def _parse_bool(s):
+    if s.lower() not in ('true', 'false', '1', '0'):
+        raise argparse.ArgumentTypeError('expected true or false, not {!r}'.format(s))
+    return s.lower() in ('true', '1')
+
+def _parse_num_threads(s):
+    return None if s.lower() == 'none' else int(s)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages of mtm_stats')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run a grid of benchmarks and save the results as JSON')
+    run_parser.add_argument('output_path')
+    for name, parse in [('sizeA', int), ('sizeB', int), ('num_connections', int),
+                        ('chunk_length_64', int), ('dense_input', _parse_bool),
+                        ('num_threads', _parse_num_threads)]:
+        run_parser.add_argument('--' + name.replace('_', '-'), dest=name, type=parse, nargs='+')
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    compare_parser = subparsers.add_parser('compare', help='flag the stages that got slower between two runs')
+    compare_parser.add_argument('baseline_path')
+    compare_parser.add_argument('current_path')
+    compare_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                                help='relative slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+    
+    if args.command == 'run':
+        grid = {name: getattr(args, name) for name in DEFAULT_GRID if getattr(args, name) is not None}
+        run_benchmarks(grid, args.repeats, args.seed, args.output_path, verbose=True)
+        return 0
+    elif args.command == 'compare':
+        comparisons = compare_benchmarks(args.baseline_path, args.current_path, args.threshold)
+        for c in comparisons:
+            print('{:<4} {:<14} {:10.4f} {:10.4f} {:6.2f}x {}'.format('FAIL' if c['regression'] else 'ok',
+                                                                   c['stage'], c['baseline'], c['current'],
+                                                                   c['ratio'], json.dumps(c['params'], sort_keys=True)))
+        return 1 if any(c['regression'] for c in comparisons) else 0
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
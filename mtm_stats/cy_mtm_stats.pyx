@@ -1,7 +1,9 @@
 import numpy as np
 cimport numpy as np
 
+import os
 import multiprocessing
+from .sparse_block_array import sba_list_to_packed
 from cython.parallel cimport parallel
 from cython.parallel import prange
 cimport openmp
@@ -9,13 +11,19 @@ cimport openmp
 ctypedef unsigned int UINT32
 ctypedef unsigned long int UINT64
 ctypedef int INT32
+ctypedef long long INT64
+ctypedef unsigned short UINT16
+ctypedef unsigned char UINT8
 
-cdef extern from "stdlib.h":
+cdef extern from "stdlib.h" nogil:
     ctypedef int size_t
     void free(void* ptr)
     void* malloc(size_t size)
     void* realloc(void* ptr, size_t size)
 
+cdef extern from "string.h" nogil:
+    void* memcpy(void* dest, const void* src, size_t n)
+
 cdef extern from "mtm_stats_core.h":
     ctypedef struct SparseBlockArray:
         const UINT32* locs
@@ -27,10 +35,27 @@ cdef extern from "mtm_stats_core.h":
         UINT32 j
         UINT32 intersection_count
     
+    ctypedef struct RoaringRow:
+        const UINT16* keys
+        const UINT8* types
+        const UINT16* sizes
+        const UINT16* data
+        const UINT64* bitmaps
+        UINT32 len
+    
+    ctypedef struct SimilarityFilter:
+        const UINT32* counts
+        const INT32* sorted_rows
+        const UINT32* sorted_counts
+        int num_counts
+        double min_jaccard
+        double min_cosine
+        double min_overlap
+    
     void compute_counts(SparseBlockArray * sba_rows,
                         int chunk_length,
                         int num_rows,
-                        UINT32 * counts)
+                        UINT32 * counts) nogil
     
     int compute_intersection_counts(SparseBlockArray * sba_rows,
                                     int chunk_length,
@@ -38,12 +63,26 @@ cdef extern from "mtm_stats_core.h":
                                     int start_j,
                                     int num_rows,
                                     IntersectionCount * intersection_counts,
-                                    int cutoff) nogil
+                                    int cutoff,
+                                    const SimilarityFilter * similarity_filter) nogil
+
+    int compute_intersection_counts_postings(const INT64 * a_offsets,
+                                             const INT32 * a_indices,
+                                             const INT64 * b_offsets,
+                                             const INT32 * b_indices,
+                                             int i,
+                                             int start_j,
+                                             int num_rows,
+                                             UINT32 * accumulator,
+                                             INT32 * touched,
+                                             IntersectionCount * intersection_counts,
+                                             int cutoff,
+                                             const SimilarityFilter * similarity_filter) nogil
 
     void compute_counts_dense_input(UINT64 * rows_arr,
                                     int chunk_length,
                                     int num_rows,
-                                    UINT32 * counts)
+                                    UINT32 * counts) nogil
                 
     int compute_intersection_counts_dense_input(UINT64 * rows_arr,
                                                 int chunk_length,
@@ -51,50 +90,700 @@ cdef extern from "mtm_stats_core.h":
                                                 int start_j,
                                                 int num_rows,
                                                 IntersectionCount * intersection_counts,
-                                                int cutoff) nogil
+                                                int cutoff,
+                                                const SimilarityFilter * similarity_filter) nogil
 
+    int TOPK_INTERSECTION
+    int TOPK_JACCARD
+    
+    int PAIR_METRIC_UNION
+    int PAIR_METRIC_DIFFERENCE_IJ
+    int PAIR_METRIC_DIFFERENCE_JI
+    int PAIR_METRIC_SYMMETRIC_DIFFERENCE
+    int PAIR_METRIC_JACCARD
+    int PAIR_METRIC_COSINE
+    int PAIR_METRIC_OVERLAP
+    int PAIR_METRIC_DICE
+    int PAIR_METRIC_LIFT
+    int PAIR_METRIC_PMI
+    int PAIR_METRIC_LAST_COUNT
+    int NUM_PAIR_METRICS
+    
+    void compute_pair_metrics(const IntersectionCount * intersection_counts,
+                              INT64 num_intersection_counts,
+                              const UINT32 * counts,
+                              double num_b,
+                              const INT64 * metric_offsets,
+                              int double_precision,
+                              INT64 record_size,
+                              char * output) nogil
+    
+    int compute_topk(SparseBlockArray * sba_rows,
+                     int chunk_length,
+                     int i,
+                     int num_rows,
+                     const UINT32 * counts,
+                     int metric,
+                     int k,
+                     INT32 * top_indices,
+                     double * top_scores,
+                     int cutoff) nogil
+    
+    int compute_topk_dense_input(UINT64 * rows_arr,
+                                 int chunk_length,
+                                 int i,
+                                 int num_rows,
+                                 const UINT32 * counts,
+                                 int metric,
+                                 int k,
+                                 INT32 * top_indices,
+                                 double * top_scores,
+                                 int cutoff) nogil
+    
+    int compute_topk_postings(const INT64 * a_offsets,
+                              const INT32 * a_indices,
+                              const INT64 * b_offsets,
+                              const INT32 * b_indices,
+                              int i,
+                              int num_rows,
+                              const UINT32 * counts,
+                              int metric,
+                              int k,
+                              UINT32 * accumulator,
+                              INT32 * touched,
+                              INT32 * top_indices,
+                              double * top_scores,
+                              int cutoff) nogil
+    
+    int compute_intersection_counts_roaring(RoaringRow * rows,
+                                            int i,
+                                            int start_j,
+                                            int num_rows,
+                                            IntersectionCount * intersection_counts,
+                                            int cutoff,
+                                            const SimilarityFilter * similarity_filter) nogil
+    
+    INT64 sort_row_bits(INT64 * bits,
+                        INT64 num_bits) nogil
+    
+    INT64 count_row_blocks(const INT64 * bits,
+                           INT64 num_bits,
+                           int chunk_length) nogil
+    
+    void fill_row_blocks(const INT64 * bits,
+                         INT64 num_bits,
+                         int chunk_length,
+                         UINT32 * locs,
+                         UINT64 * array) nogil
+    
+    void compute_min_sums(SparseBlockArray * sba_rows,
+                          const INT64 * row_offsets,
+                          const INT64 * block_weight_offsets,
+                          const double * weights,
+                          int chunk_length,
+                          const IntersectionCount * intersection_counts,
+                          int num_intersection_counts,
+                          double * min_sums) nogil
+    
+    int compute_intersection_counts_candidates(SparseBlockArray query,
+                                               SparseBlockArray * sba_rows,
+                                               int chunk_length,
+                                               int i,
+                                               int skip_j,
+                                               const INT32 * candidates,
+                                               int num_candidates,
+                                               IntersectionCount * intersection_counts,
+                                               int cutoff) nogil
+    
+    int pin_current_thread(int cpu) nogil
+
+cdef extern from "popcount_simd.h":
+    void init_popcount_dispatch()
+    int popcount_impl_supported(const char * name)
+    int set_popcount_impl(const char * name)
+    const char * get_popcount_impl()
+
+# Pick the best popcount kernels for this CPU when the module is imported
+init_popcount_dispatch()
+
+POPCOUNT_IMPLS = ('scalar', 'popcnt', 'avx2', 'avx512')
+
+def cy_get_popcount_impl():
+    '''Name of the popcount implementation in use (one of POPCOUNT_IMPLS)'''
+    return get_popcount_impl().decode('ascii')
+
+def cy_get_supported_popcount_impls():
+    '''Names of the popcount implementations this CPU supports'''
+    return [name for name in POPCOUNT_IMPLS
+            if popcount_impl_supported(name.encode('ascii'))]
+
+def cy_set_popcount_impl(name):
+    '''Force a popcount implementation (mostly useful for testing/benchmarking)
+       name can be any of POPCOUNT_IMPLS that the CPU supports
+       or None to go back to the best one'''
+    if name is None:
+        init_popcount_dispatch()
+    elif set_popcount_impl(name.encode('ascii')) != 0:
+        raise ValueError('popcount implementation {!r} is not supported on this CPU '
+                         '(supported: {})'.format(name, cy_get_supported_popcount_impls()))
 
 INTERSECTION_COUNTS_DTYPE = [('i', np.uint32),
                              ('j', np.uint32),
                              ('intersection_count', np.uint32)]
 
-cdef void set_SBA_from_py_dict(SparseBlockArray * sba, input_dict, sba_ind=0):
-    '''Takes a python dictionary of arrays and fill a SparseBlockArray
-       The expected input format for the input_dict is:
-       {'locs': <numpy array of uint32>,
-        'array': <numpy array of uint64>}
+def _as_sba_packed(sba_rows, chunk_length):
+    '''Get a packed SBA with contiguous arrays (no copies if it already is one)
+       sba_rows can be either a packed SBA (see sparse_block_array.sba_pack)
+       or a list of sba dictionaries (which gets packed)'''
+    if not isinstance(sba_rows, dict):
+        sba_rows = sba_list_to_packed(sba_rows, chunk_length)
+    return {'offsets': np.ascontiguousarray(sba_rows['offsets'], dtype=np.int64),
+            'locs': np.ascontiguousarray(sba_rows['locs'], dtype=np.int32),
+            'array': np.ascontiguousarray(sba_rows['array'], dtype=np.uint64)}
+
+cdef SparseBlockArray * get_sba_pointer(sba_packed, int chunk_length):
+    '''Make a C array of SparseBlockArray's (one per row) that point
+       directly into the buffers of a packed SBA (from _as_sba_packed)
+       No python objects are created per row
+       The packed SBA must outlive the result and the caller must free it'''
+    cdef int i
+    cdef np.ndarray offsets_cn = sba_packed['offsets']
+    cdef np.ndarray locs_cn = sba_packed['locs']
+    cdef np.ndarray array_cn = sba_packed['array']
+    cdef const INT64 * offsets = <const INT64 *> offsets_cn.data
+    cdef const UINT32 * locs = <const UINT32 *> locs_cn.data
+    cdef const UINT64 * array = <const UINT64 *> array_cn.data
+    cdef int num_rows = len(offsets_cn) - 1
+    
+    cdef SparseBlockArray * sba = <SparseBlockArray *> malloc(num_rows * sizeof(SparseBlockArray))
+    if sba == NULL and num_rows > 0:
+        raise MemoryError()
+    with nogil:
+        for i in range(num_rows):
+            sba[i].locs = locs + offsets[i]
+            sba[i].array = array + offsets[i] * chunk_length
+            sba[i].len = offsets[i + 1] - offsets[i]
+    return sba
+
+def _as_roaring_packed(roaring_packed):
+    '''Get a packed roaring dictionary with contiguous arrays
+       (no copies if it already is one, see roaring.roaring_compress_index_arrays)'''
+    dtypes = {'offsets': np.int64,
+              'keys': np.uint16,
+              'types': np.uint8,
+              'sizes': np.uint16,
+              'data_offsets': np.int64,
+              'data': np.uint16,
+              'bitmap_offsets': np.int64,
+              'bitmaps': np.uint64}
+    return {name: np.ascontiguousarray(roaring_packed[name], dtype=dtype)
+            for name, dtype in dtypes.items()}
+
+cdef RoaringRow * get_roaring_pointer(roaring_packed):
+    '''Make a C array of RoaringRow's (one per row) that point
+       directly into the buffers of a packed roaring dictionary
+       (from _as_roaring_packed), same as get_sba_pointer'''
+    cdef int i
+    cdef np.ndarray offsets_cn = roaring_packed['offsets']
+    cdef np.ndarray keys_cn = roaring_packed['keys']
+    cdef np.ndarray types_cn = roaring_packed['types']
+    cdef np.ndarray sizes_cn = roaring_packed['sizes']
+    cdef np.ndarray data_offsets_cn = roaring_packed['data_offsets']
+    cdef np.ndarray data_cn = roaring_packed['data']
+    cdef np.ndarray bitmap_offsets_cn = roaring_packed['bitmap_offsets']
+    cdef np.ndarray bitmaps_cn = roaring_packed['bitmaps']
+    cdef const INT64 * offsets = <const INT64 *> offsets_cn.data
+    cdef const UINT16 * keys = <const UINT16 *> keys_cn.data
+    cdef const UINT8 * types = <const UINT8 *> types_cn.data
+    cdef const UINT16 * sizes = <const UINT16 *> sizes_cn.data
+    cdef const INT64 * data_offsets = <const INT64 *> data_offsets_cn.data
+    cdef const UINT16 * data = <const UINT16 *> data_cn.data
+    cdef const INT64 * bitmap_offsets = <const INT64 *> bitmap_offsets_cn.data
+    cdef const UINT64 * bitmaps = <const UINT64 *> bitmaps_cn.data
+    cdef int num_rows = len(offsets_cn) - 1
+    
+    cdef RoaringRow * rows = <RoaringRow *> malloc(num_rows * sizeof(RoaringRow))
+    if rows == NULL and num_rows > 0:
+        raise MemoryError()
+    with nogil:
+        for i in range(num_rows):
+            rows[i].keys = keys + offsets[i]
+            rows[i].types = types + offsets[i]
+            rows[i].sizes = sizes + offsets[i]
+            rows[i].data = data + data_offsets[i]
+            rows[i].bitmaps = bitmaps + bitmap_offsets[i] * 1024
+            rows[i].len = offsets[i + 1] - offsets[i]
+    return rows
+
+# Per-thread growable results buffers
+# Each thread appends the results for its rows to its own buffer
+# (no GIL, no python objects), and the rows get gathered into a single
+# structured array once the parallel loop is done (see _gather_results)
+cdef struct ThreadBuffer:
+    IntersectionCount * data
+    INT64 size
+    INT64 capacity
+
+cdef ThreadBuffer * _new_thread_buffers(int num_threads, INT64 initial_capacity):
+    cdef int t
+    cdef ThreadBuffer * buffers = <ThreadBuffer *> malloc(num_threads * sizeof(ThreadBuffer))
+    if buffers == NULL:
+        raise MemoryError()
+    for t in range(num_threads):
+        buffers[t].data = NULL
+        buffers[t].size = 0
+        buffers[t].capacity = 0
+    for t in range(num_threads):
+        if _reserve(&buffers[t], initial_capacity) != 0:
+            _free_thread_buffers(buffers, num_threads)
+            raise MemoryError()
+    return buffers
+
+cdef void _free_thread_buffers(ThreadBuffer * buffers, int num_threads):
+    cdef int t
+    for t in range(num_threads):
+        free(buffers[t].data)
+    free(buffers)
+
+cdef int _reserve(ThreadBuffer * buffer, INT64 extra) nogil:
+    '''Make sure there is room for extra more results (grows geometrically)
+       Returns 0 on success and -1 if the memory could not be allocated'''
+    cdef INT64 capacity
+    cdef IntersectionCount * data
+    if buffer.size + extra <= buffer.capacity:
+        return 0
+    capacity = max(2 * buffer.capacity, buffer.size + extra, 1)
+    data = <IntersectionCount *> realloc(buffer.data, <size_t> (capacity * sizeof(IntersectionCount)))
+    if data == NULL:
+        return -1
+    buffer.data = data
+    buffer.capacity = capacity
+    return 0
+
+def _get_cpu_quota():
+    '''The number of cpus allowed by a cgroup cpu quota
+       (like inside a container), or None if there is no quota'''
+    for quota_path, period_path in (('/sys/fs/cgroup/cpu.max', None),
+                                    ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+                                     '/sys/fs/cgroup/cpu/cpu.cfs_period_us')):
+        try:
+            with open(quota_path) as f:
+                values = f.read().split()
+            if period_path is not None:
+                with open(period_path) as f:
+                    values += f.read().split()
+        except (IOError, OSError):
+            continue
+        if len(values) < 2 or values[0] in ('max', '-1'):
+            return None
+        return max(int(-(-int(values[0]) // int(values[1]))), 1)
+    return None
+
+def get_default_num_threads():
+    '''The number of threads to use when none is given:
+       OMP_NUM_THREADS if it is set, otherwise the number of cpus this
+       process is allowed to run on (its affinity mask), capped by the
+       cgroup cpu quota if there is one'''
+    if os.environ.get('OMP_NUM_THREADS', '').isdigit() and int(os.environ['OMP_NUM_THREADS']) > 0:
+        return int(os.environ['OMP_NUM_THREADS'])
+    num_cpus = (len(os.sched_getaffinity(0))
+                if hasattr(os, 'sched_getaffinity') else
+                multiprocessing.cpu_count())
+    quota = _get_cpu_quota()
+    return max(min(num_cpus, quota or num_cpus), 1)
+
+cdef class ExecutionContext:
+    '''Owns the threading setup and the scratch memory for the
+       cy_compute_* functions so repeated calls (like the partitions
+       of mtm_stats_iterator) don't need to allocate anything new:
+         * num_threads: the number of threads to run (default None
+                        means get_default_num_threads())
+         * cpu_affinity: optional list of cpus, the threads get pinned to
+                         them in order (thread t runs on cpu_affinity[t % len]),
+                         the calling thread gets its own affinity back after each call
+       The OpenMP schedule a call asks for (see set_schedule) is also
+       put back the way it was after each call
+       The per-thread results buffers only ever grow and get reused,
+       everything is freed by close() (or when the context is deleted)
+       A context can only be used by one call at a time
+       
+       Example:
+           with ExecutionContext(num_threads=4) as context:
+               for partition in ...:
+                   mtm_stats_raw(..., context=context)
        '''
-    cdef np.ndarray locs_cn = input_dict['locs']
-    cdef np.ndarray array_cn = input_dict['array']
+    cdef readonly int num_threads
+    cdef readonly object cpu_affinity
+    cdef ThreadBuffer * buffers
+    cdef object scratch
+    cdef int in_use
+    cdef object _saved_affinity
+    cdef int _schedule_saved
+    cdef openmp.omp_sched_t _saved_schedule_kind
+    cdef int _saved_schedule_chunk_size
+    
+    def __cinit__(self, num_threads=None, cpu_affinity=None):
+        self.buffers = NULL
+        self.in_use = 0
+        self.scratch = {}
+        self._saved_affinity = None
+        self._schedule_saved = 0
+        self.cpu_affinity = None if cpu_affinity is None else tuple(int(cpu) for cpu in cpu_affinity)
+        if self.cpu_affinity is not None and len(self.cpu_affinity) == 0:
+            raise ValueError('cpu_affinity must have at least one cpu')
+        if num_threads is None:
+            num_threads = (get_default_num_threads()
+                           if self.cpu_affinity is None else
+                           len(self.cpu_affinity))
+        if num_threads < 1:
+            raise ValueError('num_threads must be at least 1, not {}'.format(num_threads))
+        self.num_threads = num_threads
+    
+    def __dealloc__(self):
+        if self.buffers != NULL:
+            _free_thread_buffers(self.buffers, self.num_threads)
+            self.buffers = NULL
+    
+    def close(self):
+        '''Free all the buffers now (the context can still be used after)'''
+        if self.in_use:
+            raise RuntimeError('the context is in use')
+        if self.buffers != NULL:
+            _free_thread_buffers(self.buffers, self.num_threads)
+            self.buffers = NULL
+        self.scratch = {}
+    
+    def __enter__(self):
+        return self
     
-    sba[sba_ind].locs = <const UINT32 *> locs_cn.data
-    sba[sba_ind].array = <const UINT64 *> array_cn.data
-    sba[sba_ind].len = len(locs_cn)
+    def __exit__(self, *args):
+        self.close()
+    
+    def get_buffer_capacity(self):
+        '''Total room in the per-thread results buffers (in intersection counts)'''
+        cdef int t
+        if self.buffers == NULL:
+            return 0
+        return sum(self.buffers[t].capacity for t in range(self.num_threads))
+    
+    cdef ThreadBuffer * acquire(self, INT64 initial_capacity) except NULL:
+        '''Start a call: pin the threads and hand out the (emptied)
+           results buffers with at least initial_capacity room in each'''
+        cdef int t
+        if self.in_use:
+            raise RuntimeError('the context is already in use by another call')
+        if self.buffers == NULL:
+            self.buffers = _new_thread_buffers(self.num_threads, initial_capacity)
+        for t in range(self.num_threads):
+            self.buffers[t].size = 0
+            if _reserve(&self.buffers[t], initial_capacity) != 0:
+                raise MemoryError()
+        self.in_use = 1
+        self._pin_threads()
+        return self.buffers
+    
+    def release(self):
+        '''End a call (the buffers stay around for the next one)'''
+        self.in_use = 0
+        if self._saved_affinity is not None:
+            os.sched_setaffinity(0, self._saved_affinity)
+            self._saved_affinity = None
+        if self._schedule_saved:
+            openmp.omp_set_schedule(self._saved_schedule_kind, self._saved_schedule_chunk_size)
+            self._schedule_saved = 0
+    
+    def set_schedule(self, schedule):
+        '''Set the OpenMP schedule used by the prange loops (schedule='runtime')
+           for the current call (one of SCHEDULES)
+           It is only changed when it differs from the current one and
+           release() puts the previous one back'''
+        cdef openmp.omp_sched_t kind, current_kind
+        cdef int current_chunk_size
+        if schedule not in SCHEDULES:
+            raise ValueError('schedule must be one of {}, not {!r}'.format(SCHEDULES, schedule))
+        kind = {'static': openmp.omp_sched_static,
+                'dynamic': openmp.omp_sched_dynamic,
+                'guided': openmp.omp_sched_guided,
+                'balanced': openmp.omp_sched_dynamic}[schedule]
+        openmp.omp_get_schedule(&current_kind, &current_chunk_size)
+        if current_kind == kind and current_chunk_size == 1:
+            return
+        if not self._schedule_saved:
+            self._saved_schedule_kind = current_kind
+            self._saved_schedule_chunk_size = current_chunk_size
+            self._schedule_saved = 1
+        openmp.omp_set_schedule(kind, 1)
+    
+    def get_scratch(self, name, shape, dtype):
+        '''A reusable array that starts out zeroed, the caller has to leave it
+           zeroed again when done (like the postings accumulators)'''
+        arr = self.scratch.get(name)
+        if arr is None or arr.shape != shape or arr.dtype != dtype:
+            arr = self.scratch[name] = np.zeros(shape, dtype=dtype)
+        return arr
+    
+    def _pin_threads(self):
+        '''Pin each thread of the OpenMP team to its cpu (see cpu_affinity)'''
+        cdef int t
+        cdef np.ndarray cpus_cn
+        cdef const INT32 * cpus_pointer
+        cdef int num_cpus
+        self._saved_affinity = None
+        if self.cpu_affinity is None or not hasattr(os, 'sched_setaffinity'):
+            return
+        self._saved_affinity = os.sched_getaffinity(0)
+        cpus_cn = np.array(self.cpu_affinity, dtype=np.int32)
+        cpus_pointer = <const INT32 *> cpus_cn.data
+        num_cpus = len(self.cpu_affinity)
+        with nogil, parallel(num_threads=self.num_threads):
+            t = openmp.omp_get_thread_num()
+            pin_current_thread(cpus_pointer[t % num_cpus])
+
+def _get_context(context):
+    '''The context to use for one call (a new one if context is None)'''
+    return ExecutionContext() if context is None else context
+
+cdef _release_context(ExecutionContext ctx, context):
+    '''Done with ctx for this call (it gets freed if it was only made for the call)'''
+    ctx.release()
+    if context is None:
+        ctx.close()
+
+
+cdef _gather_results(ThreadBuffer * buffers, int num_a, np.ndarray item_thread, np.ndarray item_start, np.ndarray item_count, item_rows=None):
+    '''Concatenate the results of each work item out of the per-thread buffers
+       item_thread, item_start and item_count say where the results for each item ended up
+       (a negative count means the thread buffer could not be grown)
+       item_rows is the position in indices_a of each item (default None means
+       there is one item per row), the items of a row must be next to each other
+       and in order of j
+       Returns packed intersection counts (see unpack_intersection_counts)'''
+    cdef INT64 k
+    cdef INT64 num_work = len(item_count)
+    if num_work and item_count.min() < 0:
+        raise MemoryError()
+    
+    item_offsets = np.zeros(num_work + 1, dtype=np.int64)
+    np.cumsum(item_count, out=item_offsets[1:])
+    intersection_counts = np.empty(item_offsets[-1], dtype=INTERSECTION_COUNTS_DTYPE)
+    
+    cdef np.ndarray item_offsets_cn = item_offsets
+    cdef np.ndarray intersection_counts_cn = intersection_counts
+    cdef const INT64 * item_offsets_pointer = <const INT64 *> item_offsets_cn.data
+    cdef IntersectionCount * intersection_counts_pointer = <IntersectionCount *> intersection_counts_cn.data
+    cdef const INT32 * item_thread_pointer = <const INT32 *> item_thread.data
+    cdef const INT64 * item_start_pointer = <const INT64 *> item_start.data
+    cdef const INT64 * item_count_pointer = <const INT64 *> item_count.data
+    
+    with nogil:
+        for k in range(num_work):
+            memcpy(intersection_counts_pointer + item_offsets_pointer[k],
+                   buffers[item_thread_pointer[k]].data + item_start_pointer[k],
+                   <size_t> (item_count_pointer[k] * sizeof(IntersectionCount)))
+    
+    if item_rows is None:
+        offsets = item_offsets
+    else:
+        offsets = np.zeros(num_a + 1, dtype=np.int64)
+        np.cumsum(np.bincount(item_rows, weights=item_count, minlength=num_a).astype(np.int64),
+                  out=offsets[1:])
+    return {'offsets': offsets,
+            'intersection_counts': intersection_counts}
+
+# How the rows get handed out to the threads:
+#   'static': round robin (row k goes to thread k % num_threads)
+#   'dynamic': each thread grabs the next row when it is done
+#   'guided': dynamic, but with chunks that shrink as the work runs out
+#   'balanced': rows are split into work items of similar estimated cost
+#               (heavy rows get split across threads) and handed out
+#               dynamically, most expensive first (DEFAULT)
+SCHEDULES = ('static', 'dynamic', 'guided', 'balanced')
+DEFAULT_SCHEDULE = 'balanced'
+
+# With schedule='balanced', rows that cost more than
+# 1 / (num_threads * SPLIT_FACTOR) of the total get split
+SPLIT_FACTOR = 4
+
+def _get_omp_schedule():
+    '''The current OpenMP schedule as (kind, chunk_size)
+       (see ExecutionContext.set_schedule)'''
+    cdef openmp.omp_sched_t kind
+    cdef int chunk_size
+    openmp.omp_get_schedule(&kind, &chunk_size)
+    return int(kind), chunk_size
+
+def _get_work_items(indices_a, start_j, end_j, upper_only, row_weights, row_costs, num_threads, schedule):
+    '''Turn the rows in indices_a into work items, each one comparing
+       a row against a range of j's, and pick the order to run them in
+         * row_weights estimate the cost of each row when it gets compared
+           (comparing i and j costs row_weights[i] + row_weights[j])
+         * row_costs can be given instead when the cost of a row doesn't
+           depend on the range of j's (those rows never get split)
+       Only schedule='balanced' splits rows and reorders the items
+       Returns item_rows (positions in indices_a), item_starts, item_ends
+       (the range of j's) and order (the order to run the items in)'''
+    num_a = len(indices_a)
+    starts = np.where((indices_a >= start_j) & bool(upper_only), indices_a + 1, start_j)
+    starts = np.minimum(starts, end_j).astype(np.int32)
+    rows = np.arange(num_a, dtype=np.int32)
+    ends = np.full(num_a, end_j, dtype=np.int32)
+    if schedule != 'balanced' or num_a == 0:
+        return rows, starts, ends, rows
+    
+    if row_costs is not None:
+        costs = np.asarray(row_costs, dtype=np.float64)[indices_a]
+        return rows, starts, ends, np.argsort(-costs, kind='stable').astype(np.int32)
+    
+    row_weights = np.asarray(row_weights, dtype=np.float64)
+    cumulative = np.concatenate([[0], np.cumsum(row_weights)])
+    weights_a = row_weights[indices_a]
+    costs = (end_j - starts) * weights_a + cumulative[end_j] - cumulative[starts]
+    target = costs.sum() / (num_threads * SPLIT_FACTOR)
+    num_pieces = (np.ones(num_a, dtype=np.int64)
+                  if num_threads == 1 or target <= 0 else
+                  np.clip(np.ceil(costs / target).astype(np.int64), 1, np.maximum(end_j - starts, 1)))
+    
+    # Split the heavy rows into j ranges of about the same cost
+    item_rows = np.repeat(rows, num_pieces)
+    item_starts = np.repeat(starts, num_pieces)
+    item_ends = np.repeat(ends, num_pieces)
+    first_items = np.concatenate([[0], np.cumsum(num_pieces)[:-1]])
+    for k in np.flatnonzero(num_pieces > 1):
+        j = np.arange(starts[k], end_j)
+        cost_through_j = (j - starts[k] + 1) * weights_a[k] + cumulative[j + 1] - cumulative[starts[k]]
+        bounds = starts[k] + 1 + np.searchsorted(cost_through_j,
+                                                 np.linspace(0, costs[k], num_pieces[k] + 1)[1:-1])
+        item_starts[first_items[k] + 1:first_items[k] + num_pieces[k]] = bounds
+        item_ends[first_items[k]:first_items[k] + num_pieces[k] - 1] = bounds
+    
+    item_costs = ((item_ends - item_starts) * weights_a[item_rows] +
+                  cumulative[item_ends] - cumulative[item_starts])
+    order = np.argsort(-item_costs, kind='stable').astype(np.int32)
+    return item_rows, item_starts, item_ends, order
+
+def _fill_stats(stats, schedule, num_threads, num_work, busy_time):
+    '''Record how the work was spread over the threads (if stats is a dictionary)'''
+    if stats is None:
+        return
+    mean_busy_time = busy_time.mean() if len(busy_time) else 0.0
+    stats.update({'schedule': schedule,
+                  'num_threads': num_threads,
+                  'num_work_items': num_work,
+                  'busy_time': busy_time,
+                  'imbalance': busy_time.max() / mean_busy_time if mean_busy_time > 0 else 1.0})
 
-def cy_compute_counts(sba_list, chunk_length):
+def _fill_counters(stats, packed, item_starts, item_ends, buffer_capacity, kernel_time, gather_time):
+    '''Record what the kernel did (if stats is a dictionary):
+         kernel_time: seconds in the parallel loop
+         gather_time: seconds copying the results out of the thread buffers
+         pairs_evaluated: the pairs in the j ranges given to the kernel
+                          (a similarity filter can skip some of them
+                           without intersecting them)
+         pairs_emitted: the pairs in the results
+         pairs_cut_off: the pairs left out (by the cutoff or the filter)
+         buffer_bytes: size of the per-thread results buffers
+         output_bytes: size of the packed results'''
+    if stats is None:
+        return
+    pairs_evaluated = int((np.asarray(item_ends, dtype=np.int64) - item_starts).sum())
+    pairs_emitted = len(packed['intersection_counts'])
+    stats.update({'kernel_time': kernel_time,
+                  'gather_time': gather_time,
+                  'pairs_evaluated': pairs_evaluated,
+                  'pairs_emitted': pairs_emitted,
+                  'pairs_cut_off': pairs_evaluated - pairs_emitted,
+                  'buffer_bytes': buffer_capacity * sizeof(IntersectionCount),
+                  'output_bytes': packed['offsets'].nbytes + packed['intersection_counts'].nbytes})
+
+def _count_block_merge_steps(row_lengths, item_i, item_starts, item_ends):
+    '''Most steps the sparse block merges can take for the work items
+       (comparing rows i and j walks at most len(i) + len(j) blocks)'''
+    cumulative = np.zeros(len(row_lengths) + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=cumulative[1:])
+    return int(((np.asarray(item_ends, dtype=np.int64) - item_starts) * row_lengths[item_i]).sum() +
+               (cumulative[item_ends] - cumulative[item_starts]).sum())
+
+def unpack_intersection_counts(packed):
+    '''Convert packed intersection counts (a dictionary with a single
+       'intersection_counts' structured array and the row 'offsets' into it,
+       like the packed SBA) into the classic intersection_counts_list
+       (one structured array per row, these are views, not copies)'''
+    offsets = packed['offsets']
+    intersection_counts = packed['intersection_counts']
+    return [intersection_counts[offsets[k]:offsets[k + 1]]
+            for k in range(len(offsets) - 1)]
+
+def _as_similarity_filter(similarity_filter, num_items):
+    '''Get a similarity filter with contiguous arrays (or None)
+       similarity_filter is a dictionary with:
+        * counts: the base counts of each row
+        * min_jaccard, min_cosine, min_overlap: thresholds (None or 0 to turn off)
+        * sorted_rows: (optional) rows in order of their counts
+       (see mtm_stats.get_similarity_filter)'''
+    if similarity_filter is None:
+        return None
+    counts = np.ascontiguousarray(similarity_filter['counts'], dtype=np.uint32)
+    if len(counts) != num_items:
+        raise ValueError('similarity_filter counts must have one entry per row')
+    sorted_rows = similarity_filter.get('sorted_rows')
+    sorted_rows = np.ascontiguousarray(np.argsort(counts, kind='stable')
+                                       if sorted_rows is None else
+                                       sorted_rows,
+                                       dtype=np.int32)
+    return {'counts': counts,
+            'sorted_rows': sorted_rows,
+            'sorted_counts': np.ascontiguousarray(counts[sorted_rows]),
+            'min_jaccard': float(similarity_filter.get('min_jaccard') or 0),
+            'min_cosine': float(similarity_filter.get('min_cosine') or 0),
+            'min_overlap': float(similarity_filter.get('min_overlap') or 0)}
+
+cdef SimilarityFilter * get_similarity_filter_pointer(SimilarityFilter * similarity_filter_c, similarity_filter):
+    '''Fill in a SimilarityFilter from the result of _as_similarity_filter
+       Returns NULL if there is no filter
+       The arrays in similarity_filter must outlive the result'''
+    if similarity_filter is None:
+        return NULL
+    cdef np.ndarray counts_cn = similarity_filter['counts']
+    cdef np.ndarray sorted_rows_cn = similarity_filter['sorted_rows']
+    cdef np.ndarray sorted_counts_cn = similarity_filter['sorted_counts']
+    similarity_filter_c.counts = <const UINT32 *> counts_cn.data
+    similarity_filter_c.sorted_rows = <const INT32 *> sorted_rows_cn.data
+    similarity_filter_c.sorted_counts = <const UINT32 *> sorted_counts_cn.data
+    similarity_filter_c.num_counts = len(counts_cn)
+    similarity_filter_c.min_jaccard = similarity_filter['min_jaccard']
+    similarity_filter_c.min_cosine = similarity_filter['min_cosine']
+    similarity_filter_c.min_overlap = similarity_filter['min_overlap']
+    return similarity_filter_c
+
+# Number of rows in each parallel work item of cy_compute_counts,
+# cy_compute_counts_dense_input and cy_compress_index_arrays
+COUNTS_CHUNK = 4096
+COMPRESS_CHUNK = 256
+
+def cy_compute_counts(sba_rows, chunk_length, context=None):
     '''Wrapper around compute_counts
        Inputs:
-        * sba_list: list of sparse block arrays (python format)
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
                     compressed version of the subset of B connected to each element of A
-                    specifically, an list of dictionaries with fields 'array' and 'locs'
+                    (a list of dictionaries with fields 'array' and 'locs' also works)
         * chunk_length: sba compression parameter
-        * cutoff: maximum size of intersection to keep in the output
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
        
-       Returns a numpy array (uint32) with the count for each sba_list
+       Returns a numpy array (uint32) with the count for each row
     '''
     
-    cdef int i
+    cdef int c, start
     
-    num_items = len(sba_list)
+    sba_packed = _as_sba_packed(sba_rows, chunk_length)
+    num_items = len(sba_packed['offsets']) - 1
     
     cdef int num_items_c = num_items
     cdef int chunk_length_c = chunk_length
-    
-    # Map the numpy arrays directly to C pointers
-    cdef SparseBlockArray * sba_pointer = <SparseBlockArray *> malloc(num_items * sizeof(SparseBlockArray))
-    
-    for i in range(num_items):
-        set_SBA_from_py_dict(sba_pointer, sba_list[i], sba_ind=i)
+    cdef int chunk_size = COUNTS_CHUNK
+    cdef int num_chunks = (num_items_c + chunk_size - 1) // chunk_size
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    cdef SparseBlockArray * sba_pointer = NULL
     
     # Compute the counts (bitsum the sba's)
     counts = np.zeros(num_items, dtype=np.uint32)
@@ -102,33 +791,219 @@ def cy_compute_counts(sba_list, chunk_length):
     cdef UINT32 * counts_pointer
     counts_pointer = <UINT32 *> counts_cn.data
     
-    compute_counts(sba_pointer,
-                   chunk_length_c,
-                   num_items_c,
-                   counts_pointer)
-    
+    ctx.acquire(0)
+    try:
+        # Map the numpy arrays directly to C pointers
+        sba_pointer = get_sba_pointer(sba_packed, chunk_length_c)
+        
+        # Each work item is a contiguous run of rows with its own slice of counts
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            compute_counts(sba_pointer + start,
+                           chunk_length_c,
+                           min(chunk_size, num_items_c - start),
+                           counts_pointer + start)
+    finally:
+        free(sba_pointer)
+        _release_context(ctx, context)
     return counts
 
-def cy_compute_intersection_counts(sba_list, chunk_length, indices_a=None, cutoff=0, start_j=0, upper_only=True):
-    '''Wrapper around compute_intersection_counts
+def cy_compress_index_arrays(row_indices, bit_indices, num_rows, chunk_length, context=None):
+    '''Compress many rows of indices into a packed SBA
+       (same result as sparse_block_array.sba_compress_64_index_arrays)
        Inputs:
-        * sba_list: list of sparse block arrays (python format)
-                    compressed version of the subset of B connected to each element of A
-                    specifically, an list of dictionaries with fields 'array' and 'locs'
+        * row_indices, bit_indices: parallel integer arrays with one entry
+                                    per set bit (duplicates are merged)
+        * num_rows: number of rows in the result
         * chunk_length: sba compression parameter
-        * cutoff: maximum size of intersection to keep in the output
-        * start_j: an offset to apply on comparison
-          (skip comparing against values less than start_j)
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
        
-       Returns a list of numpy structured arrays with the following fields:
-        * i, j: pair of indices into set A (set of interest)
-        * intersection_count: number of elements in B that the 
-                              A[i] and A[j] share in common
+       The bits get grouped by row (one counting sort), and then each row
+       is sorted and compressed on its own in a prange, in two passes:
+       count the blocks of every row, then fill in the preallocated
+       packed buffers at each row's offset
+       
+       Returns a packed SBA (python format, see sparse_block_array.sba_pack)
     '''
     
-    cdef int i, ii
+    cdef INT64 k, r
+    cdef int c, rr, start, end
+    
+    row_indices = np.ascontiguousarray(row_indices, dtype=np.int64)
+    bit_indices = np.ascontiguousarray(bit_indices, dtype=np.int64)
+    if len(row_indices) != len(bit_indices):
+        raise ValueError('row_indices and bit_indices must have the same length')
+    if len(row_indices) and (row_indices.min() < 0 or row_indices.max() >= num_rows):
+        raise ValueError('row_indices must be between 0 and num_rows - 1')
+    if len(bit_indices) and (bit_indices.min() < 0 or
+                             bit_indices.max() // (64 * chunk_length) > np.iinfo(np.int32).max):
+        raise ValueError('bit_indices must be positive and fit in int32 block locations')
+    
+    cdef INT64 num_bits = len(row_indices)
+    cdef int num_rows_c = num_rows
+    cdef int chunk_length_c = chunk_length
+    cdef int chunk_size = COMPRESS_CHUNK
+    cdef int num_chunks = (num_rows_c + chunk_size - 1) // chunk_size
+    
+    # Group the bits by row (counting sort)
+    row_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_indices, minlength=num_rows), out=row_offsets[1:])
+    positions = row_offsets[:-1].copy()
+    bits = np.empty(num_bits, dtype=np.int64)
+    row_num_bits = np.zeros(num_rows, dtype=np.int64)
+    row_num_blocks = np.zeros(num_rows, dtype=np.int64)
+    
+    cdef np.ndarray row_indices_cn = row_indices
+    cdef np.ndarray bit_indices_cn = bit_indices
+    cdef np.ndarray row_offsets_cn = row_offsets
+    cdef np.ndarray positions_cn = positions
+    cdef np.ndarray bits_cn = bits
+    cdef np.ndarray row_num_bits_cn = row_num_bits
+    cdef np.ndarray row_num_blocks_cn = row_num_blocks
+    cdef const INT64 * row_indices_pointer = <const INT64 *> row_indices_cn.data
+    cdef const INT64 * bit_indices_pointer = <const INT64 *> bit_indices_cn.data
+    cdef const INT64 * row_offsets_pointer = <const INT64 *> row_offsets_cn.data
+    cdef INT64 * positions_pointer = <INT64 *> positions_cn.data
+    cdef INT64 * bits_pointer = <INT64 *> bits_cn.data
+    cdef INT64 * row_num_bits_pointer = <INT64 *> row_num_bits_cn.data
+    cdef INT64 * row_num_blocks_pointer = <INT64 *> row_num_blocks_cn.data
+    
+    with nogil:
+        for k in range(num_bits):
+            r = row_indices_pointer[k]
+            bits_pointer[positions_pointer[r]] = bit_indices_pointer[k]
+            positions_pointer[r] += 1
     
-    num_items = len(sba_list)
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    cdef np.ndarray offsets_cn, locs_cn, array_cn
+    cdef const INT64 * offsets_pointer
+    cdef UINT32 * locs_pointer
+    cdef UINT64 * array_pointer
+    
+    ctx.acquire(0)
+    try:
+        # First pass: sort each row and count its blocks
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            end = min(start + chunk_size, num_rows_c)
+            for rr in range(start, end):
+                row_num_bits_pointer[rr] = sort_row_bits(bits_pointer + row_offsets_pointer[rr],
+                                                         row_offsets_pointer[rr + 1] - row_offsets_pointer[rr])
+                row_num_blocks_pointer[rr] = count_row_blocks(bits_pointer + row_offsets_pointer[rr],
+                                                              row_num_bits_pointer[rr],
+                                                              chunk_length_c)
+        
+        offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(row_num_blocks, out=offsets[1:])
+        locs = np.empty(offsets[-1], dtype=np.int32)
+        array = np.zeros(offsets[-1] * chunk_length, dtype=np.uint64)
+        
+        offsets_cn = offsets
+        locs_cn = locs
+        array_cn = array
+        offsets_pointer = <const INT64 *> offsets_cn.data
+        locs_pointer = <UINT32 *> locs_cn.data
+        array_pointer = <UINT64 *> array_cn.data
+        
+        # Second pass: write each row's blocks at its offset
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            end = min(start + chunk_size, num_rows_c)
+            for rr in range(start, end):
+                fill_row_blocks(bits_pointer + row_offsets_pointer[rr],
+                                row_num_bits_pointer[rr],
+                                chunk_length_c,
+                                locs_pointer + offsets_pointer[rr],
+                                array_pointer + offsets_pointer[rr] * chunk_length_c)
+    finally:
+        _release_context(ctx, context)
+    return {'offsets': offsets,
+            'locs': locs,
+            'array': array}
+
+# The kernels that _compute_intersection_counts can run (see _run_kernel)
+cdef enum:
+    KERNEL_SBA
+    KERNEL_DENSE
+    KERNEL_POSTINGS
+    KERNEL_ROARING
+
+# Everything the kernel of one engine needs to compare a row against a range of rows
+# (each wrapper fills in the fields of its own engine, the driver fills in
+# cutoff and similarity_filter)
+cdef struct KernelInputs:
+    int kernel
+    int cutoff
+    const SimilarityFilter * similarity_filter
+    # KERNEL_SBA and KERNEL_DENSE
+    int chunk_length
+    SparseBlockArray * sba_rows
+    UINT64 * rows_arr
+    # KERNEL_POSTINGS (with one accumulator and touched list of num_items per thread)
+    const INT64 * a_offsets
+    const INT32 * a_indices
+    const INT64 * b_offsets
+    const INT32 * b_indices
+    UINT32 * accumulators
+    INT32 * touched
+    int num_items
+    # KERNEL_ROARING
+    RoaringRow * roaring_rows
+
+cdef int _run_kernel(const KernelInputs * inputs, int i, int start_j, int end_j, int thread_number, IntersectionCount * intersection_counts) nogil:
+    '''Compare row i against rows start_j up to end_j with the kernel in inputs
+       Returns the number of intersection counts written'''
+    if inputs.kernel == KERNEL_DENSE:
+        return compute_intersection_counts_dense_input(inputs.rows_arr,
+                                                       inputs.chunk_length,
+                                                       i,
+                                                       start_j,
+                                                       end_j,
+                                                       intersection_counts,
+                                                       inputs.cutoff,
+                                                       inputs.similarity_filter)
+    if inputs.kernel == KERNEL_POSTINGS:
+        return compute_intersection_counts_postings(inputs.a_offsets,
+                                                    inputs.a_indices,
+                                                    inputs.b_offsets,
+                                                    inputs.b_indices,
+                                                    i,
+                                                    start_j,
+                                                    end_j,
+                                                    inputs.accumulators + <INT64> thread_number * inputs.num_items,
+                                                    inputs.touched + <INT64> thread_number * inputs.num_items,
+                                                    intersection_counts,
+                                                    inputs.cutoff,
+                                                    inputs.similarity_filter)
+    if inputs.kernel == KERNEL_ROARING:
+        return compute_intersection_counts_roaring(inputs.roaring_rows,
+                                                   i,
+                                                   start_j,
+                                                   end_j,
+                                                   intersection_counts,
+                                                   inputs.cutoff,
+                                                   inputs.similarity_filter)
+    return compute_intersection_counts(inputs.sba_rows,
+                                       inputs.chunk_length,
+                                       i,
+                                       start_j,
+                                       end_j,
+                                       intersection_counts,
+                                       inputs.cutoff,
+                                       inputs.similarity_filter)
+
+cdef _compute_intersection_counts(KernelInputs * inputs, int num_items, indices_a, cutoff, start_j, upper_only, similarity_filter, end_j,
+                                  row_weights, row_costs, ExecutionContext ctx, context, schedule, stats):
+    '''Shared driver of the cy_compute_intersection_counts* wrappers
+       The rows in indices_a get split into work items (see _get_work_items,
+       row_weights or row_costs estimate the cost of each row), which run
+       in a prange through the kernel in inputs (see _run_kernel) and
+       write into the per-thread results buffers of ctx
+       ctx gets released when done (see _release_context)
+       and stats gets filled in (see _fill_stats and _fill_counters)
+       Returns the packed intersection counts (see unpack_intersection_counts)
+       and the row (i), start_j and end_j of each work item'''
     
     indices_a = np.asanyarray((np.arange(num_items)
                                if indices_a is None else
@@ -137,37 +1012,45 @@ def cy_compute_intersection_counts(sba_list, chunk_length, indices_a=None, cutof
     
     num_a = len(indices_a)
     
-    intersection_counts_list = [None] * num_a
+    cdef int num_threads = ctx.num_threads
+    end_j = num_items if end_j is None else max(min(end_j, num_items), 0)
+    schedule = DEFAULT_SCHEDULE if schedule is None else schedule
     
-    cdef int num_threads = multiprocessing.cpu_count()
-    cdef int num_items_c = num_items
-    cdef int chunk_length_c = chunk_length
-    cdef int cutoff_c = cutoff
-    cdef int start_j_c = start_j
-    cdef int upper_only_c = upper_only
+    similarity_filter = _as_similarity_filter(similarity_filter, num_items)
+    cdef SimilarityFilter similarity_filter_c
+    inputs.cutoff = cutoff
+    inputs.similarity_filter = get_similarity_filter_pointer(&similarity_filter_c, similarity_filter)
     
-    # Map the numpy arrays directly to C pointers
-    cdef SparseBlockArray * sba_pointer = <SparseBlockArray *> malloc(num_items * sizeof(SparseBlockArray))
-    
-    for i in range(num_items):
-        set_SBA_from_py_dict(sba_pointer, sba_list[i], sba_ind=i)
-    
-    # Run compute_intersection_counts on the generated pointers:
-    
-    # Set up results buffer and pointers
-    # This section:
-    # * Makes a num_threads by num_items numpy array
-    # * Makes a C double pointer (array-of-arrays) of IntersectionCounts
-    # * Sets the pointers to each of the numpy sub-arrays (each is num_items)
-    # Each thread then gets it's own num_items length buffer to store its result
-    intersection_counts_tmp_arr = np.zeros((num_threads, num_items),        # Make sure each thread uses separate memory
-                                           dtype=INTERSECTION_COUNTS_DTYPE)
-    cdef np.ndarray intersection_counts_cn
-    cdef IntersectionCount ** intersection_counts_pointer_arr
-    intersection_counts_pointer_arr = <IntersectionCount **> malloc(num_threads * sizeof(IntersectionCount *))
-    for i in range(num_threads):
-        intersection_counts_cn = intersection_counts_tmp_arr[i]
-        intersection_counts_pointer_arr[i] = <IntersectionCount*> intersection_counts_cn.data
+    # Split the rows into work items and pick the order to run them in
+    item_rows, item_starts, item_ends, order = _get_work_items(indices_a, start_j, end_j, upper_only,
+                                                               row_weights, row_costs,
+                                                               num_threads, schedule)
+    num_work = len(order)
+    cdef int w, item, i
+    cdef double start_time
+    cdef int collect_stats = stats is not None
+    busy_time = np.zeros(num_threads, dtype=np.float64)
+    cdef np.ndarray busy_time_cn = busy_time
+    cdef double * busy_time_pointer = <double *> busy_time_cn.data
+    cdef np.ndarray item_rows_cn = item_rows
+    cdef np.ndarray item_starts_cn = item_starts
+    cdef np.ndarray item_ends_cn = item_ends
+    cdef np.ndarray order_cn = order
+    cdef const INT32 * item_rows_pointer = <const INT32 *> item_rows_cn.data
+    cdef const INT32 * item_starts_pointer = <const INT32 *> item_starts_cn.data
+    cdef const INT32 * item_ends_pointer = <const INT32 *> item_ends_cn.data
+    cdef const INT32 * order_pointer = <const INT32 *> order_cn.data
+    
+    # The arrays that say where each work item's results end up
+    item_thread = np.zeros(num_work, dtype=np.int32)
+    item_start = np.zeros(num_work, dtype=np.int64)
+    item_count = np.zeros(num_work, dtype=np.int64)
+    cdef np.ndarray item_thread_cn = item_thread
+    cdef np.ndarray item_start_cn = item_start
+    cdef np.ndarray item_count_cn = item_count
+    cdef INT32 * item_thread_pointer = <INT32 *> item_thread_cn.data
+    cdef INT64 * item_start_pointer = <INT64 *> item_start_cn.data
+    cdef INT64 * item_count_pointer = <INT64 *> item_count_cn.data
     
     cdef int num_intersection_counts
     cdef int thread_number
@@ -176,44 +1059,120 @@ def cy_compute_intersection_counts(sba_list, chunk_length, indices_a=None, cutof
     cdef INT32 * indices_a_pointer
     indices_a_pointer = <INT32 *> indices_a_cn.data
     
-    for ii in prange(num_a, nogil=True, chunksize=1, num_threads=num_threads, schedule='static'):
-        i = indices_a_pointer[ii] # add a layer of indirection, but should still be fast
-        thread_number = openmp.omp_get_thread_num()
-        num_intersection_counts = compute_intersection_counts(sba_pointer,
-                                                              chunk_length_c,
-                                                              i,
-                                                              i+1 if upper_only_c and start_j_c <= i else start_j_c,
-                                                              num_items_c,
-                                                              intersection_counts_pointer_arr[thread_number],
-                                                              cutoff_c)
-        with gil:
-            intersection_counts_list[ii] = np.array(intersection_counts_tmp_arr[thread_number][:num_intersection_counts])
-
-    return intersection_counts_list
-
-def cy_compute_counts_dense_input(rows_arr):
-    '''Wrapper around compute_counts
+    # Set up the per-thread results buffers (each one starts with room for one row)
+    cdef ThreadBuffer * buffers = ctx.acquire(num_items)
+    cdef ThreadBuffer * buffer
+    try:
+        ctx.set_schedule(schedule)
+        kernel_start = openmp.omp_get_wtime()
+        for w in prange(num_work, nogil=True, num_threads=num_threads, schedule='runtime'):
+            item = order_pointer[w]
+            i = indices_a_pointer[item_rows_pointer[item]] # add a layer of indirection, but should still be fast
+            thread_number = openmp.omp_get_thread_num()
+            if collect_stats:
+                start_time = openmp.omp_get_wtime()
+            buffer = &buffers[thread_number]
+            if _reserve(buffer, item_ends_pointer[item] - item_starts_pointer[item]) != 0:
+                item_count_pointer[item] = -1
+                continue
+            num_intersection_counts = _run_kernel(inputs,
+                                                  i,
+                                                  item_starts_pointer[item],
+                                                  item_ends_pointer[item],
+                                                  thread_number,
+                                                  buffer.data + buffer.size)
+            item_thread_pointer[item] = thread_number
+            item_start_pointer[item] = buffer.size
+            item_count_pointer[item] = num_intersection_counts
+            buffer.size = buffer.size + num_intersection_counts
+            if collect_stats:
+                busy_time_pointer[thread_number] = busy_time_pointer[thread_number] + openmp.omp_get_wtime() - start_time
+        
+        kernel_time = openmp.omp_get_wtime() - kernel_start
+        packed = _gather_results(buffers, num_a, item_thread, item_start, item_count, item_rows)
+        gather_time = openmp.omp_get_wtime() - kernel_start - kernel_time
+        buffer_capacity = ctx.get_buffer_capacity()
+    finally:
+        _release_context(ctx, context)
+    _fill_stats(stats, schedule, num_threads, num_work, busy_time)
+    _fill_counters(stats, packed, item_starts, item_ends, buffer_capacity, kernel_time, gather_time)
+    return packed, indices_a[item_rows], item_starts, item_ends
+
+def cy_compute_intersection_counts(sba_rows, chunk_length, indices_a=None, cutoff=0, start_j=0, upper_only=True, packed_output=False, similarity_filter=None, end_j=None, schedule=None, stats=None, context=None):
+    '''Wrapper around compute_intersection_counts
        Inputs:
-        * sba_list: list of sparse block arrays (python format)
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
                     compressed version of the subset of B connected to each element of A
-                    specifically, an list of dictionaries with fields 'array' and 'locs'
+                    (a list of dictionaries with fields 'array' and 'locs' also works)
         * chunk_length: sba compression parameter
         * cutoff: maximum size of intersection to keep in the output
+        * start_j: an offset to apply on comparison
+          (skip comparing against values less than start_j)
+        * packed_output: return packed intersection counts instead
+                         (a dictionary with a single 'intersection_counts'
+                          structured array and the row 'offsets' into it,
+                          see unpack_intersection_counts)
+        * similarity_filter: optional similarity thresholds, pairs below them
+                             are left out (see _as_similarity_filter)
+        * end_j: only compare against values less than end_j
+                 (default None means all of them)
+        * schedule: how the rows get spread over the threads, one of SCHEDULES
+                    (default None means DEFAULT_SCHEDULE)
+        * stats: if a dictionary is given, it gets filled with the busy time
+                 of each thread and other scheduling details (see _fill_stats)
+        * context: the ExecutionContext to run in (threads and reusable buffers),
+                   default None means a new one just for this call
        
-       Returns a numpy array (uint32) with the count for each sba_list
+       Returns a list of numpy structured arrays with the following fields:
+        * i, j: pair of indices into set A (set of interest)
+        * intersection_count: number of elements in B that the 
+                              A[i] and A[j] share in common
     '''
     
-    cdef int i
+    sba_packed = _as_sba_packed(sba_rows, chunk_length)
+    num_items = len(sba_packed['offsets']) - 1
+    
+    # Map the numpy arrays directly to C pointers
+    cdef KernelInputs inputs
+    inputs.kernel = KERNEL_SBA
+    inputs.chunk_length = chunk_length
+    inputs.sba_rows = get_sba_pointer(sba_packed, chunk_length)
+    try:
+        packed, item_i, item_starts, item_ends = _compute_intersection_counts(&inputs, num_items, indices_a, cutoff, start_j, upper_only,
+                                                                              similarity_filter, end_j,
+                                                                              np.diff(sba_packed['offsets']) + 0.5, None,
+                                                                              _get_context(context), context, schedule, stats)
+    finally:
+        free(inputs.sba_rows)
+    if stats is not None:
+        stats['max_block_merge_steps'] = _count_block_merge_steps(np.diff(sba_packed['offsets']), item_i,
+                                                                  item_starts, item_ends)
+    return packed if packed_output else unpack_intersection_counts(packed)
+
+def cy_compute_counts_dense_input(rows_arr, context=None):
+    '''Wrapper around compute_counts_dense_input
+       Inputs:
+        * rows_arr: 2D uint64 array, one row of bits for each element of A
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
+       
+       Returns a numpy array (uint32) with the count for each row
+    '''
+    
+    cdef int c, start
     
     num_items, chunk_length = rows_arr.shape
     
     cdef int num_items_c = num_items
     cdef int chunk_length_c = chunk_length
+    cdef int chunk_size = COUNTS_CHUNK
+    cdef int num_chunks = (num_items_c + chunk_size - 1) // chunk_size
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
     
     # Map the numpy arrays directly to C pointers
     cdef np.ndarray rows_cn
-    rows_cn = rows_arr
-    cdef UINT64 * rows_pointer = <const UINT64 *> rows_cn.data
+    rows_cn = np.ascontiguousarray(rows_arr, dtype=np.uint64)
+    cdef UINT64 * rows_pointer = <UINT64 *> rows_cn.data
     
     # Compute the counts (bitsum the rows)
     counts = np.zeros(num_items, dtype=np.uint32)
@@ -221,14 +1180,20 @@ def cy_compute_counts_dense_input(rows_arr):
     cdef UINT32 * counts_pointer
     counts_pointer = <UINT32 *> counts_cn.data
     
-    compute_counts_dense_input(rows_pointer,
-                               chunk_length_c,
-                               num_items_c,
-                               counts_pointer)
-    
+    # Each work item is a contiguous run of rows with its own slice of counts
+    ctx.acquire(0)
+    try:
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            compute_counts_dense_input(rows_pointer + <INT64> start * chunk_length_c,
+                                       chunk_length_c,
+                                       min(chunk_size, num_items_c - start),
+                                       counts_pointer + start)
+    finally:
+        _release_context(ctx, context)
     return counts
 
-def cy_compute_intersection_counts_dense_input(rows_arr, indices_a=None, cutoff=0, start_j=0, upper_only=True):
+def cy_compute_intersection_counts_dense_input(rows_arr, indices_a=None, cutoff=0, start_j=0, upper_only=True, packed_output=False, similarity_filter=None, end_j=None, schedule=None, stats=None, context=None):
     '''Wrapper around compute_intersection_counts_dense_input
        Inputs:
         * rows_arr: array of uint64 values with shape (num_rows, chunk_length)
@@ -238,6 +1203,20 @@ def cy_compute_intersection_counts_dense_input(rows_arr, indices_a=None, cutoff=
         * cutoff: maximum size of intersection to keep in the output
         * start_j: an offset to apply on comparison
           (skip comparing against values less than start_j)
+        * packed_output: return packed intersection counts instead
+                         (a dictionary with a single 'intersection_counts'
+                          structured array and the row 'offsets' into it,
+                          see unpack_intersection_counts)
+        * similarity_filter: optional similarity thresholds, pairs below them
+                             are left out (see _as_similarity_filter)
+        * end_j: only compare against values less than end_j
+                 (default None means all of them)
+        * schedule: how the rows get spread over the threads, one of SCHEDULES
+                    (default None means DEFAULT_SCHEDULE)
+        * stats: if a dictionary is given, it gets filled with the busy time
+                 of each thread and other scheduling details (see _fill_stats)
+        * context: the ExecutionContext to run in (threads and reusable buffers),
+                   default None means a new one just for this call
        
        Returns a list of numpy structured arrays with the following fields:
         * i, j: pair of indices into set A (set of interest)
@@ -245,77 +1224,671 @@ def cy_compute_intersection_counts_dense_input(rows_arr, indices_a=None, cutoff=
                               A[i] and A[j] share in common
     '''
     
-    cdef int i, ii
-    
     num_items, chunk_length = rows_arr.shape
     
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray rows_cn
+    rows_cn = rows_arr
+    cdef KernelInputs inputs
+    inputs.kernel = KERNEL_DENSE
+    inputs.chunk_length = chunk_length
+    inputs.rows_arr = <UINT64 *> rows_cn.data
+    
+    packed = _compute_intersection_counts(&inputs, num_items, indices_a, cutoff, start_j, upper_only,
+                                          similarity_filter, end_j,
+                                          np.full(num_items, chunk_length / 2 + 0.5), None,
+                                          _get_context(context), context, schedule, stats)[0]
+    return packed if packed_output else unpack_intersection_counts(packed)
+
+def cy_compute_intersection_counts_postings(postings, indices_a=None, cutoff=0, start_j=0, upper_only=True, packed_output=False, similarity_filter=None, end_j=None, schedule=None, stats=None, context=None):
+    '''Wrapper around compute_intersection_counts_postings
+       Inputs:
+        * postings: dictionary of arrays with the connections in both directions
+                    (see mtm_stats.convert_indices_to_postings):
+                    'a_offsets', 'a_indices': the B's for each A (CSR)
+                    'b_offsets', 'b_indices': the A's for each B (postings lists)
+        * indices_a: parameter to allow only running computing intersections
+                     of certain values against the rest of the values
+                     (with default None, compute all indices against all others)
+        * cutoff: maximum size of intersection to keep in the output
+        * start_j: an offset to apply on comparison
+          (skip comparing against values less than start_j)
+        * packed_output: return packed intersection counts instead
+                         (a dictionary with a single 'intersection_counts'
+                          structured array and the row 'offsets' into it,
+                          see unpack_intersection_counts)
+        * similarity_filter: optional similarity thresholds, pairs below them
+                             are left out (see _as_similarity_filter)
+        * end_j: only compare against values less than end_j
+                 (default None means all of them)
+        * schedule: how the rows get spread over the threads, one of SCHEDULES
+                    (default None means DEFAULT_SCHEDULE)
+        * stats: if a dictionary is given, it gets filled with the busy time
+                 of each thread and other scheduling details (see _fill_stats)
+        * context: the ExecutionContext to run in (threads and reusable buffers),
+                   default None means a new one just for this call
+       
+       Returns a list of numpy structured arrays with the following fields:
+        * i, j: pair of indices into set A (set of interest)
+        * intersection_count: number of elements in B that the 
+                              A[i] and A[j] share in common
+    '''
+    
+    a_offsets = np.ascontiguousarray(postings['a_offsets'], dtype=np.int64)
+    a_indices = np.ascontiguousarray(postings['a_indices'], dtype=np.int32)
+    b_offsets = np.ascontiguousarray(postings['b_offsets'], dtype=np.int64)
+    b_indices = np.ascontiguousarray(postings['b_indices'], dtype=np.int32)
+    num_items = len(a_offsets) - 1
+    
+    cdef ExecutionContext ctx = _get_context(context)
+    
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray a_offsets_cn = a_offsets
+    cdef np.ndarray a_indices_cn = a_indices
+    cdef np.ndarray b_offsets_cn = b_offsets
+    cdef np.ndarray b_indices_cn = b_indices
+    cdef KernelInputs inputs
+    inputs.kernel = KERNEL_POSTINGS
+    inputs.a_offsets = <const INT64 *> a_offsets_cn.data
+    inputs.a_indices = <const INT32 *> a_indices_cn.data
+    inputs.b_offsets = <const INT64 *> b_offsets_cn.data
+    inputs.b_indices = <const INT32 *> b_indices_cn.data
+    inputs.num_items = num_items
+    
+    # Set up the per-thread sparse accumulators
+    # (the kernel leaves them zeroed, so they can be reused)
+    accumulator_arr = ctx.get_scratch('accumulator', (ctx.num_threads, num_items), np.uint32)
+    touched_arr = ctx.get_scratch('touched', (ctx.num_threads, num_items), np.int32)
+    cdef np.ndarray accumulator_cn = accumulator_arr
+    cdef np.ndarray touched_cn = touched_arr
+    inputs.accumulators = <UINT32 *> accumulator_cn.data
+    inputs.touched = <INT32 *> touched_cn.data
+    
+    # The cost of a row is the length of all the postings lists it walks
+    postings_lengths = np.concatenate([[0], np.cumsum(np.diff(b_offsets)[a_indices])])
+    packed = _compute_intersection_counts(&inputs, num_items, indices_a, cutoff, start_j, upper_only,
+                                          similarity_filter, end_j,
+                                          None, postings_lengths[a_offsets[1:]] - postings_lengths[a_offsets[:-1]] + 1,
+                                          ctx, context, schedule, stats)[0]
+    return packed if packed_output else unpack_intersection_counts(packed)
+
+def cy_compute_intersection_counts_roaring(roaring_rows, indices_a=None, cutoff=0, start_j=0, upper_only=True, packed_output=False, similarity_filter=None, end_j=None, schedule=None, stats=None, context=None):
+    '''Wrapper around compute_intersection_counts_roaring
+       Inputs:
+        * roaring_rows: packed roaring dictionary (see roaring.roaring_compress_index_arrays)
+                        hybrid compressed version of the subset of B connected to each element of A
+        * indices_a: parameter to allow only running computing intersections
+                     of certain values against the rest of the values
+                     (with default None, compute all indices against all others)
+        * cutoff: maximum size of intersection to keep in the output
+        * start_j: an offset to apply on comparison
+          (skip comparing against values less than start_j)
+        * packed_output: return packed intersection counts instead
+                         (a dictionary with a single 'intersection_counts'
+                          structured array and the row 'offsets' into it,
+                          see unpack_intersection_counts)
+        * similarity_filter: optional similarity thresholds, pairs below them
+                             are left out (see _as_similarity_filter)
+        * end_j: only compare against values less than end_j
+                 (default None means all of them)
+        * schedule: how the rows get spread over the threads, one of SCHEDULES
+                    (default None means DEFAULT_SCHEDULE)
+        * stats: if a dictionary is given, it gets filled with the busy time
+                 of each thread and other scheduling details (see _fill_stats)
+        * context: the ExecutionContext to run in (threads and reusable buffers),
+                   default None means a new one just for this call
+       
+       Returns a list of numpy structured arrays with the following fields:
+        * i, j: pair of indices into set A (set of interest)
+        * intersection_count: number of elements in B that the 
+                              A[i] and A[j] share in common
+    '''
+    
+    roaring_packed = _as_roaring_packed(roaring_rows)
+    num_items = len(roaring_packed['offsets']) - 1
+    
+    # Map the numpy arrays directly to C pointers
+    cdef KernelInputs inputs
+    inputs.kernel = KERNEL_ROARING
+    inputs.roaring_rows = get_roaring_pointer(roaring_packed)
+    try:
+        packed = _compute_intersection_counts(&inputs, num_items, indices_a, cutoff, start_j, upper_only,
+                                              similarity_filter, end_j,
+                                              np.diff(roaring_packed['offsets']) + 0.5, None,
+                                              _get_context(context), context, schedule, stats)[0]
+    finally:
+        free(inputs.roaring_rows)
+    return packed if packed_output else unpack_intersection_counts(packed)
+
+
+# Largest number of (query, candidate) results held at once by
+# cy_compute_intersection_counts_query (the queries run in batches)
+QUERY_BATCH_PAIRS = 2 ** 22
+
+def _as_row_indices(indices, num_items, name):
+    '''Check that indices are valid row indices and get them as int32'''
+    indices = np.ascontiguousarray(indices, dtype=np.int32).ravel()
+    if len(indices) and (indices.min() < 0 or indices.max() >= num_items):
+        raise IndexError('{} must be between 0 and {}'.format(name, num_items - 1))
+    return indices
+
+def cy_compute_intersection_counts_query(sba_rows, chunk_length, query_indices=None, query_rows=None, candidates=None, cutoff=0, context=None):
+    '''Wrapper around compute_intersection_counts_candidates
+       Intersect a few query rows against an explicit list of candidate rows
+       (instead of a range of j like cy_compute_intersection_counts)
+       Inputs:
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
+        * chunk_length: sba compression parameter
+        * query_indices: the rows of sba_rows to use as queries
+                         (each one is not compared with itself)
+        * query_rows: or, a separate packed SBA of query rows
+                      (that don't have to be in sba_rows at all)
+        * candidates: the rows of sba_rows to compare against
+                      (default None means all rows)
+        * cutoff: only keep pairs with an intersection larger than this
+        * context: the ExecutionContext to run in (only used with more
+                   than one query, a single query runs on the calling
+                   thread without starting any other threads)
+       
+       Returns packed intersection counts (see unpack_intersection_counts)
+       with one row per query, in order of the candidates
+       i is the query's row index (or its position in query_rows)
+    '''
+    
+    cdef int q, qq, batch_start, num_batch
+    
+    sba_packed = _as_sba_packed(sba_rows, chunk_length)
+    num_items = len(sba_packed['offsets']) - 1
+    if (query_indices is None) == (query_rows is None):
+        raise ValueError('give exactly one of query_indices or query_rows')
+    if query_rows is not None:
+        query_packed = _as_sba_packed(query_rows, chunk_length)
+        num_queries = len(query_packed['offsets']) - 1
+        query_indices = np.arange(num_queries, dtype=np.int32)
+    else:
+        query_packed = sba_packed
+        query_indices = _as_row_indices(query_indices, num_items, 'query_indices')
+        num_queries = len(query_indices)
+    
+    all_candidates = candidates is None
+    candidates = (np.zeros(1, dtype=np.int32)
+                  if all_candidates else
+                  _as_row_indices(candidates, num_items, 'candidates'))
+    cdef int num_candidates = num_items if all_candidates else len(candidates)
+    
+    cdef int chunk_length_c = chunk_length
+    cdef int cutoff_c = cutoff
+    cdef int skip_self = query_rows is None
+    cdef int batch_size = max(1, min(num_queries, QUERY_BATCH_PAIRS // max(num_candidates, 1)))
+    cdef np.ndarray query_indices_cn = query_indices
+    cdef np.ndarray candidates_cn = candidates
+    cdef INT32 * query_indices_pointer = <INT32 *> query_indices_cn.data
+    cdef const INT32 * candidates_pointer = NULL if all_candidates else <const INT32 *> candidates_cn.data
+    
+    # Each query writes straight into its own slice of the batch output
+    output = np.empty(batch_size * max(num_candidates, 1), dtype=INTERSECTION_COUNTS_DTYPE)
+    counts = np.zeros(batch_size, dtype=np.int32)
+    cdef np.ndarray output_cn = output
+    cdef np.ndarray counts_cn = counts
+    cdef IntersectionCount * output_pointer = <IntersectionCount *> output_cn.data
+    cdef INT32 * counts_pointer = <INT32 *> counts_cn.data
+    
+    cdef SparseBlockArray * sba_pointer = NULL
+    cdef SparseBlockArray * query_pointer = NULL
+    cdef ExecutionContext ctx = None
+    cdef int num_threads = 1
+    if num_queries > 1:
+        ctx = _get_context(context)
+        num_threads = ctx.num_threads
+        ctx.acquire(0)
+    try:
+        sba_pointer = get_sba_pointer(sba_packed, chunk_length_c)
+        query_pointer = (sba_pointer
+                         if query_rows is None else
+                         get_sba_pointer(query_packed, chunk_length_c))
+        
+        intersection_counts_list = []
+        for batch_start in range(0, num_queries, batch_size):
+            num_batch = min(batch_size, num_queries - batch_start)
+            if num_batch == 1:
+                # Latency path for a single query, no thread team
+                q = query_indices_pointer[batch_start]
+                with nogil:
+                    counts_pointer[0] = compute_intersection_counts_candidates(query_pointer[q],
+                                                                               sba_pointer,
+                                                                               chunk_length_c,
+                                                                               q,
+                                                                               q if skip_self else -1,
+                                                                               candidates_pointer,
+                                                                               num_candidates,
+                                                                               output_pointer,
+                                                                               cutoff_c)
+            else:
+                for qq in prange(num_batch, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+                    q = query_indices_pointer[batch_start + qq]
+                    counts_pointer[qq] = compute_intersection_counts_candidates(query_pointer[q],
+                                                                                sba_pointer,
+                                                                                chunk_length_c,
+                                                                                q,
+                                                                                q if skip_self else -1,
+                                                                                candidates_pointer,
+                                                                                num_candidates,
+                                                                                output_pointer + <INT64> qq * num_candidates,
+                                                                                cutoff_c)
+            batch_output = output[:num_batch * max(num_candidates, 1)].reshape(num_batch, -1)
+            keep = np.arange(batch_output.shape[1]) < counts[:num_batch, None]
+            intersection_counts_list.append((batch_output[keep], counts[:num_batch].copy()))
+    finally:
+        if query_pointer != sba_pointer:
+            free(query_pointer)
+        free(sba_pointer)
+        if ctx is not None:
+            _release_context(ctx, context)
+    
+    offsets = np.zeros(num_queries + 1, dtype=np.int64)
+    if intersection_counts_list:
+        np.cumsum(np.concatenate([c for _, c in intersection_counts_list]), out=offsets[1:])
+    intersection_counts = (np.concatenate([ic for ic, _ in intersection_counts_list])
+                           if intersection_counts_list else
+                           np.zeros(0, dtype=INTERSECTION_COUNTS_DTYPE))
+    return {'offsets': offsets,
+            'intersection_counts': intersection_counts}
+
+# Number of pairs in each parallel work item of cy_compute_min_sums
+MIN_SUMS_CHUNK = 1024
+
+def cy_compute_min_sums(sba_rows, chunk_length, sba_weights, intersection_counts, context=None):
+    '''Wrapper around compute_min_sums
+       Inputs:
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
+        * chunk_length: sba compression parameter
+        * sba_weights: the weights that go with sba_rows
+                       (see sparse_block_array.sba_weights_from_index_arrays)
+        * intersection_counts: the pairs to compute, either packed intersection
+                               counts or an INTERSECTION_COUNTS_DTYPE array
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
+       
+       Returns the sum of min(w_i, w_j) over the B's that each pair has in common
+       (a float64 array, in the same order as the pairs)
+    '''
+    
+    cdef int c, start
+    
+    sba_packed = _as_sba_packed(sba_rows, chunk_length)
+    if isinstance(intersection_counts, dict):
+        intersection_counts = intersection_counts['intersection_counts']
+    intersection_counts = np.ascontiguousarray(intersection_counts, dtype=INTERSECTION_COUNTS_DTYPE)
+    weights = np.ascontiguousarray(sba_weights['weights'], dtype=np.float64)
+    block_weight_offsets = np.ascontiguousarray(sba_weights['block_weight_offsets'], dtype=np.int64)
+    if len(block_weight_offsets) != len(sba_packed['locs']):
+        raise ValueError('sba_weights must have one block_weight_offset per SBA block')
+    min_sums = np.zeros(len(intersection_counts), dtype=np.float64)
+    
+    cdef int num_pairs = len(intersection_counts)
+    cdef int num_chunks = (num_pairs + MIN_SUMS_CHUNK - 1) // MIN_SUMS_CHUNK
+    cdef int chunk_size = MIN_SUMS_CHUNK
+    cdef int chunk_length_c = chunk_length
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray offsets_cn = sba_packed['offsets']
+    cdef np.ndarray block_weight_offsets_cn = block_weight_offsets
+    cdef np.ndarray weights_cn = weights
+    cdef np.ndarray intersection_counts_cn = intersection_counts
+    cdef np.ndarray min_sums_cn = min_sums
+    cdef const INT64 * offsets_pointer = <const INT64 *> offsets_cn.data
+    cdef const INT64 * block_weight_offsets_pointer = <const INT64 *> block_weight_offsets_cn.data
+    cdef const double * weights_pointer = <const double *> weights_cn.data
+    cdef const IntersectionCount * intersection_counts_pointer = <const IntersectionCount *> intersection_counts_cn.data
+    cdef double * min_sums_pointer = <double *> min_sums_cn.data
+    
+    cdef SparseBlockArray * sba_pointer = NULL
+    ctx.acquire(0)
+    try:
+        # Map the packed SBA to C pointers
+        sba_pointer = get_sba_pointer(sba_packed, chunk_length_c)
+        
+        # Each work item is a contiguous run of pairs with its own slice of min_sums
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            compute_min_sums(sba_pointer,
+                             offsets_pointer,
+                             block_weight_offsets_pointer,
+                             weights_pointer,
+                             chunk_length_c,
+                             intersection_counts_pointer + start,
+                             min(chunk_size, num_pairs - start),
+                             min_sums_pointer + start)
+    finally:
+        free(sba_pointer)
+        _release_context(ctx, context)
+    return min_sums
+
+# The derived set statistics that cy_compute_pair_metrics can add to each pair
+# (the counts are uint32 and the rest are float32 or float64):
+#   union_count: count_i + count_j - intersection_count
+#   difference_ij_count: count_i - intersection_count (the B's of i that j doesn't have)
+#   difference_ji_count: count_j - intersection_count
+#   symmetric_difference_count: union_count - intersection_count
+#   jaccard: intersection_count / union_count
+#   cosine: intersection_count / sqrt(count_i * count_j)
+#   overlap: intersection_count / min(count_i, count_j)
+#   dice: 2 * intersection_count / (count_i + count_j)
+#   lift: intersection_count * num_b / (count_i * count_j)
+#   pmi: log(lift)
+# Ratios with a zero denominator are 0
+PAIR_METRICS = {'union_count': PAIR_METRIC_UNION,
+                'difference_ij_count': PAIR_METRIC_DIFFERENCE_IJ,
+                'difference_ji_count': PAIR_METRIC_DIFFERENCE_JI,
+                'symmetric_difference_count': PAIR_METRIC_SYMMETRIC_DIFFERENCE,
+                'jaccard': PAIR_METRIC_JACCARD,
+                'cosine': PAIR_METRIC_COSINE,
+                'overlap': PAIR_METRIC_OVERLAP,
+                'dice': PAIR_METRIC_DICE,
+                'lift': PAIR_METRIC_LIFT,
+                'pmi': PAIR_METRIC_PMI}
+
+# Number of pairs in each parallel work item of cy_compute_pair_metrics
+PAIR_METRICS_CHUNK = 65536
+
+def get_pair_metrics_dtype(metrics, float_dtype=np.float32):
+    '''The structured dtype of cy_compute_pair_metrics: i, j and
+       intersection_count and then each metric in the order given'''
+    fields = [('i', np.uint32), ('j', np.uint32), ('intersection_count', np.uint32)]
+    for name in metrics:
+        if name not in PAIR_METRICS:
+            raise ValueError('unknown metric {!r}, expected one of {}'.format(name, sorted(PAIR_METRICS)))
+        fields.append((name, np.uint32 if PAIR_METRICS[name] <= PAIR_METRIC_LAST_COUNT else float_dtype))
+    return np.dtype(fields)
+
+def cy_compute_pair_metrics(intersection_counts, counts, metrics, num_b=None, float_dtype=np.float32, context=None):
+    '''Wrapper around compute_pair_metrics
+       Inputs:
+        * intersection_counts: packed intersection counts
+                               or an INTERSECTION_COUNTS_DTYPE array
+        * counts: the base counts (uint32, one per row)
+        * metrics: the names of the metrics to compute (see PAIR_METRICS)
+        * num_b: the number of B's (only needed for 'lift' and 'pmi')
+        * float_dtype: np.float32 (default) or np.float64 for the ratios
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
+       
+       Returns a structured array (see get_pair_metrics_dtype) with one
+       record per pair, in the same order as intersection_counts
+    '''
+    
+    cdef int c
+    cdef INT64 start
+    
+    metrics = list(dict.fromkeys(metrics)) # drop repeats, keep the order
+    float_dtype = np.dtype(float_dtype)
+    if float_dtype not in (np.dtype(np.float32), np.dtype(np.float64)):
+        raise ValueError('float_dtype must be float32 or float64, not {}'.format(float_dtype))
+    if num_b is None and ('lift' in metrics or 'pmi' in metrics):
+        raise ValueError('num_b is needed for the lift and the pmi')
+    dtype = get_pair_metrics_dtype(metrics, float_dtype)
+    if isinstance(intersection_counts, dict):
+        intersection_counts = intersection_counts['intersection_counts']
+    intersection_counts = np.ascontiguousarray(intersection_counts, dtype=INTERSECTION_COUNTS_DTYPE)
+    counts = np.ascontiguousarray(counts, dtype=np.uint32)
+    metric_offsets = np.full(NUM_PAIR_METRICS, -1, dtype=np.int64)
+    for name in metrics:
+        metric_offsets[PAIR_METRICS[name]] = dtype.fields[name][1]
+    output = np.empty(len(intersection_counts), dtype=dtype)
+    
+    cdef INT64 num_pairs = len(intersection_counts)
+    cdef INT64 chunk_size = PAIR_METRICS_CHUNK
+    cdef int num_chunks = (num_pairs + chunk_size - 1) // chunk_size
+    cdef double num_b_c = 0 if num_b is None else num_b
+    cdef int double_precision = float_dtype == np.dtype(np.float64)
+    cdef INT64 record_size = dtype.itemsize
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray intersection_counts_cn = intersection_counts
+    cdef np.ndarray counts_cn = counts
+    cdef np.ndarray metric_offsets_cn = metric_offsets
+    cdef np.ndarray output_cn = output
+    cdef const IntersectionCount * intersection_counts_pointer = <const IntersectionCount *> intersection_counts_cn.data
+    cdef const UINT32 * counts_pointer = <const UINT32 *> counts_cn.data
+    cdef const INT64 * metric_offsets_pointer = <const INT64 *> metric_offsets_cn.data
+    cdef char * output_pointer = <char *> output_cn.data
+    
+    # Each work item is a contiguous run of pairs with its own slice of the output
+    ctx.acquire(0)
+    try:
+        for c in prange(num_chunks, nogil=True, chunksize=1, num_threads=num_threads, schedule='dynamic'):
+            start = c * chunk_size
+            compute_pair_metrics(intersection_counts_pointer + start,
+                                 min(chunk_size, num_pairs - start),
+                                 counts_pointer,
+                                 num_b_c,
+                                 metric_offsets_pointer,
+                                 double_precision,
+                                 record_size,
+                                 output_pointer + start * record_size)
+    finally:
+        _release_context(ctx, context)
+    return output
+
+TOPK_METRICS = {'intersection': TOPK_INTERSECTION,
+                'jaccard': TOPK_JACCARD}
+
+def _get_topk_setup(counts, k, metric, indices_a, num_items):
+    '''Shared argument handling for the top-k wrappers
+       Returns the metric code, indices_a and the (empty) output arrays'''
+    if metric not in TOPK_METRICS:
+        raise ValueError('metric must be one of {}, not {!r}'.format(sorted(TOPK_METRICS), metric))
+    if k < 0:
+        raise ValueError('k must be non-negative')
+    if len(counts) != num_items:
+        raise ValueError('counts must have one entry per row')
     indices_a = np.asanyarray((np.arange(num_items)
                                if indices_a is None else
                                indices_a),
                               dtype=np.int32)
+    top_indices = np.empty((len(indices_a), k), dtype=np.int32)
+    top_scores = np.empty((len(indices_a), k), dtype=np.float64)
+    return TOPK_METRICS[metric], indices_a, top_indices, top_scores
+
+def cy_compute_topk(sba_rows, chunk_length, counts, k, metric='jaccard', indices_a=None, cutoff=0, context=None):
+    '''Wrapper around compute_topk
+       Inputs:
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
+                    (a list of dictionaries with fields 'array' and 'locs' also works)
+        * chunk_length: sba compression parameter
+        * counts: the base counts for each row (from cy_compute_counts)
+        * k: number of neighbours to keep for each row
+        * metric: 'jaccard' or 'intersection' (see TOPK_METRICS)
+        * indices_a: rows to find the neighbours of (default None means all rows)
+        * cutoff: only consider pairs with an intersection larger than this
+        * context: the ExecutionContext to run in (see cy_compute_intersection_counts)
+       
+       Returns two (len(indices_a), k) arrays, sorted best first (ties by j):
+        * top_indices (int32): indices of the neighbours (-1 when there are fewer than k)
+        * top_scores (float64): the score for each neighbour (0 when there is none)
+    '''
     
-    num_a = len(indices_a)
+    cdef int i, ii
     
-    intersection_counts_list = [None] * num_a
+    sba_packed = _as_sba_packed(sba_rows, chunk_length)
+    num_items = len(sba_packed['offsets']) - 1
+    counts = np.ascontiguousarray(counts, dtype=np.uint32)
+    metric_c, indices_a, top_indices, top_scores = _get_topk_setup(counts, k, metric, indices_a, num_items)
     
-    cdef int num_threads = multiprocessing.cpu_count()
+    cdef int num_a = len(indices_a)
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
     cdef int num_items_c = num_items
     cdef int chunk_length_c = chunk_length
+    cdef int metric_code = metric_c
+    cdef int k_c = k
     cdef int cutoff_c = cutoff
-    cdef int start_j_c = start_j
-    cdef int upper_only_c = upper_only
     
     # Map the numpy arrays directly to C pointers
-    cdef np.ndarray rows_cn
-    rows_cn = rows_arr
-    cdef UINT64 * rows_pointer = <const UINT64 *> rows_cn.data
-    
-    # Run compute_intersection_counts on the generated pointers:
-    
-    # Set up results buffer and pointers
-    # This section:
-    # * Makes a num_threads by num_items numpy array
-    # * Makes a C double pointer (array-of-arrays) of IntersectionCounts
-    # * Sets the pointers to each of the numpy sub-arrays (each is num_items)
-    # Each thread then gets it's own num_items length buffer to store its result
-    intersection_counts_tmp_arr = np.zeros((num_threads, num_items),        # Make sure each thread uses separate memory
-                                           dtype=INTERSECTION_COUNTS_DTYPE)
-    cdef np.ndarray intersection_counts_cn
-    cdef IntersectionCount ** intersection_counts_pointer_arr
-    intersection_counts_pointer_arr = <IntersectionCount **> malloc(num_threads * sizeof(IntersectionCount *))
-    for i in range(num_threads):
-        intersection_counts_cn = intersection_counts_tmp_arr[i]
-        intersection_counts_pointer_arr[i] = <IntersectionCount*> intersection_counts_cn.data
+    cdef np.ndarray counts_cn = counts
+    cdef np.ndarray indices_a_cn = indices_a
+    cdef np.ndarray top_indices_cn = top_indices
+    cdef np.ndarray top_scores_cn = top_scores
+    cdef const UINT32 * counts_pointer = <const UINT32 *> counts_cn.data
+    cdef INT32 * indices_a_pointer = <INT32 *> indices_a_cn.data
+    cdef INT32 * top_indices_pointer = <INT32 *> top_indices_cn.data
+    cdef double * top_scores_pointer = <double *> top_scores_cn.data
     
-    cdef int num_intersection_counts
-    cdef int thread_number
+    cdef SparseBlockArray * sba_pointer = NULL
+    ctx.acquire(0)
+    try:
+        # Map the packed SBA to C pointers
+        sba_pointer = get_sba_pointer(sba_packed, chunk_length_c)
+        
+        # Each row writes straight into its own row of the outputs
+        for ii in prange(num_a, nogil=True, chunksize=1, num_threads=num_threads, schedule='static'):
+            i = indices_a_pointer[ii]
+            compute_topk(sba_pointer,
+                         chunk_length_c,
+                         i,
+                         num_items_c,
+                         counts_pointer,
+                         metric_code,
+                         k_c,
+                         top_indices_pointer + <INT64> ii * k_c,
+                         top_scores_pointer + <INT64> ii * k_c,
+                         cutoff_c)
+    finally:
+        free(sba_pointer)
+        _release_context(ctx, context)
+    return top_indices, top_scores
+
+def cy_compute_topk_dense_input(rows_arr, counts, k, metric='jaccard', indices_a=None, cutoff=0, context=None):
+    '''Wrapper around compute_topk_dense_input
+       Same as cy_compute_topk, but rows_arr is an array of uint64 values
+       with shape (num_rows, chunk_length)'''
+    
+    cdef int i, ii
+    
+    num_items, chunk_length = rows_arr.shape
+    counts = np.ascontiguousarray(counts, dtype=np.uint32)
+    metric_c, indices_a, top_indices, top_scores = _get_topk_setup(counts, k, metric, indices_a, num_items)
     
+    cdef int num_a = len(indices_a)
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    cdef int num_items_c = num_items
+    cdef int chunk_length_c = chunk_length
+    cdef int metric_code = metric_c
+    cdef int k_c = k
+    cdef int cutoff_c = cutoff
+    
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray rows_cn = rows_arr
+    cdef np.ndarray counts_cn = counts
     cdef np.ndarray indices_a_cn = indices_a
-    cdef INT32 * indices_a_pointer
-    indices_a_pointer = <INT32 *> indices_a_cn.data
+    cdef np.ndarray top_indices_cn = top_indices
+    cdef np.ndarray top_scores_cn = top_scores
+    cdef UINT64 * rows_pointer = <UINT64 *> rows_cn.data
+    cdef const UINT32 * counts_pointer = <const UINT32 *> counts_cn.data
+    cdef INT32 * indices_a_pointer = <INT32 *> indices_a_cn.data
+    cdef INT32 * top_indices_pointer = <INT32 *> top_indices_cn.data
+    cdef double * top_scores_pointer = <double *> top_scores_cn.data
     
-    for ii in prange(num_a, nogil=True, chunksize=1, num_threads=num_threads, schedule='static'):
-        i = indices_a_pointer[ii] # add a layer of indirection, but should still be fast
-        thread_number = openmp.omp_get_thread_num()
-        num_intersection_counts = compute_intersection_counts_dense_input(rows_pointer,
-                                                                          chunk_length_c,
-                                                                          i,
-                                                                          i+1 if upper_only_c and start_j_c <= i else start_j_c,
-                                                                          num_items_c,
-                                                                          intersection_counts_pointer_arr[thread_number],
-                                                                          cutoff_c)
-        with gil:
-            intersection_counts_list[ii] = np.array(intersection_counts_tmp_arr[thread_number][:num_intersection_counts])
-
-    return intersection_counts_list
+    ctx.acquire(0)
+    try:
+        for ii in prange(num_a, nogil=True, chunksize=1, num_threads=num_threads, schedule='static'):
+            i = indices_a_pointer[ii]
+            compute_topk_dense_input(rows_pointer,
+                                     chunk_length_c,
+                                     i,
+                                     num_items_c,
+                                     counts_pointer,
+                                     metric_code,
+                                     k_c,
+                                     top_indices_pointer + <INT64> ii * k_c,
+                                     top_scores_pointer + <INT64> ii * k_c,
+                                     cutoff_c)
+    finally:
+        _release_context(ctx, context)
+    return top_indices, top_scores
 
+def cy_compute_topk_postings(postings, counts, k, metric='jaccard', indices_a=None, cutoff=0, context=None):
+    '''Wrapper around compute_topk_postings
+       Same as cy_compute_topk, but with postings
+       (see cy_compute_intersection_counts_postings)'''
+    
+    cdef int i, ii
+    
+    a_offsets = np.ascontiguousarray(postings['a_offsets'], dtype=np.int64)
+    a_indices = np.ascontiguousarray(postings['a_indices'], dtype=np.int32)
+    b_offsets = np.ascontiguousarray(postings['b_offsets'], dtype=np.int64)
+    b_indices = np.ascontiguousarray(postings['b_indices'], dtype=np.int32)
+    num_items = len(a_offsets) - 1
+    counts = np.ascontiguousarray(counts, dtype=np.uint32)
+    metric_c, indices_a, top_indices, top_scores = _get_topk_setup(counts, k, metric, indices_a, num_items)
+    
+    cdef int num_a = len(indices_a)
+    cdef ExecutionContext ctx = _get_context(context)
+    cdef int num_threads = ctx.num_threads
+    cdef int num_items_c = num_items
+    cdef int metric_code = metric_c
+    cdef int k_c = k
+    cdef int cutoff_c = cutoff
+    cdef int thread_number
+    
+    # Map the numpy arrays directly to C pointers
+    cdef np.ndarray a_offsets_cn = a_offsets
+    cdef np.ndarray a_indices_cn = a_indices
+    cdef np.ndarray b_offsets_cn = b_offsets
+    cdef np.ndarray b_indices_cn = b_indices
+    cdef np.ndarray counts_cn = counts
+    cdef np.ndarray indices_a_cn = indices_a
+    cdef np.ndarray top_indices_cn = top_indices
+    cdef np.ndarray top_scores_cn = top_scores
+    cdef const INT64 * a_offsets_pointer = <const INT64 *> a_offsets_cn.data
+    cdef const INT32 * a_indices_pointer = <const INT32 *> a_indices_cn.data
+    cdef const INT64 * b_offsets_pointer = <const INT64 *> b_offsets_cn.data
+    cdef const INT32 * b_indices_pointer = <const INT32 *> b_indices_cn.data
+    cdef const UINT32 * counts_pointer = <const UINT32 *> counts_cn.data
+    cdef INT32 * indices_a_pointer = <INT32 *> indices_a_cn.data
+    cdef INT32 * top_indices_pointer = <INT32 *> top_indices_cn.data
+    cdef double * top_scores_pointer = <double *> top_scores_cn.data
+    
+    # Per-thread sparse accumulators
+    accumulator_arr = ctx.get_scratch('accumulator', (num_threads, num_items), np.uint32)
+    touched_arr = ctx.get_scratch('touched', (num_threads, num_items), np.int32)
+    cdef np.ndarray accumulator_cn = accumulator_arr
+    cdef np.ndarray touched_cn = touched_arr
+    cdef UINT32 * accumulator_pointer = <UINT32 *> accumulator_cn.data
+    cdef INT32 * touched_pointer = <INT32 *> touched_cn.data
+    
+    ctx.acquire(0)
+    try:
+        for ii in prange(num_a, nogil=True, chunksize=1, num_threads=num_threads, schedule='static'):
+            i = indices_a_pointer[ii]
+            thread_number = openmp.omp_get_thread_num()
+            compute_topk_postings(a_offsets_pointer,
+                                  a_indices_pointer,
+                                  b_offsets_pointer,
+                                  b_indices_pointer,
+                                  i,
+                                  num_items_c,
+                                  counts_pointer,
+                                  metric_code,
+                                  k_c,
+                                  accumulator_pointer + thread_number * num_items_c,
+                                  touched_pointer + thread_number * num_items_c,
+                                  top_indices_pointer + <INT64> ii * k_c,
+                                  top_scores_pointer + <INT64> ii * k_c,
+                                  cutoff_c)
+    finally:
+        _release_context(ctx, context)
+    return top_indices, top_scores
 
-def cy_mtm_stats(sba_list, chunk_length, indices_a=None, cutoff=0, start_j=0, upper_only=True):
+def cy_mtm_stats(sba_rows, chunk_length, indices_a=None, cutoff=0, start_j=0, upper_only=True):
     '''Run mtm_stats on 64-bit arrays
        Inputs:
-        * sba_list: list of sparse block arrays (python format)
+        * sba_rows: packed SBA (python format, see sparse_block_array.sba_pack)
                     compressed version of the subset of B connected to each element of A
-                    specifically, an list of dictionaries with fields 'array' and 'locs'
+                    (a list of dictionaries with fields 'array' and 'locs' also works)
         * chunk_length: sba compression parameter
         * cutoff: maximum size of intersection to keep in the output
        
@@ -329,8 +1902,8 @@ def cy_mtm_stats(sba_list, chunk_length, indices_a=None, cutoff=0, start_j=0, up
              * intersection_count: number of elements in B that the 
                                    A[i] and A[j] share in common
     '''
-    base_counts = cy_compute_counts(sba_list, chunk_length)
-    intersection_counts_list = cy_compute_intersection_counts(sba_list, chunk_length, indices_a, cutoff, start_j, upper_only)
+    base_counts = cy_compute_counts(sba_rows, chunk_length)
+    intersection_counts_list = cy_compute_intersection_counts(sba_rows, chunk_length, indices_a, cutoff, start_j, upper_only)
 
     # Return the results from the two sections
     return base_counts, intersection_counts_list
@@ -0,0 +1,201 @@
+'''Keep mtm_stats results up to date as connections get added and removed
+without recomputing everything from scratch'''
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+from .mtm_stats import (extract_indices, convert_indices_to_sba_packed,
+                        _is_array_input, _split_array_input)
+from .sparse_block_array import (sba_compress_64_index_arrays,
+                                 sba_packed_replace_rows)
+from . import cy_mtm_stats
+
+def _get_edge_keys(ia, ib):
+    '''Pack (ia, ib) index pairs into single sortable int64 keys'''
+    return (np.asarray(ia, dtype=np.int64) << 32) | np.asarray(ib, dtype=np.int64)
+
+def _split_edge_keys(keys):
+    '''Inverse of _get_edge_keys, returns ia, ib'''
+    return keys >> 32, keys & 0xffffffff
+
+class IncrementalMtmStats(object):
+    '''Holds the state needed to update mtm_stats results in place:
+       the setA/setB mappings, the sorted connections (as index pairs),
+       the packed SBA rows and the current base counts
+
+       update(added, removed) applies a batch of connection changes:
+       only the rows of A that changed get recompressed, and only their
+       intersections get recomputed (against the old and the new rows),
+       so the cost is proportional to the number of rows touched
+       instead of N_A ** 2
+       New members of A and B get appended as they show up
+       (so setA is only sorted until the first new member of A)
+
+       Only the 'sba' engine is used here, and all the updates run in
+       the same ExecutionContext (context, or a new one) so the thread
+       buffers get reused from one batch to the next
+
+       Example:
+           inc = IncrementalMtmStats(connections)
+           base_counts_dict, iu_counts_dict = inc.get_mtm_stats()
+           base_counts_delta, iu_counts_delta = inc.update(added=[('a1', 'b7')],
+                                                           removed=[('a2', 'b1')])
+       '''
+    def __init__(self, connections=(), chunk_length_64=1, cutoff=0, context=None):
+        self.chunk_length_64 = chunk_length_64
+        self.cutoff = cutoff
+        self.context = cy_mtm_stats.ExecutionContext() if context is None else context
+        if _is_array_input(connections) or len(connections):
+            setA, setB, ia, ib = extract_indices(connections)
+        else:
+            setA, setB, ia, ib = [], [], np.zeros(0, np.int64), np.zeros(0, np.int64)
+        self.setA = list(setA)
+        self.setB = list(setB)
+        self.mappingA = {p: i for i, p in enumerate(self.setA)}
+        self.mappingB = {p: i for i, p in enumerate(self.setB)}
+        self.edges = np.unique(_get_edge_keys(ia, ib))
+        ia, ib = _split_edge_keys(self.edges)
+        self.base_counts = np.bincount(ia, minlength=len(self.setA)).astype(np.uint32)
+        self.sba = convert_indices_to_sba_packed(ia, ib, len(self.setA), chunk_length_64)
+        self._rank_a = np.zeros(0, dtype=np.int64)
+
+    def _get_connection_keys(self, connections, add_members):
+        '''Map a batch of connections to edge keys
+           If add_members, new members of A and B get added to the sets,
+           otherwise connections with unknown members are dropped'''
+        if _is_array_input(connections):
+            connections = zip(*[arr.tolist() for arr in _split_array_input(connections)])
+        ia, ib = [], []
+        for a, b in connections:
+            if add_members:
+                for p, s, mapping in ((a, self.setA, self.mappingA),
+                                      (b, self.setB, self.mappingB)):
+                    if p not in mapping:
+                        mapping[p] = len(s)
+                        s.append(p)
+            elif a not in self.mappingA or b not in self.mappingB:
+                continue
+            ia.append(self.mappingA[a])
+            ib.append(self.mappingB[b])
+        return np.unique(_get_edge_keys(ia, ib))
+
+    def _get_rank_a(self):
+        '''Position of each member of A in sorted order
+           (used to orient the pairs the same way as mtm_stats)'''
+        if len(self._rank_a) != len(self.setA):
+            order = sorted(range(len(self.setA)), key=self.setA.__getitem__)
+            self._rank_a = np.empty(len(self.setA), dtype=np.int64)
+            self._rank_a[order] = np.arange(len(self.setA))
+        return self._rank_a
+
+    def _get_pair_counts(self, rows, upper_only=False):
+        '''Intersection counts of the given rows against all other rows
+           (or only the ones after them if upper_only)
+           Returns the unique pairs as sorted keys (smaller index first)
+           and their intersection counts'''
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        packed = cy_mtm_stats.cy_compute_intersection_counts(self.sba, self.chunk_length_64, rows, self.cutoff,
+                                                             upper_only=upper_only, packed_output=True,
+                                                             context=self.context)
+        intersection_counts = packed['intersection_counts']
+        i = intersection_counts['i'].astype(np.int64)
+        j = intersection_counts['j'].astype(np.int64)
+        keys, unique_indices = np.unique(_get_edge_keys(np.minimum(i, j), np.maximum(i, j)),
+                                         return_index=True)
+        return keys, intersection_counts['intersection_count'][unique_indices].astype(np.int64)
+
+    def _recompress_rows(self, rows):
+        '''Rebuild the SBA for just these rows from self.edges'''
+        starts = np.searchsorted(self.edges, _get_edge_keys(rows, 0))
+        ends = np.searchsorted(self.edges, _get_edge_keys(rows + 1, 0))
+        lengths = ends - starts
+        local_rows = np.repeat(np.arange(len(rows)), lengths)
+        edge_indices = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                        np.arange(lengths.sum()))
+        ia, ib = _split_edge_keys(self.edges[edge_indices])
+        new_rows_packed = sba_compress_64_index_arrays(local_rows, ib, len(rows), self.chunk_length_64)
+        self.sba = sba_packed_replace_rows(self.sba, rows, new_rows_packed,
+                                           self.chunk_length_64, len(self.setA))
+
+    def _get_pair_dict(self, keys, values):
+        '''Make a dictionary of {(a_i, a_j): value} from pair keys
+           with the pairs oriented the same way as mtm_stats (sorted labels)'''
+        rank_a = self._get_rank_a()
+        i, j = _split_edge_keys(keys)
+        swap = rank_a[i] > rank_a[j]
+        i, j = np.where(swap, j, i), np.where(swap, i, j)
+        return {(self.setA[ii], self.setA[jj]): v
+                for ii, jj, v in zip(i.tolist(), j.tolist(), values)}
+
+    def update(self, added=(), removed=()):
+        '''Apply a batch of changes to the connections
+           (the removals are applied before the additions)
+           
+           Returns only what changed (delta output):
+             base_counts_delta: {a: base_count} for each member of A whose count changed
+             iu_counts_delta: {(a_i, a_j): (intersection_count, union_count)}
+                              for each pair whose counts changed, or None if the
+                              pair dropped out (intersection no longer above cutoff)
+           '''
+        old_num_a = len(self.setA)
+        removed_keys = self._get_connection_keys(removed, False)
+        added_keys = self._get_connection_keys(added, True)
+        num_a = len(self.setA)
+        
+        edges = np.union1d(np.setdiff1d(self.edges, removed_keys, assume_unique=True), added_keys)
+        net_removed = np.setdiff1d(self.edges, edges, assume_unique=True)
+        net_added = np.setdiff1d(edges, self.edges, assume_unique=True)
+        affected = np.unique(np.concatenate([net_removed, net_added]) >> 32)
+        
+        # Counts before the update (only for the rows that are changing)
+        old_base_counts = np.zeros(num_a, dtype=np.int64)
+        old_base_counts[:old_num_a] = self.base_counts
+        old_keys, old_ic = self._get_pair_counts(affected[affected < old_num_a])
+        
+        # Apply the update
+        self.edges = edges
+        self.base_counts = (old_base_counts +
+                            np.bincount(net_added >> 32, minlength=num_a) -
+                            np.bincount(net_removed >> 32, minlength=num_a)).astype(np.uint32)
+        self._recompress_rows(affected)
+        new_keys, new_ic = self._get_pair_counts(affected)
+        
+        # Compare every pair that involves a changed row
+        keys = np.union1d(old_keys, new_keys)
+        in_old = np.isin(keys, old_keys, assume_unique=True)
+        in_new = np.isin(keys, new_keys, assume_unique=True)
+        ic_before = np.zeros(len(keys), dtype=np.int64)
+        ic_after = np.zeros(len(keys), dtype=np.int64)
+        ic_before[in_old] = old_ic
+        ic_after[in_new] = new_ic
+        i, j = _split_edge_keys(keys)
+        base_counts = self.base_counts.astype(np.int64)
+        uc_before = old_base_counts[i] + old_base_counts[j] - ic_before
+        uc_after = base_counts[i] + base_counts[j] - ic_after
+        changed = (in_old != in_new) | (ic_before != ic_after) | (uc_before != uc_after)
+        
+        iu_counts_delta = self._get_pair_dict(keys[changed],
+                                              [(ic, uc) if present else None
+                                               for ic, uc, present in zip(ic_after[changed].tolist(),
+                                                                          uc_after[changed].tolist(),
+                                                                          in_new[changed].tolist())])
+        counts_changed = affected[base_counts[affected] != old_base_counts[affected]]
+        base_counts_delta = {self.setA[i]: self.base_counts[i]
+                             for i in counts_changed.tolist()}
+        return base_counts_delta, iu_counts_delta
+
+    def get_mtm_stats(self):
+        '''Get the full, current results in the same format as mtm_stats
+           (members of A that lost all their connections are left out)
+           This reuses the stored SBA rows, so nothing gets re-extracted
+           or recompressed, but all the pairs do get computed'''
+        base_counts_dict = {self.setA[i]: self.base_counts[i]
+                            for i in np.flatnonzero(self.base_counts).tolist()}
+        keys, intersection_counts = self._get_pair_counts(np.arange(len(self.setA)), True)
+        i, j = _split_edge_keys(keys)
+        base_counts = self.base_counts.astype(np.int64)
+        union_counts = base_counts[i] + base_counts[j] - intersection_counts
+        iu_counts_dict = self._get_pair_dict(keys, list(zip(intersection_counts.tolist(),
+                                                            union_counts.tolist())))
+        return base_counts_dict, iu_counts_dict
@@ -0,0 +1,147 @@
+'''Save the output of _mtm_common (the labels, base counts and packed SBA
+rows) into a single versioned binary file and memory-map it back
+
+Building setA, setB and the SBA from the raw connections is by far the
+slowest part of a small indices_a query, so for repeated queries against
+the same connections the index gets built once (save_index) and every
+query just maps the file (load_index) and runs the kernel directly
+against the mapped pages (mtm_stats_raw_from_index)
+
+File layout (all integers little endian):
+  MAGIC (8 bytes)
+  FORMAT_VERSION (uint32)
+  header length (uint32)
+  header (utf-8 json): the chunk_length_64, and for each array its
+                       dtype, shape, offset and nbytes
+  the arrays, each one starting at a multiple of ALIGNMENT bytes
+Labels that are all strings or all integers are stored as fixed width
+arrays (see npy_shards.as_fixed_width_labels), any other labels get
+pickled, are the only part of the file that gets copied on load and are
+only loaded with allow_pickle=True (loading a pickle can run arbitrary code)
+'''
+from __future__ import absolute_import
+
+import json
+import struct
+import pickle
+import numpy as np
+
+from .mtm_stats import (_mtm_common, _mtm_intersection_counts,
+                        get_similarity_filter)
+from .npy_shards import as_fixed_width_labels
+
+MAGIC = b'MTMSIDX\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+INDEX_ARRAYS = ('setA', 'setB', 'base_counts', 'offsets', 'locs', 'array')
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+def write_index(path, setA, setB, base_counts, sba_packed, chunk_length_64):
+    '''Write the labels, base counts and packed SBA into an index file'''
+    arrays = {'setA': as_fixed_width_labels(setA),
+              'setB': as_fixed_width_labels(setB),
+              'base_counts': np.asarray(base_counts, dtype=np.uint32),
+              'offsets': np.asarray(sba_packed['offsets'], dtype=np.int64),
+              'locs': np.asarray(sba_packed['locs'], dtype=np.int32),
+              'array': np.asarray(sba_packed['array'], dtype=np.uint64)}
+    
+    # Lay out the arrays first, the header only needs to know where they go
+    blobs = {}
+    descriptions = {}
+    position = 0
+    for name in INDEX_ARRAYS:
+        arr = arrays[name]
+        if arr.dtype.hasobject:
+            blob = pickle.dumps(arr, protocol=2)
+            descriptions[name] = {'dtype': 'pickle'}
+        else:
+            arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+            blob = arr.tobytes()
+            descriptions[name] = {'dtype': arr.dtype.str,
+                                  'shape': list(arr.shape)}
+        descriptions[name].update({'offset': position,
+                                   'nbytes': len(blob)})
+        blobs[name] = blob
+        position = _align(position + len(blob))
+    
+    header = json.dumps({'chunk_length_64': chunk_length_64,
+                         'num_rows': len(arrays['base_counts']),
+                         'arrays': descriptions}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name in INDEX_ARRAYS:
+            f.seek(data_start + descriptions[name]['offset'])
+            f.write(blobs[name])
+        f.truncate(data_start + position)
+    return path
+
+def save_index(path, connections, chunk_length_64=1):
+    '''Build the sba rows for the connections (see _mtm_common)
+       and write them into an index file at path
+       chunk_length_64 can also be 'auto' (see plan_representation)'''
+    setA, setB, base_counts, sba_packed, plan = _mtm_common(connections, chunk_length_64, False, 'sba')
+    return write_index(path, setA, setB, base_counts, sba_packed, plan['chunk_length_64'])
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not an mtm_stats index file')
+    version, header_length = struct.unpack('<II', f.read(8))
+    if version != FORMAT_VERSION:
+        raise ValueError('unsupported index file version {} (expected {})'.format(version, FORMAT_VERSION))
+    header = json.loads(f.read(header_length).decode('utf-8'))
+    header['data_start'] = _align(len(MAGIC) + 8 + header_length)
+    return header
+
+def load_index(path, mmap_mode='r', allow_pickle=False):
+    '''Open an index file written by write_index / save_index
+       All the arrays are views into a single memory map of the file
+       (no copies, except for pickled labels), or are read into memory
+       with mmap_mode=None
+       Pickled labels raise a ValueError unless allow_pickle=True
+       (like np.load, only use it for files you trust)
+       Returns setA, setB, base_counts, sba_packed, chunk_length_64'''
+    with open(path, 'rb') as f:
+        header = _read_header(f)
+        if mmap_mode is None:
+            f.seek(0)
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+    if mmap_mode is not None:
+        buf = np.memmap(path, dtype=np.uint8, mode=mmap_mode)
+    
+    arrays = {}
+    for name in INDEX_ARRAYS:
+        description = header['arrays'][name]
+        start = header['data_start'] + description['offset']
+        blob = buf[start:start + description['nbytes']]
+        if description['dtype'] == 'pickle':
+            if not allow_pickle:
+                raise ValueError('the {} labels in {} are pickled, they can only be loaded with allow_pickle=True'.format(name, path))
+            arrays[name] = pickle.loads(blob.tobytes())
+        else:
+            arrays[name] = blob.view(np.dtype(description['dtype'])).reshape(description['shape'])
+    sba_packed = {name: arrays[name] for name in ('offsets', 'locs', 'array')}
+    return arrays['setA'], arrays['setB'], arrays['base_counts'], sba_packed, header['chunk_length_64']
+
+def mtm_stats_raw_from_index(index, indices_a=None, cutoff=0, start_j=0, upper_only=True, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None, packed_output=False, allow_pickle=False):
+    '''Same as mtm_stats_raw, but using an index file (the path,
+       or the output of load_index) instead of the raw connections
+       The kernel runs directly against the mapped arrays
+       allow_pickle is passed to load_index
+       Returns:
+           setA, setB, base_counts, intersection_counts_list
+       (or packed intersection counts with packed_output=True,
+        see _mtm_intersection_counts)'''
+    setA, setB, base_counts, sba_packed, chunk_length_64 = (load_index(index, allow_pickle=allow_pickle)
+                                                            if not isinstance(index, tuple) else
+                                                            index)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts = _mtm_intersection_counts(sba_packed, chunk_length_64, indices_a, cutoff, start_j, upper_only,
+                                                   engine='sba', packed_output=packed_output,
+                                                   similarity_filter=similarity_filter, schedule=schedule,
+                                                   stats=stats, context=context)
+    return setA, setB, base_counts, intersection_counts
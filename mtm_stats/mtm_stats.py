@@ -9,8 +9,64 @@ from future.utils import viewitems
 # python setup.py build_ext --inplace
 
 import numpy as np
-from .sparse_block_array import sba_compress_64, sba_compress_64_index_list
+from .sparse_block_array import (sba_compress_64, sba_compress_64_index_list,
+                                 sba_weights_from_index_arrays)
 from . import cy_mtm_stats
+from .cy_mtm_stats import ExecutionContext, get_default_num_threads
+from .npy_shards import NpyShardSink
+from .roaring import roaring_compress_index_arrays, get_container_stats, BITMAP_WORDS
+from .profiling import Profiler, profile_stage, get_nbytes, KERNEL_COUNTERS
+
+# The intersection engines that can be passed as "engine":
+#   'sba': compare every pair of rows of the packed SBA (default)
+#   'dense': compare every pair of dense bit rows (same as dense_input=True)
+#   'postings': walk the B -> A postings lists and only count pairs that co-occur
+#   'roaring': compare every pair of rows stored as hybrid array/bitmap/run
+#              containers (see roaring), only meant for rows made of long
+#              runs of consecutive B's (it is compact on power-law data too,
+#              but slower than 'sba' with a long chunk_length_64 there)
+#   'auto': choose between 'sba', 'postings' and 'roaring' using density statistics
+ENGINES = ('sba', 'dense', 'postings', 'roaring')
+
+# The engines that mtm_topk has a kernel for
+TOPK_ENGINES = ('sba', 'dense', 'postings')
+
+# Intersection counts together with the union counts
+# (the output of get_iu_counts_array)
+IU_COUNTS_DTYPE = [('i', np.uint32),
+                   ('j', np.uint32),
+                   ('intersection_count', np.uint32),
+                   ('union_count', np.uint32)]
+
+# IU_COUNTS_DTYPE plus the weighted intersection and union
+# (the output of get_weighted_iu_counts_array)
+WEIGHTED_IU_COUNTS_DTYPE = IU_COUNTS_DTYPE + [('min_sum', np.float64),
+                                              ('max_sum', np.float64)]
+
+# Relative cost of each pair that comes out of the postings engine
+# vs. one accumulator update (see get_work_units)
+POSTINGS_COST_FACTOR = 4.0
+
+# The chunk lengths that chunk_length_64='auto' picks from
+CHUNK_LENGTH_CANDIDATES = (1, 2, 4, 8, 16, 32)
+
+# dense_input='auto' never picks dense rows bigger than this (in bytes)
+DENSE_MAX_BYTES = 2 ** 30
+
+# The cost model used to plan with 'auto' (see get_work_units):
+#   '*_seconds_per_unit': time for one unit of work of each engine
+#   'sba_word_weight': cost of popcounting one 64-bit word of a pair of
+#                      matching SBA blocks, relative to one merge step
+#   'dense_word_weight': cost of one 64-bit word of a dense pair,
+#                        relative to the fixed cost of a pair
+# The defaults were measured with calibrate_cost_model on a single
+# core, use calibrate_cost_model(update=True) to fit them to a machine
+COST_MODEL = {'sba_seconds_per_unit': 3.3e-09,
+              'dense_seconds_per_unit': 1.1e-09,
+              'postings_seconds_per_unit': 6.0e-09,
+              'roaring_seconds_per_unit': 2.6e-09,
+              'sba_word_weight': 0.03,
+              'dense_word_weight': 0.25}
 
 def extract_sets_from_connections(connections):
     '''Get two sorted array sets from the connections tuples,
@@ -19,6 +75,93 @@ def extract_sets_from_connections(connections):
     setB = np.array(sorted({i[1] for i in connections}))
     return setA, setB
 
+def _is_array_input(connections):
+    '''Check if connections is "array-shaped", meaning either:
+         * an (N, 2) numpy array of (a, b) rows
+         * a tuple of two parallel 1d numpy arrays (a_array, b_array)'''
+    if isinstance(connections, np.ndarray):
+        return connections.ndim == 2 and connections.shape[1] == 2
+    return (isinstance(connections, tuple) and len(connections) == 2 and
+            all(isinstance(i, np.ndarray) and i.ndim == 1
+                for i in connections))
+
+def _split_array_input(connections):
+    '''Get the parallel (a_array, b_array) from array-shaped connections'''
+    if isinstance(connections, np.ndarray):
+        return connections[:, 0], connections[:, 1]
+    return connections
+
+def extract_indices_from_arrays(a_array, b_array):
+    '''Vectorized version of extract_sets_from_connections for two
+       parallel arrays of labels (or integers)
+       Returns the two sorted array sets as well as the index of every
+       connection into each of them:
+           setA, setB, ia, ib'''
+    setA, ia = np.unique(a_array, return_inverse=True)
+    setB, ib = np.unique(b_array, return_inverse=True)
+    return setA, setB, ia.ravel(), ib.ravel()
+
+def compact_ids(ids, n=None):
+    '''Map integer ids onto 0..(number of distinct ids - 1) in sorted order
+       Same result as np.unique(ids, return_inverse=True), but with a
+       lookup table of size n (max(ids) + 1 by default) instead of a sort
+       Returns the sorted distinct ids and the index of each id into them'''
+    n = int(ids.max()) + 1 if n is None and len(ids) else n or 0
+    present = np.zeros(n, dtype=bool)
+    present[ids] = True
+    remap = np.cumsum(present) - 1
+    return np.flatnonzero(present), remap[ids]
+
+def extract_indices_from_ids(a_ids, b_ids, n_a=None, n_b=None, compact=False):
+    '''Fast version of extract_indices_from_arrays for connections that are
+       already integer ids (0 <= a_ids < n_a and 0 <= b_ids < n_b)
+       Nothing gets sorted: setA and setB are just np.arange(n_a) and
+       np.arange(n_b) (n_a and n_b default to the largest id + 1)
+       and the ids are used directly as the indices,
+       unless compact, then the ids that never show up get dropped
+       (see compact_ids)
+       Returns:
+           setA, setB, ia, ib'''
+    a_ids = np.asarray(a_ids)
+    b_ids = np.asarray(b_ids)
+    if a_ids.ndim != 1 or a_ids.shape != b_ids.shape:
+        raise ValueError('a_ids and b_ids must be 1d arrays of the same length')
+    for name, ids, n in (('a_ids', a_ids, n_a), ('b_ids', b_ids, n_b)):
+        if ids.dtype.kind not in 'iu':
+            raise TypeError('{} must be an integer array, not {}'.format(name, ids.dtype))
+        if len(ids) and ids.min() < 0:
+            raise ValueError('{} can not be negative'.format(name))
+        if len(ids) and n is not None and ids.max() >= n:
+            raise ValueError('{} must be less than {}'.format(name, n))
+    
+    n_a = int(a_ids.max()) + 1 if n_a is None and len(a_ids) else n_a or 0
+    n_b = int(b_ids.max()) + 1 if n_b is None and len(b_ids) else n_b or 0
+    if compact:
+        setA, ia = compact_ids(a_ids, n_a)
+        setB, ib = compact_ids(b_ids, n_b)
+        return setA, setB, ia, ib
+    return (np.arange(n_a), np.arange(n_b),
+            a_ids.astype(np.int64, copy=False), b_ids.astype(np.int64, copy=False))
+
+def convert_indices_to_binary(ia, ib, num_a, num_b):
+    '''Vectorized version of convert_connections_to_binary
+       that takes the connections as index arrays into setA and setB'''
+    ib = np.asarray(ib, dtype=np.uint64)
+    lenB64 = int(np.ceil(num_b / 64))
+    output = np.zeros((num_a, lenB64), np.uint64)
+    np.bitwise_or.at(output,
+                     (ia, (ib // np.uint64(64)).astype(np.intp)),
+                     np.left_shift(np.uint64(1), ib % np.uint64(64)))
+    return output
+
+def convert_indices_to_sba_packed(ia, ib, num_a, chunk_length_64, context=None):
+    '''Fast version of convert_connections_to_sba_list_space_efficient
+       that takes the connections as index arrays into setA and setB
+       The rows get compressed in parallel (see cy_mtm_stats.cy_compress_index_arrays)
+       Returns a single packed SBA (see sparse_block_array.sba_pack)
+       instead of a list of per-row dictionaries'''
+    return cy_mtm_stats.cy_compress_index_arrays(ia, ib, num_a, chunk_length_64, context)
+
 def convert_connections_to_binary(connections, setA, setB):
     '''connections is a many-to-many mapping from set A to set B
        Returns a binary matrix where each item in set B gets mapped to a single bit and each item in set A gets a row of these bits'''
@@ -54,7 +197,269 @@ def convert_connections_to_sba_list_space_efficient(connections, setA, setB, chu
     
     return sba_list
 
-def _mtm_common(connections, chunk_length_64=1, dense_input=False):
+def get_connection_indices(connections, setA, setB):
+    '''Get the index of every connection into setA and setB
+       as two parallel arrays: ia, ib'''
+    mappingA = {p: i for i, p in enumerate(setA)}
+    mappingB = {p: i for i, p in enumerate(setB)}
+    
+    num_connections = len(connections)
+    ia = np.fromiter((mappingA[a] for a, b in connections), np.int64, num_connections)
+    ib = np.fromiter((mappingB[b] for a, b in connections), np.int64, num_connections)
+    return ia, ib
+
+def extract_indices(connections, profiler=None):
+    '''Get the two sorted array sets and the index of every connection
+       into each of them, for any kind of connections
+       (uses extract_indices_from_arrays for array-shaped connections)
+       profiler (see profiling.Profiler) times the 'extraction' of the sets
+       and the 'mapping' of the connections
+       Returns:
+           setA, setB, ia, ib'''
+    array_input = _is_array_input(connections)
+    with profile_stage(profiler, 'extraction') as record:
+        if array_input:
+            setA, setB, ia, ib = extract_indices_from_arrays(*_split_array_input(connections))
+        else:
+            setA, setB = extract_sets_from_connections(connections)
+        if record is not None:
+            record.update({'num_a': len(setA), 'num_b': len(setB)})
+    if not array_input:
+        with profile_stage(profiler, 'mapping') as record:
+            ia, ib = get_connection_indices(connections, setA, setB)
+            if record is not None:
+                record['bytes_allocated'] = ia.nbytes + ib.nbytes
+    return setA, setB, ia, ib
+
+def convert_connections_to_sba_packed(connections, setA, setB, chunk_length_64):
+    '''Same as convert_connections_to_sba_list_space_efficient,
+       but returns a single packed SBA (see sparse_block_array.sba_pack)
+       instead of a list of per-row dictionaries'''
+    ia, ib = get_connection_indices(connections, setA, setB)
+    return convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64)
+
+def convert_indices_to_postings(ia, ib, num_a, num_b):
+    '''Store the connections in both directions (for engine='postings')
+       Returns a dictionary of arrays:
+         a_offsets, a_indices: the sorted B's for each A (CSR),
+                               A[i] owns a_indices[a_offsets[i]:a_offsets[i+1]]
+         b_offsets, b_indices: the sorted A's for each B (postings lists),
+                               B[k] owns b_indices[b_offsets[k]:b_offsets[k+1]]'''
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+    keys = np.unique(ia * num_b + ib) # sort by (a, b) and remove duplicates
+    ia = keys // num_b
+    ib = keys % num_b
+    
+    a_offsets = np.zeros(num_a + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ia, minlength=num_a), out=a_offsets[1:])
+    b_offsets = np.zeros(num_b + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ib, minlength=num_b), out=b_offsets[1:])
+    order = np.argsort(ib, kind='stable') # A's stay sorted within each B
+    return {'a_offsets': a_offsets,
+            'a_indices': np.array(ib, dtype=np.int32),
+            'b_offsets': b_offsets,
+            'b_indices': np.array(ia[order], dtype=np.int32)}
+
+def convert_indices_to_roaring_packed(ia, ib, num_a):
+    '''Compress the connections into packed roaring rows (for engine='roaring')
+       see roaring.roaring_compress_index_arrays'''
+    return roaring_compress_index_arrays(ia, ib, num_a)
+
+def get_density_stats(ia, ib, num_a, num_b):
+    '''Density statistics of the connections (given as index arrays)
+       These are used to choose an engine with engine='auto'
+       
+       num_cooccurrences is the number of (i, j, b) triples where
+       A[i] and A[j] both connect to B[b] (the work of the postings engine)'''
+    num_connections = len(ia)
+    degrees_b = np.bincount(ib, minlength=num_b).astype(np.int64)
+    return {'num_a': num_a,
+            'num_b': num_b,
+            'num_connections': num_connections,
+            'density': num_connections / max(num_a * num_b, 1),
+            'mean_degree_a': num_connections / max(num_a, 1),
+            'mean_degree_b': num_connections / max(num_b, 1),
+            'num_cooccurrences': int((degrees_b * (degrees_b - 1)).sum() // 2)}
+
+def get_block_stats(ia, ib, num_a, num_b, chunk_lengths=CHUNK_LENGTH_CANDIDATES):
+    '''Count the non-zero SBA blocks there would be with each chunk length
+       (one sort of the connections, then one pass per chunk length)
+       Returns a dictionary of {chunk_length_64: stats} with:
+         num_blocks: the number of non-zero blocks in all the rows
+         sum_sq_blocks: sum of the squares of the blocks per row
+         blocks_per_row: average number of non-zero blocks per row
+         bits_per_block: average number of bits set in each non-zero block
+         num_columns: the number of block positions (blocks in a full row)'''
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+    order = np.argsort(ia * max(num_b, 1) + ib, kind='stable')
+    ia, ib = ia[order], ib[order]
+    new_row = np.ones(len(ia), dtype=bool)
+    new_row[1:] = ia[1:] != ia[:-1]
+    block_stats = {}
+    for chunk_length_64 in chunk_lengths:
+        block_ids = ib // (64 * chunk_length_64)
+        new_block = new_row.copy()
+        new_block[1:] |= block_ids[1:] != block_ids[:-1]
+        blocks_per_row = np.bincount(ia[new_block], minlength=num_a).astype(np.float64)
+        num_blocks = int(blocks_per_row.sum())
+        block_stats[chunk_length_64] = {'num_blocks': num_blocks,
+                                        'sum_sq_blocks': float((blocks_per_row ** 2).sum()),
+                                        'blocks_per_row': num_blocks / max(num_a, 1),
+                                        'bits_per_block': len(ia) / max(num_blocks, 1),
+                                        'num_columns': int(np.ceil(num_b / (64 * chunk_length_64)))}
+    return block_stats
+
+def get_work_units(engine, stats, chunk_length_64=1, cost_model=None):
+    '''Estimated work (in units of the cost model) to compute all the pairs
+       with an engine (and chunk length for 'sba'), using the stats from
+       get_density_stats (with the block_stats from get_block_stats)
+         * sba: every pair, one merge step for each block of both rows and
+                the words of the blocks that match (a random placement
+                of the blocks predicts how many match)
+         * dense: every pair, all the words of both rows
+         * postings: one accumulator update per co-occurrence and
+                     POSTINGS_COST_FACTOR for each pair that comes out of it
+                     (at most the number of co-occurrences or of pairs)
+         * roaring: every pair, one merge step for each container of both
+                    rows, and for the containers that match (a random
+                    placement predicts how many) their array values and runs,
+                    or their bitmap words (weighted like the sba words),
+                    this needs the container_stats (see roaring.get_container_stats)'''
+    cost_model = COST_MODEL if cost_model is None else cost_model
+    num_a = stats['num_a']
+    num_pairs = num_a * (num_a - 1) / 2
+    if engine == 'dense':
+        len_b_64 = int(np.ceil(stats['num_b'] / 64))
+        return num_pairs * (1 + cost_model['dense_word_weight'] * len_b_64)
+    if engine == 'postings':
+        num_cooccurrences = stats['num_cooccurrences']
+        return (num_cooccurrences + POSTINGS_COST_FACTOR * min(num_cooccurrences, num_pairs) +
+                stats['num_connections'])
+    if engine == 'roaring':
+        container_stats = stats['container_stats']
+        num_containers = container_stats['num_containers']
+        num_columns = max(container_stats['num_columns'], 1)
+        matching_containers = (num_containers ** 2 - container_stats['sum_sq_containers']) / 2 / num_columns
+        matching_work = (container_stats['values_x_containers'] +
+                         cost_model['sba_word_weight'] * BITMAP_WORDS * container_stats['bitmaps_x_containers']) / num_columns
+        return num_pairs + (num_a - 1) * num_containers + matching_containers + matching_work
+    block_stats = stats['block_stats'][chunk_length_64]
+    num_blocks = block_stats['num_blocks']
+    matching_blocks = ((num_blocks ** 2 - block_stats['sum_sq_blocks']) / 2 /
+                       max(block_stats['num_columns'], 1))
+    return (num_pairs + (num_a - 1) * num_blocks +
+            cost_model['sba_word_weight'] * chunk_length_64 * matching_blocks)
+
+def get_predicted_cost(engine, stats, chunk_length_64=1, cost_model=None):
+    '''Predicted time (in seconds) for all the pairs, see get_work_units'''
+    cost_model = COST_MODEL if cost_model is None else cost_model
+    return (cost_model[engine + '_seconds_per_unit'] *
+            get_work_units(engine, stats, chunk_length_64, cost_model))
+
+def plan_representation(stats, engine=None, dense_input=False, chunk_length_64=1, engines=ENGINES):
+    '''Pick the engine and chunk length with the lowest predicted cost
+       Each argument set to 'auto' is open to choose:
+         * engine='auto': 'sba' or 'postings' (and 'dense' if dense_input is 'auto',
+                          and 'roaring' if stats has the container_stats)
+         * dense_input='auto': dense rows or the SBA
+                               (dense only if it takes less than DENSE_MAX_BYTES)
+         * chunk_length_64='auto': one of CHUNK_LENGTH_CANDIDATES for 'sba'
+       stats needs the block_stats when chunk_length_64 is 'auto' or 'sba'
+       is a candidate (see get_block_stats)
+       engines limits the candidates to the engines the caller supports
+       Returns engine, chunk_length_64 and the predicted costs of all the
+       candidates as a dictionary of {(engine, chunk_length_64): seconds}
+       (chunk_length_64 is None for engines that don't use it)'''
+    chunk_lengths = (CHUNK_LENGTH_CANDIDATES
+                     if chunk_length_64 == 'auto' else
+                     (chunk_length_64,))
+    if engine == 'auto':
+        candidates = (['sba', 'postings'] +
+                      (['dense'] if dense_input == 'auto' else []) +
+                      (['roaring'] if 'container_stats' in stats else []))
+        candidates = [e for e in candidates if e in engines]
+    elif dense_input == 'auto' and engine in (None, 'sba', 'dense'):
+        candidates = ['sba', 'dense']
+    else:
+        candidates = [_choose_engine(engine, dense_input)]
+    dense_bytes = stats['num_a'] * int(np.ceil(stats['num_b'] / 64)) * 8
+    if len(candidates) > 1 and dense_bytes > DENSE_MAX_BYTES and 'dense' in candidates:
+        candidates.remove('dense')
+    
+    predicted_costs = {}
+    for e in candidates:
+        for c in (chunk_lengths if e == 'sba' else (None,)):
+            predicted_costs[(e, c)] = get_predicted_cost(e, stats, c)
+    engine, best_chunk_length = min(predicted_costs, key=predicted_costs.get)
+    chunk_length_64 = (best_chunk_length
+                       if best_chunk_length is not None else
+                       1 if chunk_length_64 == 'auto' else
+                       chunk_length_64)
+    return engine, chunk_length_64, predicted_costs
+
+def calibrate_cost_model(sizeA=400, sizeB=20000, num_connections=40000, seed=0, update=False):
+    '''Fit the seconds per unit of work of each engine in COST_MODEL
+       by timing them on a random test set (index arrays with the same
+       skewed beta distributions as testing_utils.generate_test_set)
+       The sba word weight comes from timing two chunk lengths
+       Returns the fitted cost model (and makes it the default if update)'''
+    import time
+    random_state = np.random.RandomState(seed)
+    weights_a = random_state.beta(0.2, 1, size=sizeA)
+    weights_b = random_state.beta(0.2, 1, size=sizeB)
+    connections = (random_state.choice(sizeA, num_connections, p=weights_a / weights_a.sum()),
+                   random_state.choice(sizeB, num_connections, p=weights_b / weights_b.sum()))
+    setA, setB, ia, ib = extract_indices(connections)
+    stats = get_density_stats(ia, ib, len(setA), len(setB))
+    stats['block_stats'] = get_block_stats(ia, ib, len(setA), len(setB))
+    
+    def get_time(engine, chunk_length_64):
+        setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, False, engine)
+        times = []
+        for _ in range(3):
+            t = time.time()
+            _mtm_intersection_counts(rows, chunk_length_64, engine=engine, packed_output=True)
+            times.append(time.time() - t)
+        return min(times)
+    
+    cost_model = dict(COST_MODEL)
+    
+    # sba: time = seconds_per_unit * (fixed + sba_word_weight * words)
+    # for two chunk lengths gives both parameters
+    short, long = CHUNK_LENGTH_CANDIDATES[0], CHUNK_LENGTH_CANDIDATES[-2]
+    fixed = {}
+    words = {}
+    for chunk_length_64 in (short, long):
+        fixed[chunk_length_64] = get_work_units('sba', stats, chunk_length_64, dict(cost_model, sba_word_weight=0))
+        words[chunk_length_64] = get_work_units('sba', stats, chunk_length_64, dict(cost_model, sba_word_weight=1)) - fixed[chunk_length_64]
+    ratio = get_time('sba', long) / get_time('sba', short)
+    denominator = words[long] - ratio * words[short]
+    if denominator > 0:
+        cost_model['sba_word_weight'] = max((ratio * fixed[short] - fixed[long]) / denominator, 0.0)
+    
+    stats['container_stats'] = get_container_stats(ia, ib, len(setA), len(setB))
+    for engine, chunk_length_64 in [('sba', short), ('dense', 1), ('postings', 1), ('roaring', 1)]:
+        cost_model[engine + '_seconds_per_unit'] = (get_time(engine, chunk_length_64) /
+                                                    get_work_units(engine, stats, chunk_length_64, cost_model))
+    if update:
+        COST_MODEL.update(cost_model)
+    return cost_model
+
+def _choose_engine(engine, dense_input):
+    '''Resolve the engine argument into one of ENGINES
+       (None means follow dense_input)
+       'auto' only gets resolved by plan_representation'''
+    if engine is None:
+        return 'dense' if dense_input else 'sba'
+    if engine == 'auto':
+        raise ValueError('engine="auto" has to be planned first, pass the engine from the plan of _mtm_common')
+    if engine not in ENGINES:
+        raise ValueError('engine must be one of {} or "auto", not {!r}'.format(ENGINES, engine))
+    return engine
+
+def _mtm_common(connections, chunk_length_64=1, dense_input=False, engine=None, profiler=None, context=None, engines=ENGINES):
     '''Common setup for static and partitioned-generator variants of
        mtm_stats
        There are three steps:
@@ -62,49 +467,205 @@ def _mtm_common(connections, chunk_length_64=1, dense_input=False):
          * converts the connections to binary
          * compute the base counts
        
-       Returns setA, setB, base_counts, and rows
-       "rows" will be either a 2d rows_arr (when dense_input=True)
-       or a sba_list (dense_input=False, DEFAULT)
+       Returns setA, setB, base_counts, rows and plan
+       "rows" depends on the engine (see ENGINES), it will be
+       either a 2d rows_arr (engine='dense', or dense_input=True),
+       a packed SBA (engine='sba', DEFAULT),
+       a dictionary of postings arrays (engine='postings')
+       or packed roaring rows (engine='roaring')
+       "plan" is a dictionary with the 'engine' that was chosen,
+       the 'chunk_length_64' to use with the rows and the density 'stats'
+       that were used to choose them
+       
+       Any of engine, dense_input and chunk_length_64 can be 'auto'
+       to pick the representation with the lowest predicted cost
+       (see plan_representation, 'roaring' ignores chunk_length_64), the plan then also has the
+       'predicted_cost' (in seconds) and the 'predicted_costs'
+       of all the candidates
+       
+       connections can also be "array-shaped" (an (N, 2) array or a tuple
+       of two parallel 1d arrays), in which case all the steps are vectorized
+       
+       profiler (see profiling.Profiler) times each step, default None
+       means no instrumentation
+       
+       context is the ExecutionContext the compression and the base
+       counts run in (None makes a new one for each step)
+       
+       engines limits what engine='auto' can pick from (for callers
+       that don't support all of ENGINES)
        
        This is the data needed to perform the more expensive
        intersection counts calculation and the post-process union counts'''
     
-    setA, setB = extract_sets_from_connections(connections)
+    setA, setB, ia, ib = extract_indices(connections, profiler)
+    return _mtm_common_indices(setA, setB, ia, ib, chunk_length_64, dense_input, engine, profiler, context, engines)
+
+def _mtm_common_indices(setA, setB, ia, ib, chunk_length_64=1, dense_input=False, engine=None, profiler=None, context=None, engines=ENGINES):
+    '''The part of _mtm_common after the sets are extracted
+       (the connections are already index arrays into setA and setB)'''
     
-    if dense_input:
-        rows_arr = convert_connections_to_binary(connections, setA, setB)
-        base_counts = cy_mtm_stats.cy_compute_counts_dense_input(rows_arr)
-        rows = rows_arr
-    else:
-        sba_list = convert_connections_to_sba_list_space_efficient(connections, setA, setB, chunk_length_64)
-        base_counts = cy_mtm_stats.cy_compute_counts(sba_list, chunk_length_64)
-        rows = sba_list
+    with profile_stage(profiler, 'planning') as record:
+        stats = get_density_stats(ia, ib, len(setA), len(setB))
+        plan = {}
+        if engine == 'roaring':
+            chunk_length_64 = 1 if chunk_length_64 == 'auto' else chunk_length_64
+        elif 'auto' in (engine, dense_input, chunk_length_64):
+            stats['block_stats'] = get_block_stats(ia, ib, len(setA), len(setB),
+                                                   (CHUNK_LENGTH_CANDIDATES
+                                                    if chunk_length_64 == 'auto' else
+                                                    (chunk_length_64,)))
+            if engine == 'auto' and 'roaring' in engines:
+                stats['container_stats'] = get_container_stats(ia, ib, len(setA), len(setB))
+            engine, chunk_length_64, predicted_costs = plan_representation(stats, engine, dense_input, chunk_length_64, engines)
+            plan = {'predicted_cost': predicted_costs[(engine, chunk_length_64 if engine == 'sba' else None)],
+                    'predicted_costs': predicted_costs}
+        else:
+            engine = _choose_engine(engine, dense_input)
+        if record is not None:
+            record.update({'engine': engine,
+                           'chunk_length_64': chunk_length_64,
+                           'num_connections': stats['num_connections']})
+    
+    with profile_stage(profiler, 'compression') as record:
+        if engine == 'dense':
+            rows = convert_indices_to_binary(ia, ib, len(setA), len(setB))
+        elif engine == 'postings':
+            rows = convert_indices_to_postings(ia, ib, len(setA), len(setB))
+        elif engine == 'roaring':
+            rows = convert_indices_to_roaring_packed(ia, ib, len(setA))
+        else:
+            rows = convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64, context)
+        if record is not None:
+            record.update({'engine': engine,
+                           'bytes_allocated': get_nbytes(rows)})
     
-    return setA, setB, base_counts, rows
+    with profile_stage(profiler, 'base_counts'):
+        if engine == 'dense':
+            base_counts = cy_mtm_stats.cy_compute_counts_dense_input(rows, context)
+        elif engine == 'postings':
+            base_counts = np.diff(rows['a_offsets']).astype(np.uint32)
+        elif engine == 'roaring':
+            unique_ia = np.unique(np.asarray(ia, dtype=np.int64) * max(len(setB), 1) + ib) // max(len(setB), 1)
+            base_counts = np.bincount(unique_ia, minlength=len(setA)).astype(np.uint32)
+        else:
+            base_counts = cy_mtm_stats.cy_compute_counts(rows, chunk_length_64, context)
+    
+    plan.update({'engine': engine,
+                 'chunk_length_64': chunk_length_64,
+                 'stats': stats})
+    return setA, setB, base_counts, rows, plan
+
+def get_similarity_filter(base_counts, min_jaccard=None, min_cosine=None, min_overlap=None):
+    '''Build the similarity filter for _mtm_intersection_counts
+       (or None if there are no thresholds)
+       The thresholds (between 0 and 1) are:
+         min_jaccard: intersection / union
+         min_cosine: intersection / sqrt(count_i * count_j)
+         min_overlap: intersection / min(count_i, count_j)
+       Since the intersection can't be larger than the smaller count,
+       the kernels skip every pair whose counts are too different
+       to pass (the rows get sorted by base_counts for this)'''
+    thresholds = {'min_jaccard': min_jaccard,
+                  'min_cosine': min_cosine,
+                  'min_overlap': min_overlap}
+    if all(t is None for t in thresholds.values()):
+        return None
+    for name, t in thresholds.items():
+        if t is not None and not 0 <= t <= 1:
+            raise ValueError('{} must be between 0 and 1, not {!r}'.format(name, t))
+    similarity_filter = {'counts': base_counts,
+                         'sorted_rows': np.argsort(base_counts, kind='stable').astype(np.int32)}
+    similarity_filter.update(thresholds)
+    return similarity_filter
 
-def _mtm_intersection_counts(rows, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def _mtm_intersection_counts(rows, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, packed_output=False, similarity_filter=None, end_j=None, schedule=None, stats=None, context=None, profiler=None):
     '''The function that actually calls into cython for the intersection_counts
-       Return the intersection_counts_list'''
+       engine is the engine from the plan returned by _mtm_common
+       (None means follow dense_input)
+       Return the intersection_counts_list, or with packed_output=True,
+       a dictionary with a single 'intersection_counts' structured array
+       and the row 'offsets' into it (cheaper, no per-row arrays),
+       see cy_mtm_stats.unpack_intersection_counts
+       similarity_filter (from get_similarity_filter) leaves out the pairs
+       below a jaccard/cosine/overlap threshold without computing them
+       end_j limits the comparisons to j < end_j (with start_j, this
+       picks a rectangular tile of the pair space, see sharding)
+       schedule picks how the rows get spread over the threads and
+       stats (a dictionary) gets filled with the busy time of each thread,
+       see cy_mtm_stats.SCHEDULES and cy_mtm_stats._fill_stats
+       context is the ExecutionContext to run in (None makes a new one)
+       profiler (see profiling.Profiler) records the 'intersections' stage
+       with the kernel counters (see profiling.KERNEL_COUNTERS)
+       Pass everything after upper_only by keyword, the order of these
+       options is not part of the interface'''
+    
+    engine = _choose_engine(engine, dense_input)
+    if profiler is None:
+        return _run_intersection_counts(rows, chunk_length_64, indices_a, cutoff, start_j, upper_only, engine,
+                                        packed_output=packed_output, similarity_filter=similarity_filter,
+                                        end_j=end_j, schedule=schedule, stats=stats, context=context)
     
-    if dense_input:
+    kernel_stats = {} if stats is None else stats
+    with profiler.stage('intersections') as record:
+        intersection_counts = _run_intersection_counts(rows, chunk_length_64, indices_a, cutoff, start_j, upper_only, engine,
+                                                       packed_output=packed_output, similarity_filter=similarity_filter,
+                                                       end_j=end_j, schedule=schedule, stats=kernel_stats, context=context)
+    record.update({name: kernel_stats[name] for name in KERNEL_COUNTERS if name in kernel_stats})
+    record.update({'engine': engine,
+                   'thread_time': list(kernel_stats.get('busy_time', [])),
+                   'bytes_allocated': kernel_stats.get('buffer_bytes', 0) + kernel_stats.get('output_bytes', 0)})
+    return intersection_counts
+
+def _run_intersection_counts(rows, chunk_length_64, indices_a, cutoff, start_j, upper_only, engine, **kwds):
+    '''Call the cython wrapper of the engine (see _mtm_intersection_counts)
+       kwds (packed_output, similarity_filter, end_j, schedule, stats
+       and context) get passed on by keyword'''
+    if engine == 'dense':
         rows_arr = rows
-        intersection_counts_list = cy_mtm_stats.cy_compute_intersection_counts_dense_input(rows_arr, indices_a, cutoff, start_j, upper_only)
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts_dense_input(rows_arr, indices_a, cutoff, start_j, upper_only, **kwds)
+    elif engine == 'postings':
+        postings = rows
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts_postings(postings, indices_a, cutoff, start_j, upper_only, **kwds)
+    elif engine == 'roaring':
+        roaring_packed = rows
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts_roaring(roaring_packed, indices_a, cutoff, start_j, upper_only, **kwds)
     else:
-        sba_list = rows
-        intersection_counts_list = cy_mtm_stats.cy_compute_intersection_counts(sba_list, chunk_length_64, indices_a, cutoff, start_j, upper_only)
+        sba_packed = rows
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts(sba_packed, chunk_length_64, indices_a, cutoff, start_j, upper_only, **kwds)
     
-    return intersection_counts_list
+    return intersection_counts
 
-def mtm_stats_raw(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def mtm_stats_raw(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None, profiler=None):
     '''The function that actually calls into cython
        Produces the sets from the connections,
        converts the connection to binary and compresses them into sba's
        and then performs the actual counts
+       engine selects how the intersections are computed (see ENGINES),
+       the default (None) uses 'dense' if dense_input else 'sba'
+       engine, dense_input and chunk_length_64 can also be 'auto' to pick
+       them with the cost model (see plan_representation)
+       min_jaccard, min_cosine and min_overlap drop the pairs below
+       those similarities inside the kernels (see get_similarity_filter)
+       schedule picks how the rows get spread over the threads (see
+       cy_mtm_stats.SCHEDULES, the default splits up the heaviest rows)
+       and stats (a dictionary) gets filled with the busy time of each thread
+       and the 'plan' from _mtm_common (with the predicted cost when
+       engine, dense_input or chunk_length_64 is 'auto')
+       context is an ExecutionContext that sets the number of threads
+       (and keeps the buffers around for the next call)
+       profiler (a profiling.Profiler) records the time and counters
+       of each stage, default None means no instrumentation
        Returns:
            setA, setB, base_counts, intersection_counts_list'''
     
-    setA, setB, base_counts, rows = _mtm_common(connections, chunk_length_64, dense_input)
-    intersection_counts_list = _mtm_intersection_counts(rows, chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input)
+    setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, dense_input, engine, profiler, context)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts_list = _mtm_intersection_counts(rows, plan['chunk_length_64'], indices_a, cutoff, start_j, upper_only,
+                                                        engine=plan['engine'], similarity_filter=similarity_filter,
+                                                        schedule=schedule, stats=stats, context=context, profiler=profiler)
+    if stats is not None:
+        stats['plan'] = plan
     return setA, setB, base_counts, intersection_counts_list
 
 def _partition_range(x, n):
@@ -117,18 +678,65 @@ def _partition_range(x, n):
        '''
     return (range(i, min(x, i+n)) for i in range(0, x, n))
 
-def mtm_stats_raw_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def mtm_stats_raw_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
     '''This version of mtm_stats returns a generator instead of doing the
        actual intersection_counts calculation
        Each 
        Returns:
-           setA, setB, base_counts, intersection_counts_generator'''
+           setA, setB, base_counts, intersection_counts_generator
+       
+       All the partitions run in the same ExecutionContext (context, or
+       a new one), so they reuse the same thread buffers
+       (see _iter_intersection_counts)'''
     
-    setA, setB, base_counts, rows = _mtm_common(connections, chunk_length_64, dense_input)
-    intersection_counts_generator = (_mtm_intersection_counts(rows, chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input)
-                                     for indices_a in _partition_range(len(rows), partition_size))
+    setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, dense_input, engine, context=context)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts_generator = _iter_intersection_counts(rows, plan, len(base_counts), partition_size, cutoff, start_j, upper_only, dense_input, False, similarity_filter, context)
     return setA, setB, base_counts, intersection_counts_generator
 
+def mtm_stats_to_sink(connections, sink, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
+    '''Same as mtm_stats_raw_iterator, but the results get written to
+       a sink (like npy_shards.NpyShardSink) one partition at a time
+       as arrays (see _write_to_sink) instead of being returned
+       Returns the result of sink.close()'''
+    
+    setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, dense_input, engine, context=context)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts_generator = _iter_intersection_counts(rows, plan, len(base_counts), partition_size, cutoff, start_j, upper_only, dense_input, True, similarity_filter, context)
+    try:
+        return _write_to_sink(sink, setA, base_counts, intersection_counts_generator)
+    finally:
+        intersection_counts_generator.close()
+
+def _iter_intersection_counts(rows, plan, num_items, partition_size, cutoff, start_j, upper_only, dense_input, packed_output, similarity_filter, context):
+    '''Generator of the intersection counts of each partition of the rows
+       (see mtm_stats_raw_iterator)
+       If context is None, a new ExecutionContext gets made for all the
+       partitions and closed as soon as the generator is exhausted or closed'''
+    owned_context = ExecutionContext() if context is None else None
+    context = context if owned_context is None else owned_context
+    try:
+        for indices_a in _partition_range(num_items, partition_size):
+            yield _mtm_intersection_counts(rows, plan['chunk_length_64'], indices_a, cutoff, start_j, upper_only,
+                                           engine=plan['engine'], packed_output=packed_output, similarity_filter=similarity_filter, context=context)
+    finally:
+        if owned_context is not None:
+            owned_context.close()
+
+def _write_to_sink(sink, setA, base_counts, intersection_counts_iterator):
+    '''Write the labels and base counts to a sink and then
+       each partition as a single IU_COUNTS_DTYPE array
+       (see get_iu_counts_array), no python tuples get created
+       A sink needs the methods:
+         write_labels(setA, base_counts)
+         write_partition(iu_counts_arr)
+         close()
+       Returns the result of sink.close()'''
+    sink.write_labels(setA, base_counts)
+    for intersection_counts in intersection_counts_iterator:
+        sink.write_partition(get_iu_counts_array(base_counts, intersection_counts))
+    return sink.close()
+
 def get_base_counts_dict(base_counts, setA):
     return {setA[i]: p
             for i, p in enumerate(base_counts)}
@@ -138,6 +746,44 @@ def get_iu_counts_dict(base_counts, intersection_counts_list, setA):
             for intersection_counts in intersection_counts_list
             for i, j, ic in intersection_counts}
 
+def get_iu_counts_array(base_counts, intersection_counts_list):
+    '''Vectorized alternative to get_iu_counts_dict
+       Returns a single structured array (IU_COUNTS_DTYPE) with the fields
+       i, j, intersection_count and union_count
+       (i and j are indices into setA)
+       intersection_counts_list can also be packed intersection counts
+       (see _mtm_intersection_counts)'''
+    intersection_counts = _concatenate_intersection_counts(intersection_counts_list)
+    base_counts = np.asarray(base_counts, dtype=np.uint32)
+    iu_counts = np.empty(len(intersection_counts), dtype=IU_COUNTS_DTYPE)
+    iu_counts['i'] = intersection_counts['i']
+    iu_counts['j'] = intersection_counts['j']
+    iu_counts['intersection_count'] = intersection_counts['intersection_count']
+    iu_counts['union_count'] = (base_counts[intersection_counts['i']] +
+                                base_counts[intersection_counts['j']] -
+                                intersection_counts['intersection_count'])
+    return iu_counts
+
+def _concatenate_intersection_counts(intersection_counts_list):
+    '''A single INTERSECTION_COUNTS_DTYPE array out of an intersection_counts_list
+       or packed intersection counts'''
+    if isinstance(intersection_counts_list, dict):
+        return intersection_counts_list['intersection_counts']
+    elif len(intersection_counts_list):
+        return np.concatenate(intersection_counts_list)
+    return np.zeros(0, dtype=cy_mtm_stats.INTERSECTION_COUNTS_DTYPE)
+
+def get_pair_metrics_array(base_counts, intersection_counts_list, metrics=('union_count',), num_b=None, float_dtype=np.float32, context=None):
+    '''Like get_iu_counts_array, but with any of the derived set statistics
+       in cy_mtm_stats.PAIR_METRICS (unions, differences, jaccard, cosine,
+       overlap, dice, lift and pmi) computed in C in a single pass
+       num_b (len(setB)) is only needed for 'lift' and 'pmi'
+       Returns a single structured array with the fields i, j,
+       intersection_count and then each metric (uint32 for the counts
+       and float_dtype for the ratios, see cy_mtm_stats.get_pair_metrics_dtype)'''
+    intersection_counts = _concatenate_intersection_counts(intersection_counts_list)
+    return cy_mtm_stats.cy_compute_pair_metrics(intersection_counts, base_counts, metrics, num_b, float_dtype, context)
+
 def get_base_counts_gen(base_counts, setA):
     return ((setA[i], p)                         # (key, value)
             for i, p in enumerate(base_counts))
@@ -147,14 +793,75 @@ def get_iu_counts_gen(base_counts, intersection_counts_list, setA):
             for intersection_counts in intersection_counts_list
             for i, j, ic in intersection_counts)
 
-def mtm_stats(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def mtm_stats(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None, profiler=None):
     '''Get base counts and intersection counts'''
-    setA, setB, base_counts, intersection_counts_list = mtm_stats_raw(connections, chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input)
-    base_counts_dict = get_base_counts_dict(base_counts, setA)
-    iu_counts_dict = get_iu_counts_dict(base_counts, intersection_counts_list, setA)
+    setA, setB, base_counts, intersection_counts_list = mtm_stats_raw(connections, chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap, schedule, stats, context, profiler)
+    with profile_stage(profiler, 'output') as record:
+        base_counts_dict = get_base_counts_dict(base_counts, setA)
+        iu_counts_dict = get_iu_counts_dict(base_counts, intersection_counts_list, setA)
+        if record is not None:
+            record['num_pairs'] = len(iu_counts_dict)
     return base_counts_dict, iu_counts_dict
 
-def mtm_stats_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def mtm_stats_from_ids(a_ids, b_ids, n_a=None, n_b=None, compact=False, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None, profiler=None):
+    '''Fast path of mtm_stats for connections that are already integer ids:
+       two parallel integer arrays a_ids and b_ids (see extract_indices_from_ids)
+       No labels get sorted or mapped and no dicts or tuples get built,
+       the rest of the arguments work the same as in mtm_stats_raw
+       (with compact, indices_a are indices into the compacted setA)
+       Returns:
+           setA, base_counts, iu_counts_arr
+       where setA is the id of each row (np.arange(n_a) unless compact)
+       and iu_counts_arr is a single IU_COUNTS_DTYPE array whose
+       i and j index into setA (see get_iu_counts_array)'''
+    
+    with profile_stage(profiler, 'extraction'):
+        setA, setB, ia, ib = extract_indices_from_ids(a_ids, b_ids, n_a, n_b, compact)
+    base_counts, rows, plan = _mtm_common_indices(setA, setB, ia, ib, chunk_length_64, dense_input, engine, profiler, context)[2:]
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts = _mtm_intersection_counts(rows, plan['chunk_length_64'], indices_a, cutoff, start_j, upper_only,
+                                                   engine=plan['engine'], packed_output=True, similarity_filter=similarity_filter,
+                                                   schedule=schedule, stats=stats, context=context, profiler=profiler)
+    if stats is not None:
+        stats['plan'] = plan
+    with profile_stage(profiler, 'output') as record:
+        iu_counts_arr = get_iu_counts_array(base_counts, intersection_counts)
+        if record is not None:
+            record.update({'num_pairs': len(iu_counts_arr),
+                           'bytes_allocated': iu_counts_arr.nbytes})
+    return setA, base_counts, iu_counts_arr
+
+def mtm_stats_metrics(connections, metrics=('union_count', 'jaccard'), chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, float_dtype=np.float32, schedule=None, stats=None, context=None, profiler=None):
+    '''Get base counts and any of the derived set statistics of each pair
+       (see cy_mtm_stats.PAIR_METRICS) without building any python tuples,
+       the rest of the arguments work the same as in mtm_stats_raw
+       Returns:
+           setA, setB, base_counts, metrics_arr
+       where metrics_arr is a single structured array with the fields i, j
+       (indices into setA), intersection_count and then each metric
+       (see get_pair_metrics_array)'''
+    
+    setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, dense_input, engine, profiler, context)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts = _mtm_intersection_counts(rows, plan['chunk_length_64'], indices_a, cutoff, start_j, upper_only,
+                                                   engine=plan['engine'], packed_output=True, similarity_filter=similarity_filter,
+                                                   schedule=schedule, stats=stats, context=context, profiler=profiler)
+    if stats is not None:
+        stats['plan'] = plan
+    with profile_stage(profiler, 'output') as record:
+        metrics_arr = get_pair_metrics_array(base_counts, intersection_counts, metrics, len(setB), float_dtype, context)
+        if record is not None:
+            record.update({'num_pairs': len(metrics_arr),
+                           'bytes_allocated': metrics_arr.nbytes})
+    return setA, setB, base_counts, metrics_arr
+
+def get_pair_metrics_dict(setA, metrics_arr, metric):
+    '''Convert one column of the output of mtm_stats_metrics to
+       a dictionary of {(a_i, a_j): value}'''
+    return dict(zip(zip(setA[metrics_arr['i']].tolist(), setA[metrics_arr['j']].tolist()),
+                    metrics_arr[metric].tolist()))
+
+def mtm_stats_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
     '''Like mtm_stats, but returns generators instead of dicts for performance
        Returns:
          base_counts_generator:
@@ -171,9 +878,12 @@ def mtm_stats_iterator(connections, partition_size, chunk_length_64=1, cutoff=0,
        for iu_counts_gen in iu_counts_double_generator:
            for item_i, item_j, ic, uc in iu_counts_gen:
                print("{} and {} have {} things in common and {} things in total from set B".format(item_i, item_j, ic, uc))
+       
+       To write the results to a sink (like npy_shards.NpyShardSink)
+       as arrays instead, see mtm_stats_to_sink
        '''
     
-    setA, setB, base_counts, intersection_counts_iterator = mtm_stats_raw_iterator(connections, partition_size, chunk_length_64, cutoff, start_j, upper_only, dense_input)
+    setA, setB, base_counts, intersection_counts_iterator = mtm_stats_raw_iterator(connections, partition_size, chunk_length_64, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap, context)
     base_counts_generator = get_base_counts_gen(base_counts, setA)
     
     iu_counts_double_generator = (get_iu_counts_gen(base_counts, intersection_counts_list, setA)
@@ -181,26 +891,168 @@ def mtm_stats_iterator(connections, partition_size, chunk_length_64=1, cutoff=0,
     
     return base_counts_generator, iu_counts_double_generator
 
+def mtm_stats_to_npy_shards(connections, output_dir, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
+    '''Run mtm_stats_to_sink and write the results into output_dir as
+       .npy files (one shard per partition, see npy_shards.NpyShardSink)
+       Read them back (memory-mapped) with npy_shards.load_npy_shards
+       Returns the list of shard paths'''
+    sink = NpyShardSink(output_dir)
+    return mtm_stats_to_sink(connections, sink, partition_size, chunk_length_64, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap, context)
+
+def mtm_topk(connections, k, metric='jaccard', chunk_length_64=1, indices_a=None, cutoff=0, dense_input=False, engine=None, context=None):
+    '''Find the k nearest neighbours in A of each member of A
+       without materializing all the pairs (the output is linear in A)
+       Each row keeps a bounded heap of its best results in C
+       metric is either 'jaccard' or 'intersection'
+       indices_a picks which rows get searched (all rows by default)
+       Only pairs with an intersection larger than cutoff are considered
+       engine and context work the same as in mtm_stats_raw
+       (except there is no 'roaring' top-k, so 'auto' never picks it)
+       
+       Returns:
+           setA, top_indices, top_scores
+       two (len(indices_a), k) arrays with indices into setA (int32)
+       and the scores (float64), sorted best first (ties by index)
+       Rows with fewer than k neighbours are padded with -1 and 0'''
+    
+    if engine == 'roaring':
+        raise ValueError('engine="roaring" is not supported by mtm_topk')
+    setA, setB, base_counts, rows, plan = _mtm_common(connections, chunk_length_64, dense_input, engine, context=context,
+                                                      engines=TOPK_ENGINES)
+    if plan['engine'] == 'dense':
+        top_indices, top_scores = cy_mtm_stats.cy_compute_topk_dense_input(rows, base_counts, k, metric, indices_a, cutoff, context)
+    elif plan['engine'] == 'postings':
+        top_indices, top_scores = cy_mtm_stats.cy_compute_topk_postings(rows, base_counts, k, metric, indices_a, cutoff, context)
+    else:
+        top_indices, top_scores = cy_mtm_stats.cy_compute_topk(rows, plan['chunk_length_64'], base_counts, k, metric, indices_a, cutoff, context)
+    return setA, top_indices, top_scores
+
+def get_topk_dict(setA, top_indices, top_scores, indices_a=None):
+    '''Convert the output of mtm_topk to a dictionary of
+       {a: [(neighbour, score), ...]} (best first)'''
+    indices_a = range(len(setA)) if indices_a is None else indices_a
+    return {setA[i]: [(setA[j], score)
+                      for j, score in zip(row_indices, row_scores)
+                      if j >= 0]
+            for i, row_indices, row_scores in zip(indices_a, top_indices, top_scores)}
+
 def get_Jaccard_index_from_sparse_connections(iu_counts_dict):
     return {k: ic / uc
             for k, (ic, uc) in viewitems(iu_counts_dict)}
 
-def get_Jaccard_index(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False):
-    base_counts_dict, iu_counts_dict = mtm_stats(connections, chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input)
-    jaccard_index = get_Jaccard_index_from_sparse_connections(iu_counts_dict)
-    return base_counts_dict, jaccard_index
+def get_similarity_index(connections, metric='jaccard', chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
+    '''Get base counts and one metric of each pair (any of
+       cy_mtm_stats.PAIR_METRICS, in float64) as dictionaries
+       The metric is computed in C in the same pass that builds the
+       output array (see mtm_stats_metrics)'''
+    setA, setB, base_counts, metrics_arr = mtm_stats_metrics(connections, (metric,), chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap,
+                                                             float_dtype=np.float64, context=context)
+    return (get_base_counts_dict(base_counts, setA),
+            get_pair_metrics_dict(setA, metrics_arr, metric))
 
-def mtm_stats_from_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False):
+def get_Jaccard_index(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
+    '''Get base counts and the Jaccard index of each pair
+       With min_jaccard, the pairs below it are never computed'''
+    return get_similarity_index(connections, 'jaccard', chunk_length_64, indices_a, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap, context)
+
+def mtm_stats_from_iterator(connections, partition_size, chunk_length_64=1, cutoff=0, start_j=0, upper_only=True, dense_input=False, engine=None, min_jaccard=None, min_cosine=None, min_overlap=None, context=None):
     '''Same results as regular mtm_stats, but uses mtm_stats_iterator instead
        Mostly useful for testing, although it is not actually that different
        (faster or slower) than the original, so should probably just refactor to always do things this way'''
-    base_counts_generator, iu_counts_double_generator = mtm_stats_iterator(connections, partition_size, chunk_length_64, cutoff, start_j, upper_only, dense_input)
+    base_counts_generator, iu_counts_double_generator = mtm_stats_iterator(connections, partition_size, chunk_length_64, cutoff, start_j, upper_only, dense_input, engine, min_jaccard, min_cosine, min_overlap, context)
     base_counts_dict = dict(base_counts_generator)
     iu_counts_dict = {(i, j): (ic, uc)
                       for iu_counts_generator in iu_counts_double_generator
                       for i, j, ic, uc in iu_counts_generator}
     return base_counts_dict, iu_counts_dict
 
+def _split_weighted_connections(connections):
+    '''Split weighted connections into (a, b) connections and the weights
+       The weighted connections can be (a, b, weight) tuples, an (N, 3)
+       array or a tuple of three parallel 1d arrays (a_array, b_array, weights)
+       Returns connections, weights'''
+    if isinstance(connections, np.ndarray) and connections.ndim == 2 and connections.shape[1] == 3:
+        connections, weights = (connections[:, 0], connections[:, 1]), connections[:, 2]
+    elif (isinstance(connections, tuple) and len(connections) == 3 and
+          all(isinstance(i, np.ndarray) and i.ndim == 1 for i in connections)):
+        connections, weights = connections[:2], connections[2]
+    else:
+        weights = [w for a, b, w in connections]
+        connections = [(a, b) for a, b, w in connections]
+    weights = np.asarray(weights, dtype=np.float64)
+    if not np.all(np.isfinite(weights) & (weights >= 0)):
+        raise ValueError('the weights must be finite and non-negative')
+    return connections, weights
+
+def get_weighted_iu_counts_array(base_counts, row_weights, intersection_counts, min_sums):
+    '''Same as get_iu_counts_array, plus the weighted intersection (min_sum,
+       the sum of min(w_i, w_j) over the common B's) and the weighted union
+       (max_sum, the sum of max(w_i, w_j) over all the B's of either row,
+       which is row_weights[i] + row_weights[j] - min_sum)
+       Returns a WEIGHTED_IU_COUNTS_DTYPE array'''
+    iu_counts = get_iu_counts_array(base_counts, intersection_counts)
+    weighted_iu_counts = np.empty(len(iu_counts), dtype=WEIGHTED_IU_COUNTS_DTYPE)
+    for name in iu_counts.dtype.names:
+        weighted_iu_counts[name] = iu_counts[name]
+    weighted_iu_counts['min_sum'] = min_sums
+    weighted_iu_counts['max_sum'] = (row_weights[iu_counts['i']] + row_weights[iu_counts['j']] -
+                                     min_sums)
+    return weighted_iu_counts
+
+def mtm_stats_weighted_raw(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, schedule=None, stats=None, context=None):
+    '''mtm_stats_raw for weighted (multiset) connections, see _split_weighted_connections
+       Repeated connections get their weights added up
+       The pairs are found (and pruned with cutoff, on the number of common
+       B's) by the sba engine, and then compute_min_sums adds up the
+       weights of the common B's of each pair that is left
+       Returns:
+           setA, setB, base_counts, row_weights, weighted_iu_counts
+       where row_weights is the total weight of each row and
+       weighted_iu_counts is a WEIGHTED_IU_COUNTS_DTYPE array'''
+    
+    connections, weights = _split_weighted_connections(connections)
+    setA, setB, ia, ib = extract_indices(connections)
+    
+    owned_context = ExecutionContext() if context is None else None
+    context = context if owned_context is None else owned_context
+    try:
+        sba_packed = convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64, context)
+        sba_weights = sba_weights_from_index_arrays(ia, ib, weights, len(setA), chunk_length_64)
+        base_counts = cy_mtm_stats.cy_compute_counts(sba_packed, chunk_length_64, context)
+        intersection_counts = _mtm_intersection_counts(sba_packed, chunk_length_64, indices_a, cutoff, start_j, upper_only,
+                                                       engine='sba', packed_output=True, schedule=schedule,
+                                                       stats=stats, context=context)
+        min_sums = cy_mtm_stats.cy_compute_min_sums(sba_packed, chunk_length_64, sba_weights, intersection_counts, context)
+    finally:
+        if owned_context is not None:
+            owned_context.close()
+    weighted_iu_counts = get_weighted_iu_counts_array(base_counts, sba_weights['row_weights'], intersection_counts, min_sums)
+    return setA, setB, base_counts, sba_weights['row_weights'], weighted_iu_counts
+
+def mtm_stats_weighted(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, schedule=None, stats=None, context=None):
+    '''Get the total weight of each member of A and the weighted intersection
+       and union of each pair (see mtm_stats_weighted_raw)
+       Returns:
+           base_weights_dict: {a: total_weight}
+           weighted_iu_dict: {(a_i, a_j): (min_sum, max_sum)}'''
+    setA, setB, base_counts, row_weights, weighted_iu_counts = mtm_stats_weighted_raw(connections, chunk_length_64, indices_a, cutoff, start_j, upper_only, schedule, stats, context)
+    base_weights_dict = get_base_counts_dict(row_weights.tolist(), setA)
+    weighted_iu_dict = {(setA[i], setA[j]): (min_sum, max_sum)
+                        for i, j, min_sum, max_sum in zip(weighted_iu_counts['i'].tolist(),
+                                                          weighted_iu_counts['j'].tolist(),
+                                                          weighted_iu_counts['min_sum'].tolist(),
+                                                          weighted_iu_counts['max_sum'].tolist())}
+    return base_weights_dict, weighted_iu_dict
+
+def get_weighted_Jaccard_index(connections, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, context=None):
+    '''Get the total weights and the weighted Jaccard index
+       (sum of min / sum of max) of each pair of weighted connections
+       Pairs whose common B's all have a weight of 0 get 0.0'''
+    base_weights_dict, weighted_iu_dict = mtm_stats_weighted(connections, chunk_length_64, indices_a, cutoff, start_j, upper_only, context=context)
+    weighted_jaccard_index = {k: min_sum / max_sum if max_sum > 0 else 0.0
+                              for k, (min_sum, max_sum) in viewitems(weighted_iu_dict)}
+    return base_weights_dict, weighted_jaccard_index
+
 if __name__ == '__main__':
     r = mtm_stats([('a1', 'b1'),
                    ('a1', 'b2'),
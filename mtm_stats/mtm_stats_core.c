@@ -1,5 +1,22 @@
+#define _GNU_SOURCE // for sched_setaffinity
 #include <stdbool.h>
+#include <stdlib.h>
+#include <math.h>
+#include <string.h>
+#ifdef __linux__
+#include <sched.h>
+#endif
 #include "mtm_stats_core.h"
+#include "popcount_simd.h"
+
+// Build the kernels below twice (with and without the POPCNT instruction)
+// and let the loader pick one, so short blocks also get a fast popcount
+// Long arrays are sent to the vectorized kernels in popcount_simd.c
+#if defined(__GNUC__) && defined(__x86_64__) && defined(__GLIBC__)
+#define KERNEL_CLONES __attribute__((target_clones("popcnt", "default")))
+#else
+#define KERNEL_CLONES
+#endif
 
 // Create defines to make code easier to read below
 // DAT_X automatically gets a pointer to the i_x'th chunk of dat_x
@@ -11,6 +28,7 @@ static UINT32 bit_sum(CONSTANT UINT64* bit_array,
 //Given a 64-bit array, sum all the individual to corresponding binary and sum.
     int i;
     UINT32 sum = 0;
+    if(length >= SIMD_MIN_LENGTH) { return popcount_array(bit_array, length); }
     for(i = 0; i < length; i++)
         sum += POPCOUNT(bit_array[i]);
     return sum;
@@ -22,6 +40,7 @@ static UINT32 bit_sum_or(CONSTANT UINT64* a_array,
 // Sum the bitwise OR for each item
     int i;
     UINT32 sum = 0;
+    if(length >= SIMD_MIN_LENGTH) { return popcount_or_array(a_array, b_array, length); }
     for(i = 0; i < length; i++) {
         sum += POPCOUNT(a_array[i] | b_array[i]);
     }
@@ -34,6 +53,7 @@ static UINT32 bit_sum_and(CONSTANT UINT64* a_array,
 // Sum the bitwise AND for each item
     int i;
     UINT32 sum = 0;
+    if(length >= SIMD_MIN_LENGTH) { return popcount_and_array(a_array, b_array, length); }
     for(i = 0; i < length; i++) {
         sum += POPCOUNT(a_array[i] & b_array[i]);
     }
@@ -104,6 +124,107 @@ static UINT32 sparse_bit_sum_and(SparseBlockArray a,
     return sum;
 }
 
+////////////////////////////////////////////////////////////////////////
+// Similarity thresholds (see SimilarityFilter)
+// The intersection can't be larger than the smaller of the two rows,
+// so each threshold bounds how different the counts of a pair can be
+// (length filtering, as in all-pairs similarity search)
+////////////////////////////////////////////////////////////////////////
+
+// Relative slack on the thresholds when picking the range of rows to visit
+// (each pair still gets the exact check, this keeps rounding from
+//  moving the edges of the range)
+#define SIMILARITY_WINDOW_SLACK 1e-9
+
+static bool passes_similarity_filter(CONSTANT SimilarityFilter * similarity_filter,
+                                     UINT32 count_i,
+                                     UINT32 count_j,
+                                     UINT32 intersection_count,
+                                     double slack) {
+//Check the thresholds for a pair with the given counts
+//Written as !(score >= threshold) so that 0 / 0 fails too
+    double ic = intersection_count;
+    double smaller = (count_i < count_j) ? count_i : count_j;
+    if(similarity_filter -> min_jaccard > 0 &&
+       !(ic / ((double) count_i + (double) count_j - ic) >= similarity_filter -> min_jaccard * (1 - slack))) {
+        return false;
+    }
+    if(similarity_filter -> min_cosine > 0 &&
+       !(ic / sqrt((double) count_i * (double) count_j) >= similarity_filter -> min_cosine * (1 - slack))) {
+        return false;
+    }
+    if(similarity_filter -> min_overlap > 0 &&
+       !(ic / smaller >= similarity_filter -> min_overlap * (1 - slack))) {
+        return false;
+    }
+    return true;
+}
+
+static bool similarity_bound_ok(CONSTANT SimilarityFilter * similarity_filter,
+                                int i,
+                                int j) {
+//Could i and j reach the thresholds at all? (is the best case good enough?)
+    UINT32 count_i = similarity_filter -> counts[i];
+    UINT32 count_j = similarity_filter -> counts[j];
+    return passes_similarity_filter(similarity_filter,
+                                    count_i,
+                                    count_j,
+                                    (count_i < count_j) ? count_i : count_j,
+                                    0);
+}
+
+static bool similarity_window(CONSTANT SimilarityFilter * similarity_filter,
+                              int i,
+                              int * begin,
+                              int * end) {
+//Find the range [begin, end) of sorted_rows that can reach the thresholds with row i
+//The best case score of a pair only goes up as count_j gets closer to count_i,
+//so the range is found with two binary searches on sorted_counts
+//Returns false if there is no range to use (no sorted rows or no jaccard/cosine thresholds)
+    int lo, hi, mid;
+    UINT32 count_i, count_j;
+    CONSTANT UINT32 * sorted_counts = similarity_filter -> sorted_counts;
+    if(similarity_filter -> sorted_rows == NULL ||
+       (similarity_filter -> min_jaccard <= 0 && similarity_filter -> min_cosine <= 0)) {
+        return false;
+    }
+    count_i = similarity_filter -> counts[i];
+    // First row that is either not smaller than row i or close enough
+    lo = 0; hi = similarity_filter -> num_counts;
+    while(lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        count_j = sorted_counts[mid];
+        if(count_j >= count_i ||
+           passes_similarity_filter(similarity_filter, count_i, count_j, count_j, SIMILARITY_WINDOW_SLACK)) {
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    *begin = lo;
+    // First row that is both larger than row i and too far
+    hi = similarity_filter -> num_counts;
+    while(lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        count_j = sorted_counts[mid];
+        if(count_j > count_i &&
+           !passes_similarity_filter(similarity_filter, count_i, count_j, count_i, SIMILARITY_WINDOW_SLACK)) {
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    *end = lo;
+    return true;
+}
+
+static int compare_intersection_counts_j(const void * a, const void * b) {
+    UINT32 x = ((CONSTANT IntersectionCount *) a) -> j;
+    UINT32 y = ((CONSTANT IntersectionCount *) b) -> j;
+    return (x > y) - (x < y);
+}
+
+KERNEL_CLONES
 void compute_counts(SparseBlockArray * sba_rows,
                     int chunk_length,
                     int num_rows,
@@ -116,20 +237,33 @@ void compute_counts(SparseBlockArray * sba_rows,
     }
 }
 
-bool compute_intersection_count(SparseBlockArray * sba_rows,
-                                int chunk_length,
-                                int i,
-                                int j,
-                                IntersectionCount * intersection_count_ptr,
-                                int cutoff) {
+static bool compute_intersection_count(SparseBlockArray * sba_rows,
+                                       int chunk_length,
+                                       int i,
+                                       int j,
+                                       IntersectionCount * intersection_count_ptr,
+                                       int cutoff,
+                                       CONSTANT SimilarityFilter * similarity_filter) {
 //Compute the counts (intersection and union) between two rows in an array of SBA's
 //if the intersection is greater than the cutoff, return the intersection and the union in the intersection_counts and return true
 //otherwise return false (result not be saved)
-    UINT32 count = sparse_bit_sum_and(sba_rows[i],
-                                      sba_rows[j],
-                                      chunk_length);
+//With a similarity_filter, pairs that can't pass it are not even intersected
+    UINT32 count;
+    if(similarity_filter != NULL && !similarity_bound_ok(similarity_filter, i, j)) {
+        return false;
+    }
+    count = sparse_bit_sum_and(sba_rows[i],
+                               sba_rows[j],
+                               chunk_length);
     if(count <= cutoff) {
         return false;
+    } else if(similarity_filter != NULL &&
+              !passes_similarity_filter(similarity_filter,
+                                        similarity_filter -> counts[i],
+                                        similarity_filter -> counts[j],
+                                        count,
+                                        0)) {
+        return false;
     } else {
         intersection_count_ptr -> i = i;
         intersection_count_ptr -> j = j;
@@ -138,19 +272,44 @@ bool compute_intersection_count(SparseBlockArray * sba_rows,
     }
 }
 
+KERNEL_CLONES
 int compute_intersection_counts(SparseBlockArray * sba_rows,
                                 int chunk_length,
                                 int i,
                                 int start_j,
                                 int num_rows,
                                 IntersectionCount * intersection_counts,
-                                int cutoff) {
+                                int cutoff,
+                                CONSTANT SimilarityFilter * similarity_filter) {
 //Compute IntersectionCount of all rows larger than ia with ia
 //intersection_counts must be pre-allocated with a length of num_rows
 //start_j should be (i + 1) under normal circumstances
-    int j;
+//similarity_filter can be NULL (see SimilarityFilter)
+    int j, p, begin, end;
     bool result;
     int num_intersection_counts = 0;
+    // Only visit the rows with close enough counts if that's a small enough range
+    if(similarity_filter != NULL &&
+       similarity_window(similarity_filter, i, &begin, &end) &&
+       end - begin < (num_rows - start_j) / 2) {
+        for(p = begin; p < end; p++) {
+            j = similarity_filter -> sorted_rows[p];
+            if(j < start_j || j >= num_rows || i == j) { continue; }
+            result = compute_intersection_count(sba_rows,
+                                                chunk_length,
+                                                i,
+                                                j,
+                                                &intersection_counts[num_intersection_counts],
+                                                cutoff,
+                                                similarity_filter);
+            if(result) {
+                num_intersection_counts++;
+            }
+        }
+        // Put the results back in order of j
+        qsort(intersection_counts, num_intersection_counts, sizeof(IntersectionCount), compare_intersection_counts_j);
+        return num_intersection_counts;
+    }
     for(j = start_j; j < num_rows; j++) {
         if(i == j) { continue; } // skip computing the row with itself
         result = compute_intersection_count(sba_rows,
@@ -158,7 +317,8 @@ int compute_intersection_counts(SparseBlockArray * sba_rows,
                                             i,
                                             j,
                                             &intersection_counts[num_intersection_counts],
-                                            cutoff);
+                                            cutoff,
+                                            similarity_filter);
         if(result) {
             num_intersection_counts++;
         }
@@ -166,12 +326,281 @@ int compute_intersection_counts(SparseBlockArray * sba_rows,
     return num_intersection_counts;
 }
 
+KERNEL_CLONES
+int compute_intersection_counts_candidates(SparseBlockArray query,
+                                           SparseBlockArray * sba_rows,
+                                           int chunk_length,
+                                           int i,
+                                           int skip_j,
+                                           CONSTANT INT32 * candidates,
+                                           int num_candidates,
+                                           IntersectionCount * intersection_counts,
+                                           int cutoff) {
+//Compute IntersectionCount of a query row (which doesn't have to be one of the sba_rows)
+//with each row j in candidates (or with rows 0 to num_candidates - 1 if candidates is NULL)
+//i is only used to label the results and row skip_j is left out (-1 for none)
+//intersection_counts must be pre-allocated with a length of num_candidates
+    int j, p;
+    UINT32 count;
+    int num_intersection_counts = 0;
+    for(p = 0; p < num_candidates; p++) {
+        j = (candidates == NULL) ? p : candidates[p];
+        if(j == skip_j) { continue; }
+        count = sparse_bit_sum_and(query,
+                                   sba_rows[j],
+                                   chunk_length);
+        if(count > cutoff) {
+            intersection_counts[num_intersection_counts].i = i;
+            intersection_counts[num_intersection_counts].j = j;
+            intersection_counts[num_intersection_counts].intersection_count = count;
+            num_intersection_counts++;
+        }
+    }
+    return num_intersection_counts;
+}
+
+////////////////////////////////////////////////////////////////////////
+// SBA compression
+// Each row comes in as its bit indices (in any order, with repeats),
+// which get sorted and deduplicated in place (sort_row_bits), then
+// the blocks get counted (count_row_blocks) so that the packed buffers
+// can be allocated once, and filled in (fill_row_blocks)
+// The rows are independent, so the caller can run them in parallel
+////////////////////////////////////////////////////////////////////////
+
+static int compare_int64s(const void * a, const void * b) {
+    INT64 x = *(CONSTANT INT64 *) a;
+    INT64 y = *(CONSTANT INT64 *) b;
+    return (x > y) - (x < y);
+}
+
+INT64 sort_row_bits(INT64 * bits,
+                    INT64 num_bits) {
+//Sort the bits of a row and drop the repeats
+//Returns the number of bits that are left (at the start of bits)
+    INT64 k, num_unique;
+    if(num_bits < 2) {
+        return num_bits;
+    }
+    qsort(bits, num_bits, sizeof(INT64), compare_int64s);
+    num_unique = 1;
+    for(k=1; k<num_bits; k++) {
+        if(bits[k] != bits[num_unique - 1]) {
+            bits[num_unique++] = bits[k];
+        }
+    }
+    return num_unique;
+}
+
+INT64 count_row_blocks(CONSTANT INT64 * bits,
+                       INT64 num_bits,
+                       int chunk_length) {
+//Number of SBA blocks needed for the (sorted, unique) bits of a row
+    INT64 k;
+    INT64 block_bits = 64 * (INT64) chunk_length;
+    INT64 num_blocks = 0;
+    for(k=0; k<num_bits; k++) {
+        if(k == 0 || bits[k] / block_bits != bits[k - 1] / block_bits) {
+            num_blocks++;
+        }
+    }
+    return num_blocks;
+}
+
+void fill_row_blocks(CONSTANT INT64 * bits,
+                     INT64 num_bits,
+                     int chunk_length,
+                     UINT32 * locs,
+                     UINT64 * array) {
+//Write the SBA blocks of the (sorted, unique) bits of a row
+//locs and array are pre-allocated with room for count_row_blocks blocks
+//and array must be all zeros
+    INT64 k, block;
+    INT64 block_bits = 64 * (INT64) chunk_length;
+    INT64 num_blocks = 0;
+    for(k=0; k<num_bits; k++) {
+        block = bits[k] / block_bits;
+        if(k == 0 || block != bits[k - 1] / block_bits) {
+            locs[num_blocks++] = block;
+        }
+        array[(num_blocks - 1) * chunk_length + (bits[k] % block_bits) / 64] |= ((UINT64) 1) << (bits[k] % 64);
+    }
+}
+
+////////////////////////////////////////////////////////////////////////
+// Weighted (multiset) connections
+// The presence of each connection is still stored in the SBA, and its
+// weight goes into a separate weights array in the same order as the
+// bits (row by row, then by b), block_weight_offsets[k] is the position
+// in weights of the first bit of block k (see sparse_block_array.sba_weights_from_index_arrays)
+// The weight of a bit is then found with the popcount of the bits before it
+////////////////////////////////////////////////////////////////////////
+
+static double sparse_weighted_min_sum(SparseBlockArray a,
+                                      CONSTANT INT64 * a_weight_offsets,
+                                      SparseBlockArray b,
+                                      CONSTANT INT64 * b_weight_offsets,
+                                      CONSTANT double * weights,
+                                      int chunk_length) {
+// Sum of min(w_a, w_b) over the bits that are set in both a and b
+// (same merge over the matching blocks as sparse_bit_sum_and)
+    int i_a = 0;
+    int i_b = 0;
+    int w;
+    UINT64 word_a, word_b, common, below;
+    INT64 rank_a, rank_b;
+    double weight_a, weight_b;
+    double sum = 0;
+    while(i_a < a.len && i_b < b.len) {
+        if(b.locs[i_b] < a.locs[i_a]) {
+            i_b++;
+        } else if(a.locs[i_a] < b.locs[i_b]) {
+            i_a++;
+        } else {
+            rank_a = a_weight_offsets[i_a];
+            rank_b = b_weight_offsets[i_b];
+            for(w = 0; w < chunk_length; w++) {
+                word_a = DAT_A[w];
+                word_b = DAT_B[w];
+                common = word_a & word_b;
+                while(common) {
+                    below = (common & -common) - 1; // the bits under the lowest common bit
+                    weight_a = weights[rank_a + POPCOUNT(word_a & below)];
+                    weight_b = weights[rank_b + POPCOUNT(word_b & below)];
+                    sum += (weight_a < weight_b) ? weight_a : weight_b;
+                    common &= common - 1;
+                }
+                rank_a += POPCOUNT(word_a);
+                rank_b += POPCOUNT(word_b);
+            }
+            i_a++; i_b++;
+        }
+    }
+    return sum;
+}
+
+KERNEL_CLONES
+void compute_min_sums(SparseBlockArray * sba_rows,
+                      CONSTANT INT64 * row_offsets,
+                      CONSTANT INT64 * block_weight_offsets,
+                      CONSTANT double * weights,
+                      int chunk_length,
+                      CONSTANT IntersectionCount * intersection_counts,
+                      int num_intersection_counts,
+                      double * min_sums) {
+//Compute the sum of min(w_i, w_j) for each pair (i, j) in intersection_counts
+//(the output of one of the intersection counts kernels)
+//row_offsets are the offsets of the packed SBA (the first block of each row)
+//min_sums must be pre-allocated with a length of num_intersection_counts
+    int p;
+    UINT32 i, j;
+    for(p = 0; p < num_intersection_counts; p++) {
+        i = intersection_counts[p].i;
+        j = intersection_counts[p].j;
+        min_sums[p] = sparse_weighted_min_sum(sba_rows[i],
+                                              block_weight_offsets + row_offsets[i],
+                                              sba_rows[j],
+                                              block_weight_offsets + row_offsets[j],
+                                              weights,
+                                              chunk_length);
+    }
+}
+
+////////////////////////////////////////////////////////////////////////
+// Inverted index ("postings") engine for very sparse data
+// Instead of merging every pair of rows, walk the B -> A postings lists
+// of every B that row i has, and accumulate counts only for the rows j
+// that actually co-occur with i
+////////////////////////////////////////////////////////////////////////
+
+static int compare_ints(const void * a, const void * b) {
+    INT32 x = *(CONSTANT INT32 *) a;
+    INT32 y = *(CONSTANT INT32 *) b;
+    return (x > y) - (x < y);
+}
+
+int compute_intersection_counts_postings(CONSTANT INT64 * a_offsets,
+                                         CONSTANT INT32 * a_indices,
+                                         CONSTANT INT64 * b_offsets,
+                                         CONSTANT INT32 * b_indices,
+                                         int i,
+                                         int start_j,
+                                         int num_rows,
+                                         UINT32 * accumulator,
+                                         INT32 * touched,
+                                         IntersectionCount * intersection_counts,
+                                         int cutoff,
+                                         CONSTANT SimilarityFilter * similarity_filter) {
+//Compute IntersectionCount of all rows from start_j up to num_rows with row i
+//a_offsets/a_indices are the (sorted) B's for each A (CSR)
+//b_offsets/b_indices are the (sorted) A's for each B (postings lists)
+//accumulator and touched are scratch space with a length of num_rows
+//accumulator must be all zeros and is left that way on return (sparse accumulator)
+//intersection_counts must be pre-allocated with a length of num_rows
+//results come out in order of j, same as compute_intersection_counts
+//similarity_filter can be NULL (see SimilarityFilter)
+    INT64 k, p, lo, hi, mid;
+    INT32 j;
+    int t;
+    int num_touched = 0;
+    int num_intersection_counts = 0;
+    for(k = a_offsets[i]; k < a_offsets[i + 1]; k++) {
+        // Binary search for the first entry >= start_j in this postings list
+        lo = b_offsets[a_indices[k]];
+        hi = b_offsets[a_indices[k] + 1];
+        while(lo < hi) {
+            mid = (lo + hi) / 2;
+            if(b_indices[mid] < start_j) { lo = mid + 1; } else { hi = mid; }
+        }
+        for(p = lo; p < b_offsets[a_indices[k] + 1]; p++) {
+            j = b_indices[p];
+            if(j >= num_rows) { break; }
+            if(j == i) { continue; } // skip computing the row with itself
+            if(accumulator[j] == 0) {
+                touched[num_touched] = j;
+                num_touched++;
+            }
+            accumulator[j]++;
+        }
+    }
+    // Put the results in order of j (scan the range instead if it is mostly touched)
+    if(num_touched > (num_rows - start_j) / 8) {
+        num_touched = 0;
+        for(j = start_j; j < num_rows; j++) {
+            if(accumulator[j] != 0) {
+                touched[num_touched] = j;
+                num_touched++;
+            }
+        }
+    } else {
+        qsort(touched, num_touched, sizeof(INT32), compare_ints);
+    }
+    for(t = 0; t < num_touched; t++) {
+        j = touched[t];
+        if(accumulator[j] > cutoff &&
+           (similarity_filter == NULL ||
+            passes_similarity_filter(similarity_filter,
+                                     similarity_filter -> counts[i],
+                                     similarity_filter -> counts[j],
+                                     accumulator[j],
+                                     0))) {
+            intersection_counts[num_intersection_counts].i = i;
+            intersection_counts[num_intersection_counts].j = j;
+            intersection_counts[num_intersection_counts].intersection_count = accumulator[j];
+            num_intersection_counts++;
+        }
+        accumulator[j] = 0;
+    }
+    return num_intersection_counts;
+}
+
 ////////////////////////////////////////////////////////////////////////
 // Add 3 new functions that take dense arrays (simple UINT64 pointers)
 // instead of SparseBlockArray pointers.
 // These still allow for chunk_length to be used
 ////////////////////////////////////////////////////////////////////////
 
+KERNEL_CLONES
 void compute_counts_dense_input(UINT64 * rows_arr,
                                 int chunk_length,
                                 int num_rows,
@@ -185,20 +614,32 @@ void compute_counts_dense_input(UINT64 * rows_arr,
     }
 }
 
-bool compute_intersection_count_dense_input(UINT64 * rows_arr,
-                                            int chunk_length,
-                                            int i,
-                                            int j,
-                                            IntersectionCount * intersection_count_ptr,
-                                            int cutoff) {
+static bool compute_intersection_count_dense_input(UINT64 * rows_arr,
+                                                   int chunk_length,
+                                                   int i,
+                                                   int j,
+                                                   IntersectionCount * intersection_count_ptr,
+                                                   int cutoff,
+                                                   CONSTANT SimilarityFilter * similarity_filter) {
 //Compute the counts (intersection and union) between two rows in an array of SBA's
 //if the intersection is greater than the cutoff, return the intersection and the union in the intersection_counts and return true
 //otherwise return false (result not be saved)
-    UINT32 count = bit_sum_and(&rows_arr[i * chunk_length],
-                               &rows_arr[j * chunk_length],
-                               chunk_length);
+    UINT32 count;
+    if(similarity_filter != NULL && !similarity_bound_ok(similarity_filter, i, j)) {
+        return false;
+    }
+    count = bit_sum_and(&rows_arr[i * chunk_length],
+                        &rows_arr[j * chunk_length],
+                        chunk_length);
     if(count <= cutoff) {
         return false;
+    } else if(similarity_filter != NULL &&
+              !passes_similarity_filter(similarity_filter,
+                                        similarity_filter -> counts[i],
+                                        similarity_filter -> counts[j],
+                                        count,
+                                        0)) {
+        return false;
     } else {
         intersection_count_ptr -> i = i;
         intersection_count_ptr -> j = j;
@@ -207,19 +648,44 @@ bool compute_intersection_count_dense_input(UINT64 * rows_arr,
     }
 }
 
+KERNEL_CLONES
 int compute_intersection_counts_dense_input(UINT64 * rows_arr,
                                             int chunk_length,
                                             int i,
                                             int start_j,
                                             int num_rows,
                                             IntersectionCount * intersection_counts,
-                                            int cutoff) {
+                                            int cutoff,
+                                            CONSTANT SimilarityFilter * similarity_filter) {
 //Compute IntersectionCount of all rows larger than ia with ia
 //intersection_counts must be pre-allocated with a length of num_rows
 //start_j should be (i + 1) under normal circumstances
-    int j;
+//similarity_filter can be NULL (see SimilarityFilter)
+    int j, p, begin, end;
     bool result;
     int num_intersection_counts = 0;
+    // Only visit the rows with close enough counts if that's a small enough range
+    if(similarity_filter != NULL &&
+       similarity_window(similarity_filter, i, &begin, &end) &&
+       end - begin < (num_rows - start_j) / 2) {
+        for(p = begin; p < end; p++) {
+            j = similarity_filter -> sorted_rows[p];
+            if(j < start_j || j >= num_rows || i == j) { continue; }
+            result = compute_intersection_count_dense_input(rows_arr,
+                                                chunk_length,
+                                                i,
+                                                j,
+                                                &intersection_counts[num_intersection_counts],
+                                                cutoff,
+                                                similarity_filter);
+            if(result) {
+                num_intersection_counts++;
+            }
+        }
+        // Put the results back in order of j
+        qsort(intersection_counts, num_intersection_counts, sizeof(IntersectionCount), compare_intersection_counts_j);
+        return num_intersection_counts;
+    }
     for(j = start_j; j < num_rows; j++) {
         if(i == j) { continue; } // skip computing the row with itself
         result = compute_intersection_count_dense_input(rows_arr,
@@ -227,7 +693,510 @@ int compute_intersection_counts_dense_input(UINT64 * rows_arr,
                                                         i,
                                                         j,
                                                         &intersection_counts[num_intersection_counts],
-                                                        cutoff);
+                                                        cutoff,
+                                                        similarity_filter);
+        if(result) {
+            num_intersection_counts++;
+        }
+    }
+    return num_intersection_counts;
+}
+
+////////////////////////////////////////////////////////////////////////
+// Top-K: keep only the k best j's for each row i in a bounded heap
+// instead of writing out every pair (output is linear in the rows)
+// The heap is a min-heap on (score, -j) stored directly in the
+// row's output arrays, so the worst kept result is always at the root
+////////////////////////////////////////////////////////////////////////
+
+static double topk_score(UINT32 intersection_count,
+                         UINT32 count_i,
+                         UINT32 count_j,
+                         int metric) {
+    if(metric == TOPK_JACCARD) {
+        return (double) intersection_count / (double) (count_i + count_j - intersection_count);
+    }
+    return (double) intersection_count;
+}
+
+static double topk_score_bound(UINT32 count_i,
+                               UINT32 count_j,
+                               int metric) {
+//Upper bound on the score of i and j from their counts alone
+//(the intersection can't be larger than the smaller row)
+    UINT32 lo = (count_i < count_j) ? count_i : count_j;
+    UINT32 hi = (count_i < count_j) ? count_j : count_i;
+    if(metric == TOPK_JACCARD) {
+        return (hi == 0) ? 0.0 : (double) lo / (double) hi;
+    }
+    return (double) lo;
+}
+
+static bool topk_worse(double score_a, INT32 j_a, double score_b, INT32 j_b) {
+// Lower scores are worse, ties go to the smaller j
+    return (score_a < score_b) || (score_a == score_b && j_a > j_b);
+}
+
+static void topk_sift_down(INT32 * top_indices,
+                           double * top_scores,
+                           int size,
+                           int pos) {
+    int child;
+    INT32 j = top_indices[pos];
+    double score = top_scores[pos];
+    while((child = 2 * pos + 1) < size) {
+        if(child + 1 < size && topk_worse(top_scores[child + 1], top_indices[child + 1],
+                                          top_scores[child], top_indices[child])) {
+            child++;
+        }
+        if(!topk_worse(top_scores[child], top_indices[child], score, j)) { break; }
+        top_indices[pos] = top_indices[child];
+        top_scores[pos] = top_scores[child];
+        pos = child;
+    }
+    top_indices[pos] = j;
+    top_scores[pos] = score;
+}
+
+static void topk_push(INT32 * top_indices,
+                      double * top_scores,
+                      int * size,
+                      int k,
+                      INT32 j,
+                      double score) {
+    int pos, parent;
+    if(*size < k) {
+        // Sift up
+        pos = (*size)++;
+        while(pos > 0) {
+            parent = (pos - 1) / 2;
+            if(!topk_worse(score, j, top_scores[parent], top_indices[parent])) { break; }
+            top_indices[pos] = top_indices[parent];
+            top_scores[pos] = top_scores[parent];
+            pos = parent;
+        }
+        top_indices[pos] = j;
+        top_scores[pos] = score;
+    } else if(topk_worse(top_scores[0], top_indices[0], score, j)) {
+        // Replace the worst
+        top_indices[0] = j;
+        top_scores[0] = score;
+        topk_sift_down(top_indices, top_scores, k, 0);
+    }
+}
+
+static bool topk_can_skip(CONSTANT double * top_scores,
+                          int size,
+                          int k,
+                          double bound) {
+// Once the heap is full, skip any j that can't beat the worst result
+    return size == k && bound < top_scores[0];
+}
+
+static int topk_finish(INT32 * top_indices,
+                       double * top_scores,
+                       int size,
+                       int k) {
+//Sort the heap in place (best first) and pad the unused slots with -1 / 0
+//Returns the number of results
+    int n;
+    INT32 j;
+    double score;
+    for(n = size - 1; n > 0; n--) {
+        j = top_indices[n]; score = top_scores[n];
+        top_indices[n] = top_indices[0]; top_scores[n] = top_scores[0];
+        top_indices[0] = j; top_scores[0] = score;
+        topk_sift_down(top_indices, top_scores, n, 0);
+    }
+    for(n = size; n < k; n++) {
+        top_indices[n] = -1;
+        top_scores[n] = 0.0;
+    }
+    return size;
+}
+
+KERNEL_CLONES
+int compute_topk(SparseBlockArray * sba_rows,
+                 int chunk_length,
+                 int i,
+                 int num_rows,
+                 CONSTANT UINT32 * counts,
+                 int metric,
+                 int k,
+                 INT32 * top_indices,
+                 double * top_scores,
+                 int cutoff) {
+//Find the k rows j (out of all num_rows, except i) that score the highest with row i
+//counts are the bit sums of each row (from compute_counts)
+//metric is TOPK_INTERSECTION or TOPK_JACCARD
+//only rows with an intersection greater than cutoff are considered
+//top_indices and top_scores must be pre-allocated with a length of k
+//and get the results sorted by score (best first, ties by j),
+//with unused slots set to -1 and 0
+//Returns the number of results
+    int j;
+    int size = 0;
+    UINT32 count;
+    if(k <= 0) { return 0; }
+    for(j = 0; j < num_rows; j++) {
+        if(i == j) { continue; } // skip computing the row with itself
+        if(topk_can_skip(top_scores, size, k, topk_score_bound(counts[i], counts[j], metric))) { continue; }
+        count = sparse_bit_sum_and(sba_rows[i],
+                                   sba_rows[j],
+                                   chunk_length);
+        if(count <= cutoff) { continue; }
+        topk_push(top_indices, top_scores, &size, k, j,
+                  topk_score(count, counts[i], counts[j], metric));
+    }
+    return topk_finish(top_indices, top_scores, size, k);
+}
+
+KERNEL_CLONES
+int compute_topk_dense_input(UINT64 * rows_arr,
+                             int chunk_length,
+                             int i,
+                             int num_rows,
+                             CONSTANT UINT32 * counts,
+                             int metric,
+                             int k,
+                             INT32 * top_indices,
+                             double * top_scores,
+                             int cutoff) {
+//Same as compute_topk, but for dense rows
+    int j;
+    int size = 0;
+    UINT32 count;
+    if(k <= 0) { return 0; }
+    for(j = 0; j < num_rows; j++) {
+        if(i == j) { continue; } // skip computing the row with itself
+        if(topk_can_skip(top_scores, size, k, topk_score_bound(counts[i], counts[j], metric))) { continue; }
+        count = bit_sum_and(&rows_arr[i * chunk_length],
+                            &rows_arr[j * chunk_length],
+                            chunk_length);
+        if(count <= cutoff) { continue; }
+        topk_push(top_indices, top_scores, &size, k, j,
+                  topk_score(count, counts[i], counts[j], metric));
+    }
+    return topk_finish(top_indices, top_scores, size, k);
+}
+
+int compute_topk_postings(CONSTANT INT64 * a_offsets,
+                          CONSTANT INT32 * a_indices,
+                          CONSTANT INT64 * b_offsets,
+                          CONSTANT INT32 * b_indices,
+                          int i,
+                          int num_rows,
+                          CONSTANT UINT32 * counts,
+                          int metric,
+                          int k,
+                          UINT32 * accumulator,
+                          INT32 * touched,
+                          INT32 * top_indices,
+                          double * top_scores,
+                          int cutoff) {
+//Same as compute_topk, but using the postings lists
+//(see compute_intersection_counts_postings for accumulator and touched)
+//only the rows that co-occur with i are visited
+    INT64 n, p;
+    INT32 j;
+    int t;
+    int num_touched = 0;
+    int size = 0;
+    for(n = a_offsets[i]; n < a_offsets[i + 1]; n++) {
+        for(p = b_offsets[a_indices[n]]; p < b_offsets[a_indices[n] + 1]; p++) {
+            j = b_indices[p];
+            if(j >= num_rows) { break; }
+            if(j == i) { continue; } // skip computing the row with itself
+            if(accumulator[j] == 0) {
+                touched[num_touched] = j;
+                num_touched++;
+            }
+            accumulator[j]++;
+        }
+    }
+    for(t = 0; t < num_touched; t++) {
+        j = touched[t];
+        if(k > 0 && accumulator[j] > cutoff) {
+            topk_push(top_indices, top_scores, &size, k, j,
+                      topk_score(accumulator[j], counts[i], counts[j], metric));
+        }
+        accumulator[j] = 0;
+    }
+    if(k <= 0) { return 0; }
+    return topk_finish(top_indices, top_scores, size, k);
+}
+
+////////////////////////////////////////////////////////////////////////
+// Hybrid (roaring-style) rows (see RoaringRow)
+// The intersection of two rows only needs the containers with the same key,
+// each pair of container types has its own way of counting
+////////////////////////////////////////////////////////////////////////
+
+// Use galloping instead of a merge when one array is this many times longer
+#define ROARING_GALLOP_RATIO 32
+
+static UINT32 array_and_array(CONSTANT UINT16 * a,
+                              int num_a,
+                              CONSTANT UINT16 * b,
+                              int num_b) {
+//Count the values in both sorted arrays
+    int i_a = 0;
+    int i_b = 0;
+    int lo, hi, mid, step;
+    UINT16 value_a, value_b;
+    UINT32 sum = 0;
+    CONSTANT UINT16 * t;
+    if(num_a > num_b) {
+        t = a; a = b; b = t;
+        lo = num_a; num_a = num_b; num_b = lo;
+    }
+    if(num_a * ROARING_GALLOP_RATIO < num_b) {
+        // Look up each value of the short array in the long one
+        for(i_a = 0; i_a < num_a && i_b < num_b; i_a++) {
+            // Gallop to a range that has the value, then binary search in it
+            step = 1;
+            hi = i_b;
+            while(hi < num_b && b[hi] < a[i_a]) {
+                i_b = hi + 1;
+                hi += step;
+                step *= 2;
+            }
+            lo = i_b;
+            hi = (hi < num_b) ? hi + 1 : num_b;
+            while(lo < hi) {
+                mid = lo + (hi - lo) / 2;
+                if(b[mid] < a[i_a]) { lo = mid + 1; } else { hi = mid; }
+            }
+            i_b = lo;
+            if(i_b < num_b && b[i_b] == a[i_a]) {
+                sum++;
+                i_b++;
+            }
+        }
+        return sum;
+    }
+    // Branch-free merge (which side moves is too random to predict)
+    while(i_a < num_a && i_b < num_b) {
+        value_a = a[i_a];
+        value_b = b[i_b];
+        sum += (value_a == value_b);
+        i_a += (value_a <= value_b);
+        i_b += (value_b <= value_a);
+    }
+    return sum;
+}
+
+static UINT32 array_and_bitmap(CONSTANT UINT16 * a,
+                               int num_a,
+                               CONSTANT UINT64 * bitmap) {
+//Count the values of the array that are set in the bitmap
+    int i;
+    UINT32 sum = 0;
+    for(i = 0; i < num_a; i++) {
+        sum += (bitmap[a[i] >> 6] >> (a[i] & 63)) & 1;
+    }
+    return sum;
+}
+
+static UINT32 array_and_run(CONSTANT UINT16 * a,
+                            int num_a,
+                            CONSTANT UINT16 * runs,
+                            int num_runs) {
+//Count the values of the array that fall inside one of the runs
+    int i = 0;
+    int r = 0;
+    UINT32 sum = 0;
+    while(i < num_a && r < num_runs) {
+        if((UINT32) runs[2 * r] + runs[2 * r + 1] < a[i]) {
+            r++;
+        } else {
+            sum += (runs[2 * r] <= a[i]);
+            i++;
+        }
+    }
+    return sum;
+}
+
+static UINT32 bitmap_range_count(CONSTANT UINT64 * bitmap,
+                                 UINT32 first,
+                                 UINT32 last) {
+//Count the bits set in the bitmap from first to last (inclusive)
+    UINT32 w;
+    UINT32 first_word = first >> 6;
+    UINT32 last_word = last >> 6;
+    UINT64 first_mask = ~0UL << (first & 63);
+    UINT64 last_mask = ~0UL >> (63 - (last & 63));
+    UINT32 sum;
+    if(first_word == last_word) {
+        return POPCOUNT(bitmap[first_word] & first_mask & last_mask);
+    }
+    sum = POPCOUNT(bitmap[first_word] & first_mask) + POPCOUNT(bitmap[last_word] & last_mask);
+    for(w = first_word + 1; w < last_word; w++) {
+        sum += POPCOUNT(bitmap[w]);
+    }
+    return sum;
+}
+
+static UINT32 bitmap_and_run(CONSTANT UINT64 * bitmap,
+                             CONSTANT UINT16 * runs,
+                             int num_runs) {
+//Count the bits of the bitmap that fall inside one of the runs
+    int r;
+    UINT32 sum = 0;
+    for(r = 0; r < num_runs; r++) {
+        sum += bitmap_range_count(bitmap, runs[2 * r], (UINT32) runs[2 * r] + runs[2 * r + 1]);
+    }
+    return sum;
+}
+
+static UINT32 run_and_run(CONSTANT UINT16 * a,
+                          int num_a,
+                          CONSTANT UINT16 * b,
+                          int num_b) {
+//Add up the overlaps of two sorted lists of runs
+    int r_a = 0;
+    int r_b = 0;
+    UINT32 first, last, last_a, last_b;
+    UINT32 sum = 0;
+    while(r_a < num_a && r_b < num_b) {
+        last_a = (UINT32) a[2 * r_a] + a[2 * r_a + 1];
+        last_b = (UINT32) b[2 * r_b] + b[2 * r_b + 1];
+        first = (a[2 * r_a] > b[2 * r_b]) ? a[2 * r_a] : b[2 * r_b];
+        last = (last_a < last_b) ? last_a : last_b;
+        if(first <= last) {
+            sum += last - first + 1;
+        }
+        if(last_a < last_b) { r_a++; } else { r_b++; }
+    }
+    return sum;
+}
+
+static UINT32 container_and_count(UINT8 type_a,
+                                  CONSTANT UINT16 * data_a,
+                                  CONSTANT UINT64 * bitmap_a,
+                                  int size_a,
+                                  UINT8 type_b,
+                                  CONSTANT UINT16 * data_b,
+                                  CONSTANT UINT64 * bitmap_b,
+                                  int size_b) {
+//Count the values in both containers (any two types)
+    if(type_a > type_b) {
+        return container_and_count(type_b, data_b, bitmap_b, size_b,
+                                   type_a, data_a, bitmap_a, size_a);
+    }
+    if(type_a == ROARING_ARRAY) {
+        if(type_b == ROARING_ARRAY) { return array_and_array(data_a, size_a, data_b, size_b); }
+        if(type_b == ROARING_BITMAP) { return array_and_bitmap(data_a, size_a, bitmap_b); }
+        return array_and_run(data_a, size_a, data_b, size_b / 2);
+    }
+    if(type_a == ROARING_BITMAP) {
+        if(type_b == ROARING_BITMAP) { return popcount_and_array(bitmap_a, bitmap_b, ROARING_BITMAP_WORDS); }
+        return bitmap_and_run(bitmap_a, data_b, size_b / 2);
+    }
+    return run_and_run(data_a, size_a / 2, data_b, size_b / 2);
+}
+
+KERNEL_CLONES
+UINT32 roaring_and_count(RoaringRow a,
+                         RoaringRow b) {
+//Same as sparse_bit_sum_and but over hybrid rows
+//Merge the keys, keeping track of where the data of each container starts
+    UINT32 i_a = 0;
+    UINT32 i_b = 0;
+    INT64 data_a = 0;
+    INT64 data_b = 0;
+    INT64 bitmap_a = 0;
+    INT64 bitmap_b = 0;
+    UINT32 sum = 0;
+    bool advance_a, advance_b;
+    while(i_a < a.len && i_b < b.len) {
+        advance_a = a.keys[i_a] <= b.keys[i_b];
+        advance_b = b.keys[i_b] <= a.keys[i_a];
+        if(advance_a && advance_b) {
+            sum += container_and_count(a.types[i_a], a.data + data_a,
+                                       a.bitmaps + bitmap_a * ROARING_BITMAP_WORDS, a.sizes[i_a],
+                                       b.types[i_b], b.data + data_b,
+                                       b.bitmaps + bitmap_b * ROARING_BITMAP_WORDS, b.sizes[i_b]);
+        }
+        if(advance_a) {
+            if(a.types[i_a] == ROARING_BITMAP) { bitmap_a++; } else { data_a += a.sizes[i_a]; }
+            i_a++;
+        }
+        if(advance_b) {
+            if(b.types[i_b] == ROARING_BITMAP) { bitmap_b++; } else { data_b += b.sizes[i_b]; }
+            i_b++;
+        }
+    }
+    return sum;
+}
+
+static bool compute_intersection_count_roaring(RoaringRow * rows,
+                                               int i,
+                                               int j,
+                                               IntersectionCount * intersection_count_ptr,
+                                               int cutoff,
+                                               CONSTANT SimilarityFilter * similarity_filter) {
+//Same as compute_intersection_count, but for hybrid rows
+    UINT32 count;
+    if(similarity_filter != NULL && !similarity_bound_ok(similarity_filter, i, j)) {
+        return false;
+    }
+    count = roaring_and_count(rows[i], rows[j]);
+    if(count <= cutoff) {
+        return false;
+    } else if(similarity_filter != NULL &&
+              !passes_similarity_filter(similarity_filter,
+                                        similarity_filter -> counts[i],
+                                        similarity_filter -> counts[j],
+                                        count,
+                                        0)) {
+        return false;
+    } else {
+        intersection_count_ptr -> i = i;
+        intersection_count_ptr -> j = j;
+        intersection_count_ptr -> intersection_count = count;
+        return true;
+    }
+}
+
+int compute_intersection_counts_roaring(RoaringRow * rows,
+                                        int i,
+                                        int start_j,
+                                        int num_rows,
+                                        IntersectionCount * intersection_counts,
+                                        int cutoff,
+                                        CONSTANT SimilarityFilter * similarity_filter) {
+//Same as compute_intersection_counts, but for hybrid rows
+    int j, p, begin, end;
+    bool result;
+    int num_intersection_counts = 0;
+    if(similarity_filter != NULL &&
+       similarity_window(similarity_filter, i, &begin, &end) &&
+       end - begin < (num_rows - start_j) / 2) {
+        for(p = begin; p < end; p++) {
+            j = similarity_filter -> sorted_rows[p];
+            if(j < start_j || j >= num_rows || i == j) { continue; }
+            result = compute_intersection_count_roaring(rows,
+                                                        i,
+                                                        j,
+                                                        &intersection_counts[num_intersection_counts],
+                                                        cutoff,
+                                                        similarity_filter);
+            if(result) {
+                num_intersection_counts++;
+            }
+        }
+        qsort(intersection_counts, num_intersection_counts, sizeof(IntersectionCount), compare_intersection_counts_j);
+        return num_intersection_counts;
+    }
+    for(j = start_j; j < num_rows; j++) {
+        if(i == j) { continue; }
+        result = compute_intersection_count_roaring(rows,
+                                                    i,
+                                                    j,
+                                                    &intersection_counts[num_intersection_counts],
+                                                    cutoff,
+                                                    similarity_filter);
         if(result) {
             num_intersection_counts++;
         }
@@ -235,3 +1204,94 @@ int compute_intersection_counts_dense_input(UINT64 * rows_arr,
     return num_intersection_counts;
 }
 
+////////////////////////////////////////////////////////////////////////
+// Derived set statistics of each pair (see PAIR_METRIC_*)
+// One pass over the intersection counts with the base counts,
+// written straight into the fields of a numpy structured array
+////////////////////////////////////////////////////////////////////////
+
+static double safe_ratio(double numerator,
+                         double denominator) {
+    return denominator > 0 ? numerator / denominator : 0.0;
+}
+
+static void write_metric(char * field,
+                         double value,
+                         int is_count,
+                         int double_precision) {
+// memcpy because the fields of a packed record don't have to be aligned
+    UINT32 count;
+    float value_32;
+    if(is_count) {
+        count = (UINT32) value;
+        memcpy(field, &count, sizeof(UINT32));
+    } else if(double_precision) {
+        memcpy(field, &value, sizeof(double));
+    } else {
+        value_32 = (float) value;
+        memcpy(field, &value_32, sizeof(float));
+    }
+}
+
+void compute_pair_metrics(CONSTANT IntersectionCount * intersection_counts,
+                          INT64 num_intersection_counts,
+                          CONSTANT UINT32 * counts,
+                          double num_b,
+                          CONSTANT INT64 * metric_offsets,
+                          int double_precision,
+                          INT64 record_size,
+                          char * output) {
+//Fill in one output record for each pair in intersection_counts
+//Each record starts with the IntersectionCount itself (i, j, intersection_count)
+//and metric_offsets[m] is the byte offset of metric m in the record (-1 to leave it out)
+//The counts are UINT32 and the ratios are float (or double with double_precision)
+//num_b (the number of B's) is only used by the lift and the pmi
+    INT64 k;
+    int m;
+    char * record;
+    double ic, count_i, count_j, union_count, value;
+    for(k=0; k<num_intersection_counts; k++) {
+        record = output + k * record_size;
+        memcpy(record, &intersection_counts[k], sizeof(IntersectionCount));
+        ic = intersection_counts[k].intersection_count;
+        count_i = counts[intersection_counts[k].i];
+        count_j = counts[intersection_counts[k].j];
+        union_count = count_i + count_j - ic;
+        for(m=0; m<NUM_PAIR_METRICS; m++) {
+            if(metric_offsets[m] < 0) { continue; }
+            switch(m) {
+                case PAIR_METRIC_UNION: value = union_count; break;
+                case PAIR_METRIC_DIFFERENCE_IJ: value = count_i - ic; break;
+                case PAIR_METRIC_DIFFERENCE_JI: value = count_j - ic; break;
+                case PAIR_METRIC_SYMMETRIC_DIFFERENCE: value = union_count - ic; break;
+                case PAIR_METRIC_JACCARD: value = safe_ratio(ic, union_count); break;
+                case PAIR_METRIC_COSINE: value = safe_ratio(ic, sqrt(count_i * count_j)); break;
+                case PAIR_METRIC_OVERLAP: value = safe_ratio(ic, count_i < count_j ? count_i : count_j); break;
+                case PAIR_METRIC_DICE: value = safe_ratio(2 * ic, count_i + count_j); break;
+                case PAIR_METRIC_LIFT: value = safe_ratio(ic * num_b, count_i * count_j); break;
+                default: value = log(safe_ratio(ic * num_b, count_i * count_j)); break; // PAIR_METRIC_PMI
+            }
+            write_metric(record + metric_offsets[m],
+                         value,
+                         m <= PAIR_METRIC_LAST_COUNT,
+                         double_precision);
+        }
+    }
+}
+
+// Threads
+
+int pin_current_thread(int cpu) {
+// Restrict the calling thread to a single cpu
+// Returns 0 on success and -1 if it failed (or is not supported here)
+#ifdef __linux__
+    cpu_set_t cpu_set;
+    if(cpu < 0 || cpu >= CPU_SETSIZE) { return -1; }
+    CPU_ZERO(&cpu_set);
+    CPU_SET(cpu, &cpu_set);
+    return sched_setaffinity(0, sizeof(cpu_set), &cpu_set) == 0 ? 0 : -1;
+#else
+    (void) cpu;
+    return -1;
+#endif
+}
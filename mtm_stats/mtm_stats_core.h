@@ -19,6 +19,10 @@
 
 typedef unsigned int UINT32;
 typedef unsigned long int UINT64;
+typedef int INT32;
+typedef long long INT64;
+typedef unsigned short UINT16;
+typedef unsigned char UINT8;
 
 typedef struct {
     CONSTANT UINT32* locs;
@@ -32,6 +36,67 @@ typedef struct {
     UINT32 intersection_count;
 } IntersectionCount;
 
+// Hybrid (roaring-style) rows
+// A row is split into containers of 65536 bits (by the high 16 bits of b)
+// and each container is stored as whichever is the smallest:
+//   ROARING_ARRAY: the sorted low 16 bits of each value (size values in data)
+//   ROARING_BITMAP: ROARING_BITMAP_WORDS words (the next bitmap in bitmaps)
+//   ROARING_RUN: (start, length - 1) pairs of consecutive values (size values in data)
+// The containers of a row are sorted by key, and their data is stored
+// in the same order (so it is found by adding up the sizes)
+#define ROARING_ARRAY 0
+#define ROARING_BITMAP 1
+#define ROARING_RUN 2
+#define ROARING_BITMAP_WORDS 1024
+
+typedef struct {
+    CONSTANT UINT16* keys;
+    CONSTANT UINT8* types;
+    CONSTANT UINT16* sizes;
+    CONSTANT UINT16* data;
+    CONSTANT UINT64* bitmaps;
+    UINT32 len;
+} RoaringRow;
+
+// Optional similarity thresholds for the intersection counts kernels
+// Pairs that can't reach one of the thresholds (given the base counts)
+// are skipped without being intersected, and the rest are checked exactly
+// A threshold of 0 turns it off
+//   jaccard: ic / (count_i + count_j - ic)
+//   cosine: ic / sqrt(count_i * count_j)
+//   overlap: ic / min(count_i, count_j)
+// sorted_rows (the rows sorted by count) and sorted_counts (counts[sorted_rows])
+// let the kernels only visit the range of rows whose counts are close enough
+// (length filtering), they can be NULL
+typedef struct {
+    CONSTANT UINT32* counts;
+    CONSTANT INT32* sorted_rows;
+    CONSTANT UINT32* sorted_counts;
+    int num_counts; // length of counts, sorted_rows and sorted_counts
+    double min_jaccard;
+    double min_cosine;
+    double min_overlap;
+} SimilarityFilter;
+
+// Metrics for the top-k kernels
+#define TOPK_INTERSECTION 0
+#define TOPK_JACCARD 1
+
+// The derived set statistics of compute_pair_metrics
+// (the counts come first, see PAIR_METRIC_LAST_COUNT)
+#define PAIR_METRIC_UNION 0 // count_i + count_j - ic
+#define PAIR_METRIC_DIFFERENCE_IJ 1 // count_i - ic
+#define PAIR_METRIC_DIFFERENCE_JI 2 // count_j - ic
+#define PAIR_METRIC_SYMMETRIC_DIFFERENCE 3 // union - ic
+#define PAIR_METRIC_JACCARD 4 // ic / union
+#define PAIR_METRIC_COSINE 5 // ic / sqrt(count_i * count_j)
+#define PAIR_METRIC_OVERLAP 6 // ic / min(count_i, count_j)
+#define PAIR_METRIC_DICE 7 // 2 * ic / (count_i + count_j)
+#define PAIR_METRIC_LIFT 8 // ic * num_b / (count_i * count_j)
+#define PAIR_METRIC_PMI 9 // log(lift)
+#define PAIR_METRIC_LAST_COUNT PAIR_METRIC_SYMMETRIC_DIFFERENCE
+#define NUM_PAIR_METRICS 10
+
 void compute_counts(SparseBlockArray * sba_rows,
                     int chunk_length,
                     int num_rows,
@@ -43,7 +108,53 @@ int compute_intersection_counts(SparseBlockArray * sba_rows,
                                 int start_j,
                                 int num_rows,
                                 IntersectionCount * intersection_counts,
-                                int cutoff);
+                                int cutoff,
+                                CONSTANT SimilarityFilter * similarity_filter);
+
+int compute_intersection_counts_candidates(SparseBlockArray query,
+                                           SparseBlockArray * sba_rows,
+                                           int chunk_length,
+                                           int i,
+                                           int skip_j,
+                                           CONSTANT INT32 * candidates,
+                                           int num_candidates,
+                                           IntersectionCount * intersection_counts,
+                                           int cutoff);
+
+INT64 sort_row_bits(INT64 * bits,
+                    INT64 num_bits);
+
+INT64 count_row_blocks(CONSTANT INT64 * bits,
+                       INT64 num_bits,
+                       int chunk_length);
+
+void fill_row_blocks(CONSTANT INT64 * bits,
+                     INT64 num_bits,
+                     int chunk_length,
+                     UINT32 * locs,
+                     UINT64 * array);
+
+void compute_min_sums(SparseBlockArray * sba_rows,
+                      CONSTANT INT64 * row_offsets,
+                      CONSTANT INT64 * block_weight_offsets,
+                      CONSTANT double * weights,
+                      int chunk_length,
+                      CONSTANT IntersectionCount * intersection_counts,
+                      int num_intersection_counts,
+                      double * min_sums);
+
+int compute_intersection_counts_postings(CONSTANT INT64 * a_offsets,
+                                         CONSTANT INT32 * a_indices,
+                                         CONSTANT INT64 * b_offsets,
+                                         CONSTANT INT32 * b_indices,
+                                         int i,
+                                         int start_j,
+                                         int num_rows,
+                                         UINT32 * accumulator,
+                                         INT32 * touched,
+                                         IntersectionCount * intersection_counts,
+                                         int cutoff,
+                                         CONSTANT SimilarityFilter * similarity_filter);
 
 void compute_counts_dense_input(UINT64 * rows_arr,
                                 int chunk_length,
@@ -56,6 +167,66 @@ int compute_intersection_counts_dense_input(UINT64 * rows_arr,
                                             int start_j,
                                             int num_rows,
                                             IntersectionCount * intersection_counts,
-                                            int cutoff);
+                                            int cutoff,
+                                            CONSTANT SimilarityFilter * similarity_filter);
+
+int compute_topk(SparseBlockArray * sba_rows,
+                 int chunk_length,
+                 int i,
+                 int num_rows,
+                 CONSTANT UINT32 * counts,
+                 int metric,
+                 int k,
+                 INT32 * top_indices,
+                 double * top_scores,
+                 int cutoff);
+
+int compute_topk_dense_input(UINT64 * rows_arr,
+                             int chunk_length,
+                             int i,
+                             int num_rows,
+                             CONSTANT UINT32 * counts,
+                             int metric,
+                             int k,
+                             INT32 * top_indices,
+                             double * top_scores,
+                             int cutoff);
+
+int compute_topk_postings(CONSTANT INT64 * a_offsets,
+                          CONSTANT INT32 * a_indices,
+                          CONSTANT INT64 * b_offsets,
+                          CONSTANT INT32 * b_indices,
+                          int i,
+                          int num_rows,
+                          CONSTANT UINT32 * counts,
+                          int metric,
+                          int k,
+                          UINT32 * accumulator,
+                          INT32 * touched,
+                          INT32 * top_indices,
+                          double * top_scores,
+                          int cutoff);
+
+UINT32 roaring_and_count(RoaringRow a,
+                         RoaringRow b);
+
+int compute_intersection_counts_roaring(RoaringRow * rows,
+                                        int i,
+                                        int start_j,
+                                        int num_rows,
+                                        IntersectionCount * intersection_counts,
+                                        int cutoff,
+                                        CONSTANT SimilarityFilter * similarity_filter);
+
+void compute_pair_metrics(CONSTANT IntersectionCount * intersection_counts,
+                          INT64 num_intersection_counts,
+                          CONSTANT UINT32 * counts,
+                          double num_b,
+                          CONSTANT INT64 * metric_offsets,
+                          int double_precision,
+                          INT64 record_size,
+                          char * output);
+
+int pin_current_thread(int cpu);
 
 #endif
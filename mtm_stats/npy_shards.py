@@ -0,0 +1,88 @@
+'''Write mtm_stats results straight to disk as chunked .npy files
+so downstream jobs can memory-map them instead of rebuilding dicts'''
+from __future__ import absolute_import
+
+import os
+import json
+import numpy as np
+
+LABELS_FILENAME = 'setA.npy'
+BASE_COUNTS_FILENAME = 'base_counts.npy'
+SHARD_FILENAME_FORMAT = 'iu_counts_{:05d}.npy'
+MANIFEST_FILENAME = 'manifest.json'
+
+def as_fixed_width_labels(labels):
+    '''Convert an object array of labels that are all strings (or all
+       integers) to a fixed width numpy array (like '<U10' or int64),
+       so it can be saved and loaded without pickle
+       Any other labels are returned as they are'''
+    labels = np.asarray(labels)
+    if not labels.dtype.hasobject or labels.ndim != 1:
+        return labels
+    values = labels.tolist()
+    if (all(isinstance(v, str) for v in values) or
+        all(isinstance(v, int) and not isinstance(v, bool) for v in values)):
+        return np.array(values)
+    return labels
+
+class NpyShardSink(object):
+    '''A sink for mtm_stats_to_sink that writes everything into output_dir:
+         setA.npy: the labels for set A (i and j in the shards index into this)
+         base_counts.npy: the uint32 base counts for set A
+         iu_counts_00000.npy, iu_counts_00001.npy, ...:
+             one structured array (IU_COUNTS_DTYPE) per partition with the
+             fields i, j, intersection_count and union_count
+         manifest.json: the names of the shards of this run
+                        (written last, by close)
+
+       output_dir can be reused: the manifest of the last run gets
+       removed right away and load_npy_shards only reads the shards
+       listed in the new one, so leftover shards of an earlier (bigger)
+       run are never mixed in
+
+       Any object with the same three methods can be used as a sink'''
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.shard_paths = []
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def write_labels(self, setA, base_counts):
+        np.save(os.path.join(self.output_dir, LABELS_FILENAME), as_fixed_width_labels(setA))
+        np.save(os.path.join(self.output_dir, BASE_COUNTS_FILENAME), base_counts)
+
+    def write_partition(self, iu_counts_arr):
+        path = os.path.join(self.output_dir,
+                            SHARD_FILENAME_FORMAT.format(len(self.shard_paths)))
+        np.save(path, iu_counts_arr)
+        self.shard_paths.append(path)
+
+    def close(self):
+        '''Write the manifest
+           Returns the list of shard paths that were written'''
+        with open(os.path.join(self.output_dir, MANIFEST_FILENAME), 'w') as f:
+            json.dump({'num_shards': len(self.shard_paths),
+                       'shards': [os.path.basename(path) for path in self.shard_paths]}, f)
+        return self.shard_paths
+
+def load_npy_shards(output_dir, mmap_mode='r', allow_pickle=False):
+    '''Open the results written by NpyShardSink
+       (only the shards listed in its manifest)
+       The shards are memory-mapped (unless mmap_mode=None)
+       Labels that had to be pickled (anything but strings or numbers)
+       are only loaded with allow_pickle=True, like np.load, since
+       loading a pickle can run arbitrary code
+       Returns setA, base_counts, iu_counts_shards (a list of structured arrays)'''
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        raise IOError('no {} in {} (the run did not finish)'.format(MANIFEST_FILENAME, output_dir))
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    setA = np.load(os.path.join(output_dir, LABELS_FILENAME), allow_pickle=allow_pickle)
+    base_counts = np.load(os.path.join(output_dir, BASE_COUNTS_FILENAME), mmap_mode=mmap_mode)
+    iu_counts_shards = [np.load(os.path.join(output_dir, filename), mmap_mode=mmap_mode)
+                        for filename in manifest['shards']]
+    return setA, base_counts, iu_counts_shards
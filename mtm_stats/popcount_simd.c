@@ -0,0 +1,341 @@
+#include <string.h>
+#include "popcount_simd.h"
+
+#if defined(__GNUC__) && defined(__x86_64__)
+#define X86_DISPATCH
+#include <immintrin.h>
+#endif
+
+#define OP_NONE 0
+#define OP_AND 1
+#define OP_OR 2
+
+////////////////////////////////////////////////////////////////////////
+// Portable fallback
+////////////////////////////////////////////////////////////////////////
+
+static inline __attribute__((always_inline))
+UINT32 popcount_loop(CONSTANT UINT64* a_array,
+                     CONSTANT UINT64* b_array,
+                     int length,
+                     int op) {
+// Plain loop over POPCOUNT, gets inlined into the wrappers below
+// (so it uses whichever instructions their target allows)
+    int i;
+    UINT32 sum = 0;
+    if(op == OP_AND) {
+        for(i = 0; i < length; i++)
+            sum += POPCOUNT(a_array[i] & b_array[i]);
+    } else if(op == OP_OR) {
+        for(i = 0; i < length; i++)
+            sum += POPCOUNT(a_array[i] | b_array[i]);
+    } else {
+        for(i = 0; i < length; i++)
+            sum += POPCOUNT(a_array[i]);
+    }
+    return sum;
+}
+
+static UINT32 popcount_array_scalar(CONSTANT UINT64* a_array,
+                                    int length) {
+    return popcount_loop(a_array, NULL, length, OP_NONE);
+}
+
+static UINT32 popcount_and_array_scalar(CONSTANT UINT64* a_array,
+                                        CONSTANT UINT64* b_array,
+                                        int length) {
+    return popcount_loop(a_array, b_array, length, OP_AND);
+}
+
+static UINT32 popcount_or_array_scalar(CONSTANT UINT64* a_array,
+                                       CONSTANT UINT64* b_array,
+                                       int length) {
+    return popcount_loop(a_array, b_array, length, OP_OR);
+}
+
+#ifdef X86_DISPATCH
+
+////////////////////////////////////////////////////////////////////////
+// Same loops, but with the POPCNT instruction
+// (the extension is not built with -mpopcnt, so POPCOUNT is a libgcc call)
+////////////////////////////////////////////////////////////////////////
+
+#define TARGET_POPCNT __attribute__((target("popcnt")))
+
+TARGET_POPCNT
+static UINT32 popcount_array_popcnt(CONSTANT UINT64* a_array,
+                                    int length) {
+    return popcount_loop(a_array, NULL, length, OP_NONE);
+}
+
+TARGET_POPCNT
+static UINT32 popcount_and_array_popcnt(CONSTANT UINT64* a_array,
+                                        CONSTANT UINT64* b_array,
+                                        int length) {
+    return popcount_loop(a_array, b_array, length, OP_AND);
+}
+
+TARGET_POPCNT
+static UINT32 popcount_or_array_popcnt(CONSTANT UINT64* a_array,
+                                       CONSTANT UINT64* b_array,
+                                       int length) {
+    return popcount_loop(a_array, b_array, length, OP_OR);
+}
+
+////////////////////////////////////////////////////////////////////////
+// AVX2: Harley-Seal popcount (Mula, Kurz & Lemire)
+// 16 vectors at a time are reduced with a tree of carry-save adders
+// so only one vector popcount (nibble lookup + sad) is needed per 16
+////////////////////////////////////////////////////////////////////////
+
+#define TARGET_AVX2 __attribute__((target("avx2,popcnt")))
+
+TARGET_AVX2
+static inline __m256i avx2_load(CONSTANT UINT64* a_array,
+                                CONSTANT UINT64* b_array,
+                                int i,
+                                int op) {
+// Load the i'th vector of a (combined with b by op)
+    __m256i x = _mm256_loadu_si256((const __m256i *) (a_array + 4 * i));
+    if(op == OP_AND) {
+        x = _mm256_and_si256(x, _mm256_loadu_si256((const __m256i *) (b_array + 4 * i)));
+    } else if(op == OP_OR) {
+        x = _mm256_or_si256(x, _mm256_loadu_si256((const __m256i *) (b_array + 4 * i)));
+    }
+    return x;
+}
+
+TARGET_AVX2
+static inline __m256i avx2_popcount(__m256i x) {
+// Popcount of each 64-bit lane using a 4-bit lookup table
+    const __m256i lookup = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                            0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i low_mask = _mm256_set1_epi8(0x0f);
+    __m256i lo = _mm256_and_si256(x, low_mask);
+    __m256i hi = _mm256_and_si256(_mm256_srli_epi16(x, 4), low_mask);
+    __m256i counts = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo),
+                                     _mm256_shuffle_epi8(lookup, hi));
+    return _mm256_sad_epu8(counts, _mm256_setzero_si256());
+}
+
+TARGET_AVX2
+static inline void avx2_csa(__m256i * h, __m256i * l,
+                            __m256i a, __m256i b, __m256i c) {
+// Carry-save adder: h gets the carry bits and l the sum bits of a + b + c
+    __m256i u = _mm256_xor_si256(a, b);
+    *h = _mm256_or_si256(_mm256_and_si256(a, b), _mm256_and_si256(u, c));
+    *l = _mm256_xor_si256(u, c);
+}
+
+TARGET_AVX2
+static inline UINT32 avx2_harley_seal(CONSTANT UINT64* a_array,
+                                      CONSTANT UINT64* b_array,
+                                      int length,
+                                      int op) {
+    int i;
+    int num_vectors = length / 4;
+    __m256i total = _mm256_setzero_si256();
+    __m256i ones = _mm256_setzero_si256();
+    __m256i twos = _mm256_setzero_si256();
+    __m256i fours = _mm256_setzero_si256();
+    __m256i eights = _mm256_setzero_si256();
+    __m256i sixteens, twos_a, twos_b, fours_a, fours_b, eights_a, eights_b;
+    UINT64 lanes[4];
+    UINT32 sum;
+
+    for(i = 0; i + 16 <= num_vectors; i += 16) {
+        avx2_csa(&twos_a, &ones, ones, avx2_load(a_array, b_array, i, op), avx2_load(a_array, b_array, i + 1, op));
+        avx2_csa(&twos_b, &ones, ones, avx2_load(a_array, b_array, i + 2, op), avx2_load(a_array, b_array, i + 3, op));
+        avx2_csa(&fours_a, &twos, twos, twos_a, twos_b);
+        avx2_csa(&twos_a, &ones, ones, avx2_load(a_array, b_array, i + 4, op), avx2_load(a_array, b_array, i + 5, op));
+        avx2_csa(&twos_b, &ones, ones, avx2_load(a_array, b_array, i + 6, op), avx2_load(a_array, b_array, i + 7, op));
+        avx2_csa(&fours_b, &twos, twos, twos_a, twos_b);
+        avx2_csa(&eights_a, &fours, fours, fours_a, fours_b);
+        avx2_csa(&twos_a, &ones, ones, avx2_load(a_array, b_array, i + 8, op), avx2_load(a_array, b_array, i + 9, op));
+        avx2_csa(&twos_b, &ones, ones, avx2_load(a_array, b_array, i + 10, op), avx2_load(a_array, b_array, i + 11, op));
+        avx2_csa(&fours_a, &twos, twos, twos_a, twos_b);
+        avx2_csa(&twos_a, &ones, ones, avx2_load(a_array, b_array, i + 12, op), avx2_load(a_array, b_array, i + 13, op));
+        avx2_csa(&twos_b, &ones, ones, avx2_load(a_array, b_array, i + 14, op), avx2_load(a_array, b_array, i + 15, op));
+        avx2_csa(&fours_b, &twos, twos, twos_a, twos_b);
+        avx2_csa(&eights_b, &fours, fours, fours_a, fours_b);
+        avx2_csa(&sixteens, &eights, eights, eights_a, eights_b);
+        total = _mm256_add_epi64(total, avx2_popcount(sixteens));
+    }
+    total = _mm256_slli_epi64(total, 4);
+    total = _mm256_add_epi64(total, _mm256_slli_epi64(avx2_popcount(eights), 3));
+    total = _mm256_add_epi64(total, _mm256_slli_epi64(avx2_popcount(fours), 2));
+    total = _mm256_add_epi64(total, _mm256_slli_epi64(avx2_popcount(twos), 1));
+    total = _mm256_add_epi64(total, avx2_popcount(ones));
+
+    // Left-over vectors, then left-over words
+    for(; i < num_vectors; i++) {
+        total = _mm256_add_epi64(total, avx2_popcount(avx2_load(a_array, b_array, i, op)));
+    }
+    _mm256_storeu_si256((__m256i *) lanes, total);
+    sum = (UINT32) (lanes[0] + lanes[1] + lanes[2] + lanes[3]);
+    for(i = 4 * num_vectors; i < length; i++) {
+        if(op == OP_AND) {
+            sum += _mm_popcnt_u64(a_array[i] & b_array[i]);
+        } else if(op == OP_OR) {
+            sum += _mm_popcnt_u64(a_array[i] | b_array[i]);
+        } else {
+            sum += _mm_popcnt_u64(a_array[i]);
+        }
+    }
+    return sum;
+}
+
+TARGET_AVX2
+static UINT32 popcount_array_avx2(CONSTANT UINT64* a_array,
+                                  int length) {
+    return avx2_harley_seal(a_array, NULL, length, OP_NONE);
+}
+
+TARGET_AVX2
+static UINT32 popcount_and_array_avx2(CONSTANT UINT64* a_array,
+                                      CONSTANT UINT64* b_array,
+                                      int length) {
+    return avx2_harley_seal(a_array, b_array, length, OP_AND);
+}
+
+TARGET_AVX2
+static UINT32 popcount_or_array_avx2(CONSTANT UINT64* a_array,
+                                     CONSTANT UINT64* b_array,
+                                     int length) {
+    return avx2_harley_seal(a_array, b_array, length, OP_OR);
+}
+
+////////////////////////////////////////////////////////////////////////
+// AVX-512 VPOPCNTDQ: native popcount of 8 words at a time
+////////////////////////////////////////////////////////////////////////
+
+#define TARGET_AVX512 __attribute__((target("avx512f,avx512vpopcntdq")))
+
+TARGET_AVX512
+static inline UINT32 avx512_popcount(CONSTANT UINT64* a_array,
+                                     CONSTANT UINT64* b_array,
+                                     int length,
+                                     int op) {
+    int i;
+    __m512i x;
+    __m512i total = _mm512_setzero_si512();
+    __mmask8 mask;
+    for(i = 0; i + 8 <= length; i += 8) {
+        x = _mm512_loadu_si512((const void *) (a_array + i));
+        if(op == OP_AND) {
+            x = _mm512_and_si512(x, _mm512_loadu_si512((const void *) (b_array + i)));
+        } else if(op == OP_OR) {
+            x = _mm512_or_si512(x, _mm512_loadu_si512((const void *) (b_array + i)));
+        }
+        total = _mm512_add_epi64(total, _mm512_popcnt_epi64(x));
+    }
+    if(i < length) { // masked load for the left-over words
+        mask = (__mmask8) ((1u << (length - i)) - 1);
+        x = _mm512_maskz_loadu_epi64(mask, (const void *) (a_array + i));
+        if(op == OP_AND) {
+            x = _mm512_and_si512(x, _mm512_maskz_loadu_epi64(mask, (const void *) (b_array + i)));
+        } else if(op == OP_OR) {
+            x = _mm512_or_si512(x, _mm512_maskz_loadu_epi64(mask, (const void *) (b_array + i)));
+        }
+        total = _mm512_add_epi64(total, _mm512_popcnt_epi64(x));
+    }
+    return (UINT32) _mm512_reduce_add_epi64(total);
+}
+
+TARGET_AVX512
+static UINT32 popcount_array_avx512(CONSTANT UINT64* a_array,
+                                    int length) {
+    return avx512_popcount(a_array, NULL, length, OP_NONE);
+}
+
+TARGET_AVX512
+static UINT32 popcount_and_array_avx512(CONSTANT UINT64* a_array,
+                                        CONSTANT UINT64* b_array,
+                                        int length) {
+    return avx512_popcount(a_array, b_array, length, OP_AND);
+}
+
+TARGET_AVX512
+static UINT32 popcount_or_array_avx512(CONSTANT UINT64* a_array,
+                                       CONSTANT UINT64* b_array,
+                                       int length) {
+    return avx512_popcount(a_array, b_array, length, OP_OR);
+}
+
+#endif
+
+////////////////////////////////////////////////////////////////////////
+// Runtime dispatch
+////////////////////////////////////////////////////////////////////////
+
+typedef struct {
+    const char * name;
+    PopcountFunction popcount;
+    PopcountBinaryFunction popcount_and;
+    PopcountBinaryFunction popcount_or;
+} PopcountImpl;
+
+// In order from worst to best
+static const PopcountImpl popcount_impls[] = {
+    {"scalar", popcount_array_scalar, popcount_and_array_scalar, popcount_or_array_scalar},
+#ifdef X86_DISPATCH
+    {"popcnt", popcount_array_popcnt, popcount_and_array_popcnt, popcount_or_array_popcnt},
+    {"avx2", popcount_array_avx2, popcount_and_array_avx2, popcount_or_array_avx2},
+    {"avx512", popcount_array_avx512, popcount_and_array_avx512, popcount_or_array_avx512},
+#endif
+};
+
+#define NUM_POPCOUNT_IMPLS ((int) (sizeof(popcount_impls) / sizeof(PopcountImpl)))
+
+static int current_popcount_impl = 0;
+
+PopcountFunction popcount_array = popcount_array_scalar;
+PopcountBinaryFunction popcount_and_array = popcount_and_array_scalar;
+PopcountBinaryFunction popcount_or_array = popcount_or_array_scalar;
+
+int popcount_impl_supported(const char * name) {
+//Return 1 if the implementation exists and the CPU supports it, 0 otherwise
+    if(strcmp(name, "scalar") == 0) { return 1; }
+#ifdef X86_DISPATCH
+    __builtin_cpu_init();
+    if(strcmp(name, "popcnt") == 0) {
+        return __builtin_cpu_supports("popcnt") != 0;
+    }
+    if(strcmp(name, "avx2") == 0) {
+        return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("popcnt");
+    }
+    if(strcmp(name, "avx512") == 0) {
+        return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vpopcntdq");
+    }
+#endif
+    return 0;
+}
+
+int set_popcount_impl(const char * name) {
+//Switch to the named implementation
+//Return 0 on success, -1 if it is unknown or the CPU does not support it
+    int k;
+    if(!popcount_impl_supported(name)) { return -1; }
+    for(k = 0; k < NUM_POPCOUNT_IMPLS; k++) {
+        if(strcmp(name, popcount_impls[k].name) == 0) {
+            popcount_array = popcount_impls[k].popcount;
+            popcount_and_array = popcount_impls[k].popcount_and;
+            popcount_or_array = popcount_impls[k].popcount_or;
+            current_popcount_impl = k;
+            return 0;
+        }
+    }
+    return -1;
+}
+
+const char * get_popcount_impl(void) {
+    return popcount_impls[current_popcount_impl].name;
+}
+
+void init_popcount_dispatch(void) {
+//Select the best implementation this CPU supports
+    int k;
+    for(k = NUM_POPCOUNT_IMPLS - 1; k >= 0; k--) {
+        if(set_popcount_impl(popcount_impls[k].name) == 0) { return; }
+    }
+}
@@ -0,0 +1,38 @@
+#ifndef POPCOUNT_SIMD_H
+#define POPCOUNT_SIMD_H
+
+#include "mtm_stats_core.h"
+
+// Vectorized popcount kernels with runtime dispatch
+// The best implementation the CPU supports gets selected by
+// init_popcount_dispatch (called when the python module is imported)
+// Available implementations (best last):
+//   "scalar": portable loop over POPCOUNT
+//   "popcnt": same loop compiled to use the POPCNT instruction
+//   "avx2": Harley-Seal carry-save adder popcount over 256-bit vectors
+//   "avx512": AVX-512 VPOPCNTDQ over 512-bit vectors
+
+// Arrays shorter than this (in 64-bit words) are not worth dispatching
+#define SIMD_MIN_LENGTH 8
+
+typedef UINT32 (*PopcountFunction)(CONSTANT UINT64* a_array,
+                                   int length);
+
+typedef UINT32 (*PopcountBinaryFunction)(CONSTANT UINT64* a_array,
+                                         CONSTANT UINT64* b_array,
+                                         int length);
+
+// popcount(a), popcount(a & b) and popcount(a | b) summed over the arrays
+extern PopcountFunction popcount_array;
+extern PopcountBinaryFunction popcount_and_array;
+extern PopcountBinaryFunction popcount_or_array;
+
+void init_popcount_dispatch(void);
+
+int popcount_impl_supported(const char * name);
+
+int set_popcount_impl(const char * name);
+
+const char * get_popcount_impl(void);
+
+#endif
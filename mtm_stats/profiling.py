@@ -0,0 +1,107 @@
+'''Opt-in instrumentation of the stages of mtm_stats
+
+Pass a Profiler as profiler= to mtm_stats, mtm_stats_raw or
+mtm_stats_from_ids and every stage gets a record with its wall time
+and counters:
+  extraction: the sorted sets (num_a, num_b, num_connections)
+  mapping: the index of every connection into the sets
+           (part of extraction for array-shaped connections)
+  planning: the density stats and the choice of engine
+  compression: building the rows (engine, bytes_allocated)
+  base_counts: counting the bits of each row
+  intersections: the kernel, with the counters from the Cython wrappers
+                 (kernel_time, gather_time (the copies out of the thread
+                  buffers), thread_time (the busy time of each thread),
+                  pairs_evaluated, pairs_emitted, pairs_cut_off,
+                  max_block_merge_steps for engine='sba', and
+                  bytes_allocated for the thread buffers and the output)
+  output: converting the results (to dicts, or to an IU_COUNTS_DTYPE array)
+With profiler=None (the default) each stage costs one no-op "with"
+and none of the counters get computed
+'''
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+
+# The counters that _mtm_intersection_counts copies from the kernel stats
+KERNEL_COUNTERS = ('kernel_time', 'gather_time', 'pairs_evaluated',
+                   'pairs_emitted', 'pairs_cut_off', 'buffer_bytes',
+                   'output_bytes', 'max_block_merge_steps', 'num_threads',
+                   'schedule', 'imbalance')
+
+class Profiler(object):
+    '''Collects a record (a dictionary) for each stage that runs,
+       with at least the 'stage' name and its 'wall_time' in seconds
+       callback (optional) gets called with each record as its stage ends
+
+       Example:
+           profiler = Profiler()
+           mtm_stats(connections, profiler=profiler)
+           report = profiler.get_report()
+           report['wall_time']['intersections']
+       '''
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+
+    def stage(self, name):
+        '''A context manager that times a stage, "as" gives its record
+           so the counters can be added to it'''
+        return _Stage(self, name)
+
+    def _finish(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def get_report(self):
+        '''Returns a dictionary with:
+             stages: all the records, in the order they finished
+             wall_time: the total time of each stage name
+             total_time: the time of all the stages
+             bytes_allocated: the total of the stages that report it'''
+        wall_time = {}
+        for record in self.records:
+            wall_time[record['stage']] = wall_time.get(record['stage'], 0.0) + record['wall_time']
+        return {'stages': list(self.records),
+                'wall_time': wall_time,
+                'total_time': sum(wall_time.values()),
+                'bytes_allocated': sum(record.get('bytes_allocated', 0) for record in self.records)}
+
+    def clear(self):
+        self.records = []
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.record = {'stage': name}
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self.record
+
+    def __exit__(self, *args):
+        self.record['wall_time'] = time.time() - self.start_time
+        self.profiler._finish(self.record)
+        return False
+
+class _NullStage(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def profile_stage(profiler, name):
+    '''profiler.stage(name), or a stage that does nothing (and gives
+       None instead of a record) when profiler is None'''
+    return _NULL_STAGE if profiler is None else profiler.stage(name)
+
+def get_nbytes(rows):
+    '''Size of an array, or of all the arrays in a dictionary of arrays'''
+    if isinstance(rows, dict):
+        return sum(get_nbytes(arr) for arr in rows.values())
+    return getattr(rows, 'nbytes', 0)
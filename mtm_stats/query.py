@@ -0,0 +1,110 @@
+'''A resident index for online "items similar to X" queries
+
+The rows get built once (or mapped from an index file, see index_file)
+and then each query only intersects the query rows with the candidates
+it asks for, see cy_mtm_stats.cy_compute_intersection_counts_query'''
+from __future__ import absolute_import
+
+import numpy as np
+
+from .mtm_stats import _mtm_common, get_iu_counts_array, IU_COUNTS_DTYPE
+from .sparse_block_array import sba_compress_64_index_arrays
+from .index_file import load_index, write_index
+from . import cy_mtm_stats
+
+class MtmIndex(object):
+    '''Holds setA, setB, the base counts and the packed SBA rows
+       so that queries don't pay for any of the setup
+
+       Queries take labels of A (query and query_b_set) or row indices
+       (query_indices), and the candidates to compare against are a list of
+       labels / row indices or None for all the rows
+       Every query returns a single IU_COUNTS_DTYPE array (see
+       get_iu_counts_array) where i and j are row indices (setA[j] is the label)
+
+       A single query runs on the calling thread (no OpenMP team),
+       a list of queries runs in context (an ExecutionContext, or a new
+       one for each call if None)
+
+       Example:
+           index = MtmIndex.from_connections(connections)
+           iu_counts = index.query('a1')
+           neighbours = index.setA[iu_counts['j']]
+       '''
+    def __init__(self, setA, setB, base_counts, sba_packed, chunk_length_64=1, context=None):
+        self.setA = setA
+        self.setB = setB
+        self.base_counts = np.asarray(base_counts, dtype=np.uint32)
+        self.sba_packed = cy_mtm_stats._as_sba_packed(sba_packed, chunk_length_64)
+        self.chunk_length_64 = chunk_length_64
+        self.context = context
+
+    @classmethod
+    def from_connections(cls, connections, chunk_length_64=1, context=None):
+        '''Build the index from connections (see _mtm_common)'''
+        setA, setB, base_counts, sba_packed, plan = _mtm_common(connections, chunk_length_64, False, 'sba', context=context)
+        return cls(setA, setB, base_counts, sba_packed, plan['chunk_length_64'], context)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', context=None, allow_pickle=False):
+        '''Open an index file (see index_file.load_index)'''
+        setA, setB, base_counts, sba_packed, chunk_length_64 = load_index(path, mmap_mode, allow_pickle)
+        return cls(setA, setB, base_counts, sba_packed, chunk_length_64, context)
+
+    def save(self, path):
+        '''Write the index to an index file (see index_file.write_index)'''
+        return write_index(path, self.setA, self.setB, self.base_counts, self.sba_packed, self.chunk_length_64)
+
+    def __len__(self):
+        return len(self.base_counts)
+
+    def _get_indices(self, labels, sorted_labels):
+        '''Row indices of labels in a sorted label array (setA or setB)
+           Returns the indices and a mask of which labels were found'''
+        labels = np.asarray(labels)
+        indices = np.searchsorted(sorted_labels, labels)
+        found = indices < len(sorted_labels)
+        found[found] = sorted_labels[indices[found]] == labels[found]
+        return indices, found
+
+    def get_rows(self, labels):
+        '''Row indices of labels of A (raises KeyError if any are missing)'''
+        rows, found = self._get_indices(np.atleast_1d(labels), self.setA)
+        if not found.all():
+            raise KeyError(np.atleast_1d(labels)[~found][0])
+        return rows
+
+    def _get_candidates(self, candidates):
+        return None if candidates is None else self.get_rows(candidates)
+
+    def query_indices(self, rows, candidates=None, cutoff=0):
+        '''Intersection and union counts of each row in rows
+           (row indices) against the candidate row indices (None for all)
+           Each row is left out of its own results'''
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts_query(self.sba_packed, self.chunk_length_64, np.atleast_1d(rows), None, candidates, cutoff, self.context)
+        return get_iu_counts_array(self.base_counts, intersection_counts)
+
+    def query(self, a, candidates=None, cutoff=0):
+        '''Same as query_indices, but with a label (or list of labels) of A
+           and the candidates as labels of A'''
+        return self.query_indices(self.get_rows(a), self._get_candidates(candidates), cutoff)
+
+    def query_b_set(self, b_set, candidates=None, cutoff=0):
+        '''Intersection and union counts of an external set of B's
+           (that doesn't need to be one of the rows) against the candidates
+           B's that are not in setB can't intersect anything,
+           but they still count towards the unions
+           i is always 0 in the results'''
+        b_set = list(b_set)
+        b_set = np.unique(np.asarray(b_set) if len(b_set) else np.zeros(0, dtype=self.setB.dtype))
+        ib, found = self._get_indices(b_set, self.setB)
+        query_rows = sba_compress_64_index_arrays(np.zeros(found.sum(), dtype=np.int64), ib[found], 1, self.chunk_length_64)
+        intersection_counts = cy_mtm_stats.cy_compute_intersection_counts_query(self.sba_packed, self.chunk_length_64, None, query_rows, self._get_candidates(candidates), cutoff, self.context)
+        intersection_counts = intersection_counts['intersection_counts']
+        iu_counts = np.empty(len(intersection_counts), dtype=IU_COUNTS_DTYPE)
+        iu_counts['i'] = 0
+        iu_counts['j'] = intersection_counts['j']
+        iu_counts['intersection_count'] = intersection_counts['intersection_count']
+        iu_counts['union_count'] = (len(b_set) + self.base_counts[intersection_counts['j']] -
+                                    intersection_counts['intersection_count'])
+        return iu_counts
@@ -0,0 +1,205 @@
+'''Renumber setB (and optionally setA) so that the B's that show up together
+fall into the same SBA blocks
+
+The SBA only stores the non-zero blocks of 64 * chunk_length_64 bits of
+each row, and by default the bit of each B is its position in sorted
+label order, which has nothing to do with which B's co-occur
+Each method here picks a new bit position for every B:
+  'degree': the most connected B's first (so they share a few dense blocks)
+  'minhash': B's with similar sets of A's next to each other
+             (sorted by a few minhash values of their sets of A's)
+  'rcm': reverse Cuthill-McKee on the bipartite A-B graph
+         (a bandwidth reducing order, the A's get an order too)
+
+The intersection counts don't depend on the order of the bits,
+and mtm_stats_reordered_raw maps the rows back to the original setA,
+so the results are exactly the same as mtm_stats_raw
+'''
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+import numpy as np
+
+from .mtm_stats import (extract_indices, convert_indices_to_sba_packed,
+                        get_block_stats, _mtm_intersection_counts,
+                        get_base_counts_dict, get_iu_counts_dict)
+from . import cy_mtm_stats
+
+REORDER_METHODS = ('degree', 'minhash', 'rcm')
+
+# Number of minhash values used to sort the B's with method='minhash'
+NUM_MINHASHES = 4
+MINHASH_PRIME = 2 ** 31 - 1
+
+def _get_ranks(order):
+    '''The new index of each old index (the inverse of the permutation order)'''
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return ranks
+
+def _degree_order(ia, ib, num_a, num_b):
+    degrees = np.bincount(ib, minlength=num_b)
+    return np.argsort(-degrees, kind='stable')
+
+def _minhash_order(ia, ib, num_a, num_b, seed=0):
+    random_state = np.random.RandomState(seed)
+    a_mult = random_state.randint(1, MINHASH_PRIME, size=NUM_MINHASHES).astype(np.int64)
+    a_add = random_state.randint(0, MINHASH_PRIME, size=NUM_MINHASHES).astype(np.int64)
+    hashes = (ia[:, None] * a_mult + a_add) % MINHASH_PRIME
+    
+    # The minimum hash of the A's of each B (the B's without any A's go last)
+    order = np.argsort(ib, kind='stable')
+    ib_sorted = ib[order]
+    starts = np.flatnonzero(np.r_[True, ib_sorted[1:] != ib_sorted[:-1]]) if len(ib) else np.zeros(0, dtype=np.int64)
+    signatures = np.full((num_b, NUM_MINHASHES), MINHASH_PRIME, dtype=np.int64)
+    if len(ib):
+        signatures[ib_sorted[starts]] = np.minimum.reduceat(hashes[order], starts, axis=0)
+    degrees = np.bincount(ib, minlength=num_b)
+    return np.lexsort((-degrees,) + tuple(signatures[:, k] for k in reversed(range(NUM_MINHASHES))))
+
+def _rcm_order(ia, ib, num_a, num_b):
+    '''Reverse Cuthill-McKee on the bipartite graph with nodes
+       0 .. num_a - 1 for A and num_a .. num_a + num_b - 1 for B
+       Each level of the breadth first search is done all at once:
+       the new nodes are sorted by the position of their parent
+       and then by degree, and every connected component starts
+       at its node with the smallest degree
+       Returns the order of the A's and the order of the B's'''
+    num_nodes = num_a + num_b
+    keys = np.unique(ia * max(num_b, 1) + ib)
+    ia, ib = keys // max(num_b, 1), keys % max(num_b, 1)
+    sources = np.r_[ia, ib + num_a]
+    targets = np.r_[ib + num_a, ia]
+    order = np.argsort(sources, kind='stable')
+    neighbours = targets[order]
+    degrees = np.bincount(sources, minlength=num_nodes)
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    
+    visited = np.zeros(num_nodes, dtype=bool)
+    by_degree = np.argsort(degrees, kind='stable')
+    next_start = 0
+    num_visited = 0
+    result = []
+    while num_visited < num_nodes:
+        while visited[by_degree[next_start]]:
+            next_start += 1
+        frontier = by_degree[next_start:next_start + 1]
+        visited[frontier] = True
+        while len(frontier):
+            result.append(frontier)
+            num_visited += len(frontier)
+            counts = degrees[frontier]
+            parents = np.repeat(np.arange(len(frontier)), counts)
+            edge_positions = (np.repeat(offsets[frontier] - np.cumsum(counts) + counts, counts) +
+                              np.arange(counts.sum()))
+            candidates = neighbours[edge_positions]
+            new = ~visited[candidates]
+            candidates, parents = candidates[new], parents[new]
+            candidates = candidates[np.lexsort((degrees[candidates], parents))]
+            candidates = candidates[np.sort(np.unique(candidates, return_index=True)[1])]
+            visited[candidates] = True
+            frontier = candidates
+    nodes = np.concatenate(result)[::-1] if result else np.zeros(0, dtype=np.int64)
+    return nodes[nodes < num_a], nodes[nodes >= num_a] - num_a
+
+def get_reorder_permutations(ia, ib, num_a, num_b, method='degree', reorder_a=False, seed=0):
+    '''Pick the new order of setB (and setA if reorder_a)
+       ia and ib are the connections as index arrays (see extract_indices)
+       With the methods that only order the B's, the A's get sorted by
+       the new position of their first B
+       Returns a_order and b_order, the old index at each new position
+       (a_order is np.arange(num_a) unless reorder_a)'''
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+    if method == 'rcm':
+        a_order, b_order = _rcm_order(ia, ib, num_a, num_b)
+    elif method == 'minhash':
+        b_order = _minhash_order(ia, ib, num_a, num_b, seed)
+    elif method == 'degree':
+        b_order = _degree_order(ia, ib, num_a, num_b)
+    else:
+        raise ValueError('method must be one of {}, not {!r}'.format(REORDER_METHODS, method))
+    if not reorder_a:
+        a_order = np.arange(num_a)
+    elif method != 'rcm':
+        first_b = np.full(num_a, num_b, dtype=np.int64)
+        np.minimum.at(first_b, ia, _get_ranks(b_order)[ib])
+        a_order = np.argsort(first_b, kind='stable')
+    return a_order, b_order
+
+def reorder_indices(ia, ib, a_order, b_order):
+    '''Renumber the connections with the orders from get_reorder_permutations'''
+    return (_get_ranks(a_order)[np.asarray(ia, dtype=np.int64)],
+            _get_ranks(b_order)[np.asarray(ib, dtype=np.int64)])
+
+def _restore_a_order(intersection_counts, a_order, num_a):
+    '''Map packed intersection counts on reordered rows back to the original
+       rows (i < j, sorted by i and then j, like upper_only in mtm_stats_raw)
+       Returns a list with one array per original row'''
+    intersection_counts = intersection_counts['intersection_counts'].copy()
+    i = a_order[intersection_counts['i']]
+    j = a_order[intersection_counts['j']]
+    intersection_counts['i'] = np.minimum(i, j)
+    intersection_counts['j'] = np.maximum(i, j)
+    intersection_counts = intersection_counts[np.lexsort((intersection_counts['j'], intersection_counts['i']))]
+    splits = np.searchsorted(intersection_counts['i'], np.arange(1, num_a))
+    return np.split(intersection_counts, splits)
+
+def mtm_stats_reordered_raw(connections, method='degree', reorder_a=False, chunk_length_64=1, cutoff=0, seed=0, stats=None, context=None):
+    '''Same as mtm_stats_raw (with all the rows, upper_only), but the
+       SBA is built with the B's (and the A's if reorder_a) renumbered
+       by get_reorder_permutations
+       stats (a dictionary) gets the 'num_blocks_before' and 'num_blocks_after'
+       Returns:
+           setA, setB, base_counts, intersection_counts_list
+       all in the original order of setA and setB'''
+    setA, setB, ia, ib = extract_indices(connections)
+    a_order, b_order = get_reorder_permutations(ia, ib, len(setA), len(setB), method, reorder_a, seed)
+    new_ia, new_ib = reorder_indices(ia, ib, a_order, b_order)
+    sba_packed = convert_indices_to_sba_packed(new_ia, new_ib, len(setA), chunk_length_64, context)
+    base_counts = cy_mtm_stats.cy_compute_counts(sba_packed, chunk_length_64, context)
+    intersection_counts = _mtm_intersection_counts(sba_packed, chunk_length_64, cutoff=cutoff, engine='sba',
+                                                   packed_output=reorder_a, stats=stats, context=context)
+    if reorder_a:
+        base_counts = base_counts[_get_ranks(a_order)]
+        intersection_counts = _restore_a_order(intersection_counts, a_order, len(setA))
+    if stats is not None:
+        stats['num_blocks_before'] = get_block_stats(ia, ib, len(setA), len(setB), (chunk_length_64,))[chunk_length_64]['num_blocks']
+        stats['num_blocks_after'] = len(sba_packed['locs'])
+    return setA, setB, base_counts, intersection_counts
+
+def mtm_stats_reordered(connections, method='degree', reorder_a=False, chunk_length_64=1, cutoff=0, seed=0, stats=None, context=None):
+    '''Get base counts and intersection counts (same as mtm_stats)
+       using mtm_stats_reordered_raw'''
+    setA, setB, base_counts, intersection_counts_list = mtm_stats_reordered_raw(connections, method, reorder_a, chunk_length_64, cutoff, seed, stats, context)
+    return (get_base_counts_dict(base_counts, setA),
+            get_iu_counts_dict(base_counts, intersection_counts_list, setA))
+
+def get_reorder_report(connections, methods=REORDER_METHODS, reorder_a=False, chunk_length_64=1, cutoff=0, seed=0, context=None):
+    '''Compare the SBA size and kernel time of each method against the
+       original order ('none')
+       Returns a dictionary of {method: report} where each report has:
+         num_blocks: the number of non-zero SBA blocks
+         sba_nbytes: the size of the packed SBA
+         compression_ratio: the size of the dense rows over sba_nbytes
+         kernel_time: seconds to compute all the intersection counts'''
+    setA, setB, ia, ib = extract_indices(connections)
+    dense_nbytes = len(setA) * int(np.ceil(len(setB) / 64)) * 8
+    reports = {}
+    for method in ('none',) + tuple(methods):
+        if method == 'none':
+            new_ia, new_ib = ia, ib
+        else:
+            new_ia, new_ib = reorder_indices(ia, ib, *get_reorder_permutations(ia, ib, len(setA), len(setB), method, reorder_a, seed))
+        sba_packed = convert_indices_to_sba_packed(new_ia, new_ib, len(setA), chunk_length_64, context)
+        sba_nbytes = sum(arr.nbytes for arr in sba_packed.values())
+        start_time = time.time()
+        _mtm_intersection_counts(sba_packed, chunk_length_64, cutoff=cutoff, engine='sba',
+                                 packed_output=True, context=context)
+        reports[method] = {'num_blocks': len(sba_packed['locs']),
+                           'sba_nbytes': sba_nbytes,
+                           'compression_ratio': dense_nbytes / max(sba_nbytes, 1),
+                           'kernel_time': time.time() - start_time}
+    return reports
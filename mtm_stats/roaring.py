@@ -0,0 +1,192 @@
+'''Hybrid (roaring-style) row compression
+
+Each row is split into containers of 65536 bits (by the high 16 bits
+of each index) and each container is stored as whichever is the smallest:
+  ROARING_ARRAY: the sorted low 16 bits of the indices (uint16)
+  ROARING_BITMAP: a full 1024-word bitmap (uint64)
+  ROARING_RUN: (start, length - 1) pairs of consecutive indices (uint16)
+
+Scattered bits cost 2 bytes each (plus 5 bytes per container) instead of
+a whole chunk_length_64 block and a 32-bit loc like in the SBA,
+and dense regions still get a bitmap (or runs)
+
+The roaring engine is only meant for rows made of long runs, where each
+run container merges in a few steps and it beats every other engine
+On power-law or clustered rows it is slower than the SBA with a long
+chunk_length_64, even when the roaring rows are smaller, and on rows
+spread thinly over a very wide B the postings engine is much faster
+
+A "packed roaring" dictionary has (like a packed SBA, one entry per row
+in the offsets arrays):
+  offsets: int64 (num_rows + 1), the containers of each row
+  keys: uint16, the high 16 bits of each container
+  types: uint8, the type of each container (ROARING_ARRAY, ...)
+  sizes: uint16, the number of uint16 values each container has in data
+         (0 for bitmaps)
+  data_offsets: int64 (num_rows + 1), where each row starts in data
+  data: uint16, the values of the array and run containers
+  bitmap_offsets: int64 (num_rows + 1), where each row starts in bitmaps
+  bitmaps: uint64 (num_bitmaps, 1024), the bitmap containers
+
+The data of each row is in the same order as its containers, so the C
+kernels find it by adding up the sizes (see RoaringRow in mtm_stats_core.h)
+'''
+from __future__ import division
+
+import numpy as np
+
+ROARING_ARRAY = 0
+ROARING_BITMAP = 1
+ROARING_RUN = 2
+
+CONTAINER_BITS = 65536
+BITMAP_WORDS = CONTAINER_BITS // 64
+
+ROARING_ARRAYS = ('offsets', 'keys', 'types', 'sizes',
+                  'data_offsets', 'data', 'bitmap_offsets', 'bitmaps')
+
+def _split_containers(row_indices, bit_indices):
+    '''Sort the (row, bit) pairs (dropping duplicates), split them into
+       containers and pick the smallest type for each one (in uint16's:
+       array = cardinality, bitmap = 4096, run = 2 per run)
+       (shared by roaring_compress_index_arrays and get_container_stats)
+       Returns the highs and lows of the sorted bits, then for each container
+       where it starts in them, its rows and types and the number of uint16
+       values it has in data, and for each bit its container and whether
+       it starts a run'''
+    row_indices = np.asarray(row_indices, dtype=np.int64)
+    bit_indices = np.asarray(bit_indices, dtype=np.int64)
+    
+    # Sort once by (row, bit) and drop duplicate connections at the same time
+    stride = int(bit_indices.max()) + 1 if len(bit_indices) else 1
+    keys = np.unique(row_indices * stride + bit_indices)
+    rows = keys // stride
+    bits = keys % stride
+    highs = bits >> 16
+    lows = bits & 0xffff
+    
+    # Each new (row, high) pair starts a new container
+    new_container = np.ones(len(keys), dtype=bool)
+    new_container[1:] = (rows[1:] != rows[:-1]) | (highs[1:] != highs[:-1])
+    container_starts = np.flatnonzero(new_container)
+    container_ids = np.cumsum(new_container) - 1
+    cardinalities = np.diff(np.r_[container_starts, len(keys)])
+    
+    # Runs of consecutive values inside each container
+    new_run = new_container.copy()
+    new_run[1:] |= lows[1:] != lows[:-1] + 1
+    num_runs = np.bincount(container_ids[new_run], minlength=len(container_starts))
+    
+    # Pick the smallest type
+    types = np.where(cardinalities <= 4 * BITMAP_WORDS, ROARING_ARRAY, ROARING_BITMAP)
+    types[2 * num_runs < np.minimum(cardinalities, 4 * BITMAP_WORDS)] = ROARING_RUN
+    types = types.astype(np.uint8)
+    sizes = np.select([types == ROARING_ARRAY, types == ROARING_RUN],
+                      [cardinalities, 2 * num_runs], 0).astype(np.int64)
+    return highs, lows, container_starts, rows[container_starts], types, sizes, container_ids, new_run
+
+def roaring_compress_index_arrays(row_indices, bit_indices, num_rows):
+    '''Compress many rows of indices into a packed roaring dictionary
+    
+    row_indices and bit_indices are parallel integer arrays with one
+    entry per set bit (duplicates are allowed and are simply merged)
+    Same as sba_compress_64_index_arrays, everything is done with bulk
+    numpy operations (one sort, no per-row loops)
+    '''
+    (highs, lows, container_starts, container_rows,
+     types, sizes, container_ids, new_run) = _split_containers(row_indices, bit_indices)
+    run_starts = np.flatnonzero(new_run)
+    
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(container_rows, minlength=num_rows), out=offsets[1:])
+    data_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(container_rows, weights=sizes, minlength=num_rows).astype(np.int64),
+              out=data_offsets[1:])
+    is_bitmap = types == ROARING_BITMAP
+    bitmap_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(container_rows[is_bitmap], minlength=num_rows), out=bitmap_offsets[1:])
+    
+    # The array and run values go right where each container starts in data
+    # (the containers are already in order, so that's a cumsum of the sizes)
+    data_starts = np.cumsum(sizes) - sizes
+    data = np.zeros(int(sizes.sum()), dtype=np.uint16)
+    in_array = (types == ROARING_ARRAY)[container_ids]
+    array_positions = (data_starts[container_ids] +
+                       np.arange(len(lows)) - container_starts[container_ids])
+    data[array_positions[in_array]] = lows[in_array]
+    run_containers = container_ids[run_starts]
+    in_run = types[run_containers] == ROARING_RUN
+    run_ranks = np.arange(len(run_starts)) - np.searchsorted(run_starts, container_starts)[run_containers]
+    run_lengths = np.diff(np.r_[run_starts, len(lows)])
+    run_positions = data_starts[run_containers] + 2 * run_ranks
+    data[run_positions[in_run]] = lows[run_starts[in_run]]
+    data[run_positions[in_run] + 1] = run_lengths[in_run] - 1
+    
+    # Set the bits of the bitmap containers
+    bitmap_ids = np.cumsum(is_bitmap) - 1
+    in_bitmap = is_bitmap[container_ids]
+    bitmap_bits = np.zeros(int(is_bitmap.sum()) * CONTAINER_BITS, dtype=bool)
+    bitmap_bits[bitmap_ids[container_ids[in_bitmap]] * CONTAINER_BITS + lows[in_bitmap]] = True
+    bitmaps = np.packbits(bitmap_bits, bitorder='little').view(np.uint64).reshape(-1, BITMAP_WORDS)
+    
+    return {'offsets': offsets,
+            'keys': highs[container_starts].astype(np.uint16),
+            'types': types,
+            'sizes': sizes.astype(np.uint16),
+            'data_offsets': data_offsets,
+            'data': data,
+            'bitmap_offsets': bitmap_offsets,
+            'bitmaps': bitmaps}
+
+def get_container_stats(row_indices, bit_indices, num_rows, num_bits):
+    '''Count the containers that roaring_compress_index_arrays would make
+       (without building them), for the cost model of engine='auto'
+       Returns a dictionary with:
+         num_containers: the number of containers in all the rows
+         sum_sq_containers: sum of the squares of the containers per row
+         num_columns: the number of container keys (containers in a full row)
+         values_x_containers: sum over the rows of the array values and runs
+                              in the row times the containers of all the other rows
+         bitmaps_x_containers: the same with the bitmap containers of each row
+       (comparing two matching containers costs about their values or runs,
+        or a pass over the words of a bitmap when both are bitmaps)'''
+    container_rows, types, sizes = _split_containers(row_indices, bit_indices)[3:6]
+    num_containers = len(container_rows)
+    containers_per_row = np.bincount(container_rows, minlength=num_rows).astype(np.float64)
+    values_per_row = np.bincount(container_rows, weights=np.where(types == ROARING_RUN, sizes // 2, sizes),
+                                 minlength=num_rows)
+    bitmaps_per_row = np.bincount(container_rows, weights=types == ROARING_BITMAP, minlength=num_rows)
+    other_containers = num_containers - containers_per_row
+    return {'num_containers': num_containers,
+            'sum_sq_containers': float((containers_per_row ** 2).sum()),
+            'num_columns': int(np.ceil(num_bits / CONTAINER_BITS)),
+            'values_x_containers': float((values_per_row * other_containers).sum()),
+            'bitmaps_x_containers': float((bitmaps_per_row * other_containers).sum())}
+
+def roaring_decompress_row(roaring_packed, i):
+    '''Get the sorted indices of the bits set in row i'''
+    indices = []
+    data_position = roaring_packed['data_offsets'][i]
+    bitmap_position = roaring_packed['bitmap_offsets'][i]
+    for k in range(roaring_packed['offsets'][i], roaring_packed['offsets'][i + 1]):
+        high = int(roaring_packed['keys'][k]) << 16
+        container_type = roaring_packed['types'][k]
+        size = int(roaring_packed['sizes'][k])
+        values = roaring_packed['data'][data_position:data_position + size].astype(np.int64)
+        if container_type == ROARING_ARRAY:
+            lows = values
+        elif container_type == ROARING_RUN:
+            lows = np.concatenate([np.arange(start, start + length + 1)
+                                   for start, length in values.reshape(-1, 2)])
+        else:
+            bitmap = roaring_packed['bitmaps'][bitmap_position]
+            lows = np.flatnonzero(np.unpackbits(bitmap.view(np.uint8), bitorder='little'))
+            bitmap_position += 1
+        data_position += size
+        indices.append(high + lows)
+    return np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+
+def roaring_nbytes(roaring_packed):
+    '''Total size of all the arrays in a packed roaring dictionary
+       (or any other dictionary of arrays, like a packed SBA)'''
+    return sum(arr.nbytes for arr in roaring_packed.values())
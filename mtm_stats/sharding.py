@@ -0,0 +1,266 @@
+'''Split the upper-triangular A x A pair space into tiles and run them
+in several processes (or on several machines that share a directory)
+
+The steps are:
+  * plan_shards: split the pairs into tiles balanced by per-row nnz
+                 and group the tiles into shards
+  * save_sba_store: write the packed SBA rows once so that every worker
+                    can memory-map them instead of getting a copy
+  * run_shard: compute the intersection counts for the tiles of one shard
+               (also available as a command line worker, see main)
+  * merge_shard_outputs: put the outputs back together in the same
+                         order as mtm_stats_raw
+
+mtm_stats_sharded does all of it locally with a ProcessPoolExecutor
+(or with the worker command, runner='subprocess')
+
+Example worker command (once the store and the plan are saved):
+    python -m mtm_stats.sharding STORE_DIR PLAN_PATH SHARD_INDEX OUTPUT_PATH
+'''
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+from .mtm_stats import (_mtm_common, _mtm_intersection_counts,
+                        get_base_counts_dict, get_iu_counts_dict,
+                        ExecutionContext, get_default_num_threads)
+from .npy_shards import as_fixed_width_labels
+from . import cy_mtm_stats
+
+STORE_META_FILENAME = 'meta.json'
+STORE_ARRAYS = ('offsets', 'locs', 'array', 'base_counts', 'setA')
+PLAN_FILENAME = 'plan.json'
+SHARD_OUTPUT_FILENAME_FORMAT = 'shard_{:05d}.npy'
+
+# Fixed cost of a single pair (relative to one nnz of a row) in the planner
+PAIR_OVERHEAD = 1.0
+
+def save_sba_store(store_dir, setA, base_counts, sba_packed, chunk_length_64):
+    '''Write a packed SBA (and the labels / base counts) into store_dir
+       as .npy files that load_sba_store can memory-map
+       The labels are saved without pickle whenever they are all strings
+       or all integers (see npy_shards.as_fixed_width_labels)'''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    arrays = {'offsets': sba_packed['offsets'],
+              'locs': sba_packed['locs'],
+              'array': sba_packed['array'],
+              'base_counts': base_counts,
+              'setA': as_fixed_width_labels(setA)}
+    for name in STORE_ARRAYS:
+        np.save(os.path.join(store_dir, name + '.npy'), arrays[name])
+    with open(os.path.join(store_dir, STORE_META_FILENAME), 'w') as f:
+        json.dump({'chunk_length_64': chunk_length_64,
+                   'num_rows': len(base_counts)}, f)
+
+def load_sba_store(store_dir, mmap_mode='r', allow_pickle=False):
+    '''Open a store written by save_sba_store
+       Labels that had to be pickled (anything but strings or numbers)
+       are only loaded with allow_pickle=True, like np.load, since
+       loading a pickle can run arbitrary code
+       Returns setA, base_counts, sba_packed, chunk_length_64'''
+    setA = np.load(os.path.join(store_dir, 'setA.npy'), allow_pickle=allow_pickle)
+    return (setA,) + _load_sba_rows(store_dir, mmap_mode)
+
+def _load_sba_rows(store_dir, mmap_mode='r'):
+    '''The part of load_sba_store that the workers need (no labels)
+       Returns base_counts, sba_packed, chunk_length_64'''
+    with open(os.path.join(store_dir, STORE_META_FILENAME)) as f:
+        meta = json.load(f)
+    def load(name):
+        return np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode)
+    sba_packed = {name: load(name) for name in ('offsets', 'locs', 'array')}
+    return load('base_counts'), sba_packed, meta['chunk_length_64']
+
+def _get_band_edges(weights, num_bands):
+    '''Split range(len(weights)) into num_bands contiguous bands
+       with about the same total weight
+       Returns the num_bands + 1 band edges'''
+    cumulative = np.concatenate([[0], np.cumsum(weights, dtype=np.float64)])
+    targets = np.linspace(0, cumulative[-1], num_bands + 1)
+    edges = np.searchsorted(cumulative, targets)
+    edges[0], edges[-1] = 0, len(weights)
+    return np.unique(edges)
+
+def get_tile_cost(weights, row_start, row_end, col_start, col_end):
+    '''Estimated cost of all the pairs i < j in a tile
+       (each pair costs weights[i] + weights[j] + PAIR_OVERHEAD)'''
+    cumulative = np.concatenate([[0], np.cumsum(weights, dtype=np.float64)])
+    i = np.arange(row_start, row_end)
+    first_j = np.clip(i + 1, col_start, col_end)
+    num_pairs = col_end - first_j
+    return float(np.sum(num_pairs * (weights[i] + PAIR_OVERHEAD) +
+                        cumulative[col_end] - cumulative[first_j]))
+
+def plan_shards(base_counts, num_shards, tiles_per_shard=4):
+    '''Split the upper-triangular pair space (i < j) into tiles and
+       group them into num_shards shards of about the same cost
+       The rows are split into bands with the same total nnz (base_counts),
+       each pair of bands (row band <= column band) makes a tile,
+       and the tiles are handed out biggest first to the least loaded shard
+       
+       Returns a list (one per shard) of lists of tiles, where each tile is
+       (row_start, row_end, col_start, col_end)'''
+    weights = np.asarray(base_counts, dtype=np.float64)
+    num_tiles = max(num_shards * tiles_per_shard, 1)
+    num_bands = int(np.ceil((np.sqrt(8 * num_tiles + 1) - 1) / 2))
+    edges = _get_band_edges(weights + PAIR_OVERHEAD, num_bands)
+    bands = list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+    
+    tiles = [(r0, r1, c0, c1)
+             for k, (r0, r1) in enumerate(bands)
+             for c0, c1 in bands[k:]]
+    costs = [get_tile_cost(weights, *tile) for tile in tiles]
+    
+    shards = [[] for _ in range(num_shards)]
+    loads = np.zeros(num_shards)
+    for k in np.argsort(costs, kind='stable')[::-1]:
+        s = int(np.argmin(loads))
+        shards[s].append(tiles[k])
+        loads[s] += costs[k]
+    return [sorted(shard) for shard in shards]
+
+def save_plan(plan_path, shards, cutoff=0):
+    with open(plan_path, 'w') as f:
+        json.dump({'shards': shards,
+                   'cutoff': cutoff}, f)
+
+def load_plan(plan_path):
+    '''Returns shards, cutoff'''
+    with open(plan_path) as f:
+        plan = json.load(f)
+    return [[tuple(tile) for tile in shard] for shard in plan['shards']], plan['cutoff']
+
+def get_threads_per_worker(num_workers):
+    '''Split the available threads (see get_default_num_threads)
+       between num_workers processes so they don't oversubscribe the host'''
+    return max(get_default_num_threads() // max(num_workers, 1), 1)
+
+def run_shard(store_dir, tiles, cutoff=0, output_path=None, num_threads=None):
+    '''Compute the intersection counts for a list of tiles
+       using the memory-mapped store in store_dir
+       All the tiles run in the same ExecutionContext with num_threads threads
+       (default None means get_default_num_threads())
+       Returns a single structured array (INTERSECTION_COUNTS_DTYPE)
+       or writes it to output_path (.npy) and returns the path'''
+    sba_packed, chunk_length_64 = _load_sba_rows(store_dir)[1:]
+    with ExecutionContext(num_threads) as context:
+        intersection_counts = [_mtm_intersection_counts(sba_packed, chunk_length_64, np.arange(r0, r1),
+                                                        cutoff=cutoff, start_j=c0, engine='sba',
+                                                        packed_output=True, end_j=c1,
+                                                        context=context)['intersection_counts']
+                               for r0, r1, c0, c1 in tiles]
+    intersection_counts = (np.concatenate(intersection_counts)
+                           if intersection_counts else
+                           np.zeros(0, dtype=cy_mtm_stats.INTERSECTION_COUNTS_DTYPE))
+    if output_path is None:
+        return intersection_counts
+    np.save(output_path, intersection_counts)
+    return output_path
+
+def merge_shard_outputs(shard_outputs, num_rows):
+    '''Merge the outputs of run_shard (arrays or .npy paths) into
+       packed intersection counts (see _mtm_intersection_counts)
+       in the same order as mtm_stats_raw (by i, then j)'''
+    arrays = [np.load(output) if isinstance(output, str) else output
+              for output in shard_outputs]
+    intersection_counts = (np.concatenate(arrays)
+                           if arrays else
+                           np.zeros(0, dtype=cy_mtm_stats.INTERSECTION_COUNTS_DTYPE))
+    intersection_counts = intersection_counts[np.lexsort((intersection_counts['j'],
+                                                          intersection_counts['i']))]
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(intersection_counts['i'], minlength=num_rows), out=offsets[1:])
+    return {'offsets': offsets,
+            'intersection_counts': intersection_counts}
+
+def _run_shard_command(store_dir, plan_path, shard_index, output_path, num_threads=None):
+    '''Run one shard through the worker command (see main)'''
+    subprocess.check_call([sys.executable, '-m', 'mtm_stats.sharding',
+                           store_dir, plan_path, str(shard_index), output_path] +
+                          ([] if num_threads is None else ['--num-threads', str(num_threads)]))
+    return output_path
+
+def mtm_stats_sharded_raw(connections, num_shards, chunk_length_64=1, cutoff=0, num_workers=None, work_dir=None, runner='process', tiles_per_shard=4, num_threads=None):
+    '''Same results as mtm_stats_raw (for all pairs, upper_only)
+       but the pair space is split into num_shards shards that run
+       in separate processes
+       runner is either:
+         * 'process': run the shards in a ProcessPoolExecutor (num_workers processes)
+         * 'subprocess': run the worker command for each shard (see main)
+         * any concurrent.futures.Executor
+       The store, plan and shard outputs go into work_dir
+       (a temporary directory that gets removed if work_dir is None)
+       Each worker runs num_threads threads (default None splits the
+       available threads between the workers, see get_threads_per_worker)
+       Returns:
+           setA, setB, base_counts, packed intersection counts'''
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    
+    setA, setB, base_counts, sba_packed, plan = _mtm_common(connections, chunk_length_64, False, 'sba')
+    chunk_length_64 = plan['chunk_length_64']
+    num_workers = num_workers or (num_shards if runner == 'subprocess' else get_default_num_threads())
+    num_threads = get_threads_per_worker(min(num_workers, num_shards)) if num_threads is None else num_threads
+    cleanup = work_dir is None
+    work_dir = tempfile.mkdtemp() if work_dir is None else work_dir
+    try:
+        store_dir = os.path.join(work_dir, 'store')
+        plan_path = os.path.join(work_dir, PLAN_FILENAME)
+        save_sba_store(store_dir, setA, base_counts, sba_packed, chunk_length_64)
+        shards = plan_shards(base_counts, num_shards, tiles_per_shard)
+        save_plan(plan_path, shards, cutoff)
+        output_paths = [os.path.join(work_dir, SHARD_OUTPUT_FILENAME_FORMAT.format(k))
+                        for k in range(len(shards))]
+        
+        if runner == 'subprocess':
+            with ThreadPoolExecutor(num_workers) as executor:
+                futures = [executor.submit(_run_shard_command, store_dir, plan_path, k, output_paths[k], num_threads)
+                           for k in range(len(shards))]
+                shard_outputs = [future.result() for future in futures]
+        else:
+            executor = ProcessPoolExecutor(num_workers) if runner == 'process' else runner
+            try:
+                futures = [executor.submit(run_shard, store_dir, tiles, cutoff, output_path, num_threads)
+                           for tiles, output_path in zip(shards, output_paths)]
+                shard_outputs = [future.result() for future in futures]
+            finally:
+                if runner == 'process':
+                    executor.shutdown()
+        
+        intersection_counts = merge_shard_outputs(shard_outputs, len(base_counts))
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir)
+    return setA, setB, base_counts, intersection_counts
+
+def mtm_stats_sharded(connections, num_shards, chunk_length_64=1, cutoff=0, num_workers=None, work_dir=None, runner='process', tiles_per_shard=4, num_threads=None):
+    '''Same as mtm_stats, but runs in shards (see mtm_stats_sharded_raw)'''
+    setA, setB, base_counts, intersection_counts = mtm_stats_sharded_raw(connections, num_shards, chunk_length_64, cutoff, num_workers, work_dir, runner, tiles_per_shard, num_threads)
+    intersection_counts_list = cy_mtm_stats.unpack_intersection_counts(intersection_counts)
+    base_counts_dict = get_base_counts_dict(base_counts, setA)
+    iu_counts_dict = get_iu_counts_dict(base_counts, intersection_counts_list, setA)
+    return base_counts_dict, iu_counts_dict
+
+def main(argv=None):
+    '''Worker command: run one shard of a saved plan against a saved store'''
+    parser = argparse.ArgumentParser(description='Run one shard of an mtm_stats sharding plan')
+    parser.add_argument('store_dir', help='directory written by save_sba_store')
+    parser.add_argument('plan_path', help='json file written by save_plan')
+    parser.add_argument('shard_index', type=int)
+    parser.add_argument('output_path', help='.npy file for the intersection counts')
+    parser.add_argument('--num-threads', type=int, default=None,
+                        help='threads for this worker (default: all the cpus it may use)')
+    args = parser.parse_args(argv)
+    shards, cutoff = load_plan(args.plan_path)
+    run_shard(args.store_dir, shards[args.shard_index], cutoff, args.output_path, args.num_threads)
+
+if __name__ == '__main__':
+    main()
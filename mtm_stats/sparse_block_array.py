@@ -36,11 +36,199 @@ def sba_compress_64_index_list(index_list, tmp_uint64_arr, chunk_length_64):
     as the largest value in index_list
     this gets zeroed out and refilled by this function)
     '''
+    index_arr = np.asarray(index_list, dtype=np.uint64)
     tmp_uint64_arr *= 0
-    for index in index_list:
-        tmp_uint64_arr[index // 64] |= np.uint64(1 << (index % 64))
+    np.bitwise_or.at(tmp_uint64_arr,
+                     (index_arr // np.uint64(64)).astype(np.intp),
+                     np.left_shift(np.uint64(1), index_arr % np.uint64(64)))
     return sba_compress_64(tmp_uint64_arr, chunk_length_64)
 
+def sba_compress_64_index_arrays(row_indices, bit_indices, num_rows, chunk_length_64):
+    '''Compress many rows of indices into a packed SBA all at once
+    
+    row_indices and bit_indices are parallel integer arrays with one
+    entry per set bit (duplicates are allowed and are simply merged)
+    Everything is done with bulk numpy operations (one sort, no per-row loops)
+    
+    Returns a "packed SBA" dictionary (CSR-style, see sba_pack)
+    '''
+    row_indices = np.asarray(row_indices, dtype=np.int64)
+    bit_indices = np.asarray(bit_indices, dtype=np.int64)
+    block_bits = 64 * chunk_length_64
+    
+    # Sort once by (row, bit) and drop duplicate connections at the same time
+    stride = int(bit_indices.max()) + 1 if len(bit_indices) else 1
+    keys = np.unique(row_indices * stride + bit_indices)
+    rows = keys // stride
+    bits = keys % stride
+    blocks = bits // block_bits
+    
+    # Each new (row, block) pair starts a new SBA block
+    new_block = np.ones(len(keys), dtype=bool)
+    new_block[1:] = (rows[1:] != rows[:-1]) | (blocks[1:] != blocks[:-1])
+    block_starts = np.flatnonzero(new_block)
+    block_ids = np.cumsum(new_block) - 1
+    
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[block_starts], minlength=num_rows), out=offsets[1:])
+    locs = np.array(blocks[block_starts], dtype=np.int32)
+    
+    # OR the bits into their words (keys are sorted, so words are contiguous)
+    words = block_ids * chunk_length_64 + (bits // 64) % chunk_length_64
+    word_starts = np.flatnonzero(np.r_[True, words[1:] != words[:-1]])
+    bit_values = np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64))
+    array = np.zeros(len(block_starts) * chunk_length_64, dtype=np.uint64)
+    if len(keys):
+        array[words[word_starts]] = np.bitwise_or.reduceat(bit_values, word_starts)
+    
+    return sba_pack(offsets, locs, array)
+
+def sba_weights_from_index_arrays(row_indices, bit_indices, weights, num_rows, chunk_length_64):
+    '''The weights that go with sba_compress_64_index_arrays(row_indices, bit_indices, ...)
+    
+    Duplicate (row, bit) pairs get their weights added up
+    (so with all the weights at 1, the weight is the number of repeats)
+    
+    Returns a dictionary:
+      weights: float64 array with the weight of every set bit, in the
+               same order as the bits of the packed SBA (by row, then bit)
+      block_weight_offsets: int64 array (one per SBA block), the position
+                            in weights of the first bit of each block
+      row_weights: float64 array (size num_rows), the total weight of each row
+    '''
+    row_indices = np.asarray(row_indices, dtype=np.int64)
+    bit_indices = np.asarray(bit_indices, dtype=np.int64)
+    block_bits = 64 * chunk_length_64
+    
+    stride = int(bit_indices.max()) + 1 if len(bit_indices) else 1
+    keys, inverse = np.unique(row_indices * stride + bit_indices, return_inverse=True)
+    summed_weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+    rows = keys // stride
+    blocks = (keys % stride) // block_bits
+    
+    new_block = np.ones(len(keys), dtype=bool)
+    new_block[1:] = (rows[1:] != rows[:-1]) | (blocks[1:] != blocks[:-1])
+    return {'weights': summed_weights.astype(np.float64),
+            'block_weight_offsets': np.flatnonzero(new_block).astype(np.int64),
+            'row_weights': np.bincount(rows, weights=summed_weights, minlength=num_rows).astype(np.float64)}
+
+def sba_pack(offsets, locs, array):
+    '''Make a "packed SBA", a single contiguous store for many rows
+       (the CSR equivalent of a list of sba dictionaries)
+       Returns a dictionary:
+         offsets: int64 array (size num_rows + 1),
+                  row r owns blocks offsets[r]:offsets[r+1]
+         locs: int32 array of block locations for all rows (size N)
+         array: uint64 array of non-zero chunks for all rows
+                (size N * chunk_length_64)
+    '''
+    return {'offsets': np.asanyarray(offsets, dtype=np.int64),
+            'locs': np.asanyarray(locs, dtype=np.int32),
+            'array': np.asanyarray(array, dtype=np.uint64)}
+
+def sba_packed_num_rows(sba_packed):
+    '''Number of rows in a packed SBA'''
+    return len(sba_packed['offsets']) - 1
+
+def sba_list_to_packed(sba_list, chunk_length_64):
+    '''Pack a list of sba dictionaries (from sba_compress_64)
+       into a single packed SBA'''
+    lengths = [len(sba['locs']) for sba in sba_list]
+    offsets = np.zeros(len(sba_list) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    locs = np.concatenate([sba['locs'] for sba in sba_list] +
+                          [np.zeros(0, dtype=np.int32)])
+    array = np.concatenate([sba['array'] for sba in sba_list] +
+                           [np.zeros(0, dtype=np.uint64)])
+    return sba_pack(offsets, locs, array)
+
+def sba_packed_to_list(sba_packed, chunk_length_64):
+    '''Split a packed SBA back into a list of sba dictionaries
+       (the arrays are views into the packed store)'''
+    offsets = sba_packed['offsets']
+    return [{'locs': sba_packed['locs'][offsets[i]:offsets[i + 1]],
+             'array': sba_packed['array'][offsets[i] * chunk_length_64:
+                                          offsets[i + 1] * chunk_length_64]}
+            for i in range(sba_packed_num_rows(sba_packed))]
+
+def sba_packed_replace_rows(sba_packed, rows, new_rows_packed, chunk_length_64, num_rows=None):
+    '''Make a new packed SBA with some of the rows replaced
+       (all other rows are copied over in bulk, nothing gets recompressed)
+       rows are the (unique) indices of the rows to replace and
+       new_rows_packed is a packed SBA with one row for each of them
+       num_rows can be used to grow the number of rows
+       (new rows that are not in "rows" are empty)'''
+    offsets = sba_packed['offsets']
+    new_offsets = new_rows_packed['offsets']
+    rows = np.asarray(rows, dtype=np.int64)
+    old_num_rows = sba_packed_num_rows(sba_packed)
+    num_rows = old_num_rows if num_rows is None else num_rows
+    
+    # Where each row's blocks come from
+    lengths = np.zeros(num_rows, dtype=np.int64)
+    lengths[:old_num_rows] = np.diff(offsets)
+    lengths[rows] = np.diff(new_offsets)
+    source_starts = np.zeros(num_rows, dtype=np.int64)
+    source_starts[:old_num_rows] = offsets[:-1]
+    source_starts[rows] = new_offsets[:-1]
+    from_new_rows = np.zeros(num_rows, dtype=bool)
+    from_new_rows[rows] = True
+    
+    result_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=result_offsets[1:])
+    
+    # Gather every block from its source
+    block_rows = np.repeat(np.arange(num_rows), lengths)
+    block_sources = (source_starts[block_rows] +
+                     np.arange(result_offsets[-1]) - result_offsets[block_rows])
+    from_new = from_new_rows[block_rows]
+    
+    locs = np.empty(result_offsets[-1], dtype=np.int32)
+    locs[~from_new] = sba_packed['locs'][block_sources[~from_new]]
+    locs[from_new] = new_rows_packed['locs'][block_sources[from_new]]
+    array = np.empty((result_offsets[-1], chunk_length_64), dtype=np.uint64)
+    array[~from_new] = sba_packed['array'].reshape(-1, chunk_length_64)[block_sources[~from_new]]
+    array[from_new] = new_rows_packed['array'].reshape(-1, chunk_length_64)[block_sources[from_new]]
+    return sba_pack(result_offsets, locs, array.ravel())
+
+def sba_packed_take_rows(sba_packed, rows, chunk_length_64):
+    '''Make a new packed SBA out of some of the rows (in the given order)
+       Row k of the result is row rows[k] of sba_packed'''
+    offsets = sba_packed['offsets']
+    rows = np.asarray(rows, dtype=np.int64)
+    lengths = offsets[rows + 1] - offsets[rows]
+    result_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=result_offsets[1:])
+    block_sources = (np.repeat(offsets[rows] - result_offsets[:-1], lengths) +
+                     np.arange(result_offsets[-1]))
+    return sba_pack(result_offsets,
+                    sba_packed['locs'][block_sources],
+                    sba_packed['array'].reshape(-1, chunk_length_64)[block_sources].ravel())
+
+def sba_packed_merge(sba_packed_list, chunk_length_64, num_rows):
+    '''OR several packed SBAs together, row by row, into one packed SBA
+       with num_rows rows (any of them can have fewer rows, the missing
+       rows are empty)'''
+    block_rows = np.concatenate([np.repeat(np.arange(sba_packed_num_rows(p)), np.diff(p['offsets']))
+                                 for p in sba_packed_list] + [np.zeros(0, dtype=np.int64)])
+    locs = np.concatenate([p['locs'] for p in sba_packed_list] + [np.zeros(0, dtype=np.int32)])
+    blocks = np.concatenate([p['array'].reshape(-1, chunk_length_64) for p in sba_packed_list] +
+                            [np.zeros((0, chunk_length_64), dtype=np.uint64)])
+    
+    # Sort the blocks by (row, loc) and OR the ones that are at the same place
+    order = np.lexsort((locs, block_rows))
+    block_rows, locs, blocks = block_rows[order], locs[order], blocks[order]
+    new_block = np.ones(len(locs), dtype=bool)
+    new_block[1:] = (block_rows[1:] != block_rows[:-1]) | (locs[1:] != locs[:-1])
+    block_starts = np.flatnonzero(new_block)
+    
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(block_rows[block_starts], minlength=num_rows), out=offsets[1:])
+    array = (np.bitwise_or.reduceat(blocks, block_starts, axis=0)
+             if len(block_starts) else
+             blocks)
+    return sba_pack(offsets, locs[block_starts], array.ravel())
+
 def sba_decompress(sba_dict, orig_length):
     '''This is SLOW, only useful for testing
        sba_dict has members 'locs' and 'array'
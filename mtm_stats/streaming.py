@@ -0,0 +1,210 @@
+'''Build the packed SBA rows from connections that don't fit in memory
+
+The connections come in as batches of two parallel arrays (a_array, b_array)
+from any of the readers here (iter_connection_batches for an iterator of
+(a, b) tuples, read_delimited_batches for CSV/TSV files and
+read_npy_batches for (N, 2) .npy files), and each batch gets compressed
+into a small packed SBA right away, so the raw edges are never all in memory
+The batch SBAs get merged into the main one (sba_packed_merge) whenever
+they add up to more blocks than it has, so the peak memory is a small
+multiple of the size of the compressed rows
+
+StreamingSBABuilder does a single pass (the labels get their index the first
+time they show up and are sorted at the end), or with a source that can be
+read again (a function that returns a new iterator of batches) the first pass
+only collects the labels and the second pass maps the batches straight to
+their sorted indices (see build_sba_streaming)
+The result is the same setA, base_counts and rows as _mtm_common (engine='sba'),
+except that setB stays in the order the B's were found in the one pass version
+(the intersection counts don't depend on the order of the B's)
+'''
+from __future__ import absolute_import
+from __future__ import division
+
+import csv
+import itertools
+import numpy as np
+
+from .mtm_stats import (convert_indices_to_sba_packed, _mtm_intersection_counts,
+                        get_similarity_filter, get_base_counts_dict,
+                        get_iu_counts_dict)
+from .sparse_block_array import sba_packed_merge, sba_packed_take_rows
+from . import cy_mtm_stats
+
+DEFAULT_BATCH_SIZE = 1000000
+
+# The batch SBAs only get merged into the main one once they add up
+# to at least this many blocks (and at least as many as the main one has)
+MIN_MERGE_BLOCKS = 1000000
+
+def iter_connection_batches(connections, batch_size=DEFAULT_BATCH_SIZE):
+    '''Split any iterable of (a, b) tuples into batches of
+       (a_array, b_array) without ever building the full list'''
+    iterator = iter(connections)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        a_list, b_list = zip(*batch)
+        yield np.array(a_list), np.array(b_list)
+
+def read_delimited_batches(path, batch_size=DEFAULT_BATCH_SIZE, delimiter=None, columns=(0, 1), skip_header=False):
+    '''Read the connections from a CSV/TSV file in batches of (a_array, b_array)
+       The labels are kept as strings
+       delimiter defaults to a tab for .tsv/.tab files and a comma otherwise
+       columns are the positions of the a and b columns'''
+    if delimiter is None:
+        delimiter = '\t' if path.endswith(('.tsv', '.tab')) else ','
+    a_column, b_column = columns
+    with open(path) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if skip_header:
+            next(reader, None)
+        rows = ((row[a_column], row[b_column]) for row in reader if row)
+        for batch in iter_connection_batches(rows, batch_size):
+            yield batch
+
+def read_npy_batches(path, batch_size=DEFAULT_BATCH_SIZE):
+    '''Read the connections from an (N, 2) .npy file in batches of (a_array, b_array)
+       The file is memory-mapped, so only one batch is read at a time'''
+    arr = np.load(path, mmap_mode='r')
+    if arr.ndim != 2 or arr.shape[1] != 2:
+        raise ValueError('expected an (N, 2) array in {}, not {}'.format(path, arr.shape))
+    for start in range(0, len(arr), batch_size):
+        batch = np.array(arr[start:start + batch_size])
+        yield batch[:, 0], batch[:, 1]
+
+def _map_labels(labels, mapping, order):
+    '''Get the index of each label (labels that are new get added to mapping and order)'''
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    indices = np.empty(len(unique_labels), dtype=np.int64)
+    for k, label in enumerate(unique_labels.tolist()):
+        index = mapping.get(label)
+        if index is None:
+            index = mapping[label] = len(order)
+            order.append(label)
+        indices[k] = index
+    return indices[inverse.ravel()]
+
+class StreamingSBABuilder(object):
+    '''Builds the packed SBA rows one batch of connections at a time
+
+       With setA and setB (sorted arrays of all the labels, see
+       collect_labels) the batches get mapped with a binary search,
+       otherwise the labels get their index as they show up
+       context is the ExecutionContext the compression and the base
+       counts run in (None makes a new one for each call)
+
+       Example:
+           builder = StreamingSBABuilder(chunk_length_64=4)
+           for a_array, b_array in read_delimited_batches('edges.tsv'):
+               builder.add_batch(a_array, b_array)
+           setA, setB, base_counts, sba_packed = builder.finish()
+       '''
+    def __init__(self, chunk_length_64=1, setA=None, setB=None, context=None):
+        self.chunk_length_64 = chunk_length_64
+        self.context = context
+        self.setA = setA
+        self.setB = setB
+        self.mappingA, self.labelsA = {}, []
+        self.mappingB, self.labelsB = {}, []
+        self.sba_packed = None
+        self.pending = []
+        self.num_connections = 0
+
+    @property
+    def num_rows(self):
+        return len(self.setA) if self.setA is not None else len(self.labelsA)
+
+    def _get_indices(self, a_array, b_array):
+        if self.setA is None:
+            return (_map_labels(a_array, self.mappingA, self.labelsA),
+                    _map_labels(b_array, self.mappingB, self.labelsB))
+        ia = np.searchsorted(self.setA, a_array)
+        ib = np.searchsorted(self.setB, b_array)
+        if (np.any(ia >= len(self.setA)) or np.any(self.setA[np.minimum(ia, len(self.setA) - 1)] != a_array) or
+            np.any(ib >= len(self.setB)) or np.any(self.setB[np.minimum(ib, len(self.setB) - 1)] != b_array)):
+            raise KeyError('the batch has labels that are not in setA / setB')
+        return ia, ib
+
+    def add_batch(self, a_array, b_array):
+        '''Compress a batch of connections (two parallel arrays of labels)'''
+        if len(a_array) == 0:
+            return
+        ia, ib = self._get_indices(np.asarray(a_array), np.asarray(b_array))
+        self.num_connections += len(ia)
+        self.pending.append(convert_indices_to_sba_packed(ia, ib, int(ia.max()) + 1, self.chunk_length_64, self.context))
+        pending_blocks = sum(len(p['locs']) for p in self.pending)
+        store_blocks = 0 if self.sba_packed is None else len(self.sba_packed['locs'])
+        if pending_blocks >= max(store_blocks, MIN_MERGE_BLOCKS):
+            self._merge()
+
+    def _merge(self):
+        store = [] if self.sba_packed is None else [self.sba_packed]
+        self.sba_packed = sba_packed_merge(store + self.pending, self.chunk_length_64, self.num_rows)
+        self.pending = []
+
+    def get_nbytes(self):
+        '''Current size of the compressed rows (including the pending batches)'''
+        packed = ([] if self.sba_packed is None else [self.sba_packed]) + self.pending
+        return sum(arr.nbytes for p in packed for arr in p.values())
+
+    def finish(self):
+        '''Merge everything and put the rows in sorted order of setA
+           Returns setA, setB, base_counts, sba_packed'''
+        self._merge()
+        sba_packed = self.sba_packed
+        if self.setA is not None:
+            setA, setB = self.setA, self.setB
+        else:
+            labelsA = np.array(self.labelsA)
+            order = np.argsort(labelsA, kind='stable')
+            setA, setB = labelsA[order], np.array(self.labelsB)
+            sba_packed = sba_packed_take_rows(sba_packed, order, self.chunk_length_64)
+        base_counts = cy_mtm_stats.cy_compute_counts(sba_packed, self.chunk_length_64, self.context)
+        return setA, setB, base_counts, sba_packed
+
+def collect_labels(batches):
+    '''First pass of the two pass build: the sorted unique labels of A and B'''
+    setA = setB = None
+    for a_array, b_array in batches:
+        setA = np.unique(a_array) if setA is None else np.union1d(setA, a_array)
+        setB = np.unique(b_array) if setB is None else np.union1d(setB, b_array)
+    return ((np.array([]), np.array([])) if setA is None else (setA, setB))
+
+def build_sba_streaming(source, chunk_length_64=1, context=None):
+    '''Build the packed SBA rows from batches of connections
+       source is either an iterable of (a_array, b_array) batches (one pass)
+       or a function that returns a new one each time it's called
+       (two passes, see collect_labels)
+       context is passed on to StreamingSBABuilder
+       Returns setA, setB, base_counts, sba_packed'''
+    if callable(source):
+        setA, setB = collect_labels(source())
+        builder = StreamingSBABuilder(chunk_length_64, setA, setB, context)
+        batches = source()
+    else:
+        builder = StreamingSBABuilder(chunk_length_64, context=context)
+        batches = source
+    for a_array, b_array in batches:
+        builder.add_batch(a_array, b_array)
+    return builder.finish()
+
+def mtm_stats_streaming_raw(source, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None):
+    '''Same as mtm_stats_raw, but the connections come from batches
+       (see build_sba_streaming) and are never all in memory
+       Returns:
+           setA, setB, base_counts, intersection_counts_list'''
+    setA, setB, base_counts, sba_packed = build_sba_streaming(source, chunk_length_64, context)
+    similarity_filter = get_similarity_filter(base_counts, min_jaccard, min_cosine, min_overlap)
+    intersection_counts_list = _mtm_intersection_counts(sba_packed, chunk_length_64, indices_a, cutoff, start_j, upper_only,
+                                                        engine='sba', similarity_filter=similarity_filter,
+                                                        schedule=schedule, stats=stats, context=context)
+    return setA, setB, base_counts, intersection_counts_list
+
+def mtm_stats_streaming(source, chunk_length_64=1, indices_a=None, cutoff=0, start_j=0, upper_only=True, min_jaccard=None, min_cosine=None, min_overlap=None, schedule=None, stats=None, context=None):
+    '''Get base counts and intersection counts (same as mtm_stats)
+       using mtm_stats_streaming_raw'''
+    setA, setB, base_counts, intersection_counts_list = mtm_stats_streaming_raw(source, chunk_length_64, indices_a, cutoff, start_j, upper_only, min_jaccard, min_cosine, min_overlap, schedule, stats, context)
+    return (get_base_counts_dict(base_counts, setA),
+            get_iu_counts_dict(base_counts, intersection_counts_list, setA))
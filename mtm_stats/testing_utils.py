@@ -37,7 +37,7 @@ def run_timing_test(*args, **kwds):
        Time both steps and print the output
        kwds:
            verbose=True -> print the test set and the result from mtm_stats
-           chunk_length_64=True -> passed to mtm_stats
+           chunk_length_64=1 -> passed to mtm_stats
            cutoff=0 -> passed to mtm_stats
        
        all other args and kwds are passed to generate_test_set
@@ -53,7 +53,7 @@ def run_timing_test(*args, **kwds):
         print(connections)
     
     t = time.time()
-    setA, setB, base_counts, intersection_counts = mtm_stats.mtm_stats_raw(connections)
+    setA, setB, base_counts, intersection_counts = mtm_stats.mtm_stats_raw(connections, chunk_length_64, cutoff=cutoff)
     process_time = time.time()-t
     if verbose:
         print(setA, setB, base_counts, intersection_counts)
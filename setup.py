@@ -15,7 +15,8 @@ with open("mtm_stats/_version.py") as f:
 
 extensions = [Extension('mtm_stats.cy_mtm_stats',
                         ['mtm_stats/cy_mtm_stats.pyx',
-                         'mtm_stats/mtm_stats_core.c'],
+                         'mtm_stats/mtm_stats_core.c',
+                         'mtm_stats/popcount_simd.c'],
                         include_dirs=['src', np.get_include()],
                         extra_compile_args=['-fPIC','-fopenmp'],
                         extra_link_args=['-fopenmp'])]
@@ -2,8 +2,14 @@
 from __future__ import division
 from builtins import range
 
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import mtm_stats
+from mtm_stats import cy_mtm_stats
+from mtm_stats.mtm_stats import _mtm_common, _mtm_intersection_counts
 from mtm_stats.testing_utils import (generate_test_set, run_timing_test,
                                      naive_counts, naivest_counts, is_naive_same)
 
@@ -90,8 +96,806 @@ def test_get_mtm_with_indices_a_dense_vs_sparse_1():
             mtm_stats.mtm_stats(connections, dense_input=True, indices_a=range(10)))
 
 
+def test_mtm_stats_array_input_1():
+    assert mtm_stats.mtm_stats(TEST_SET_1) == mtm_stats.mtm_stats(np.array(TEST_SET_1))
 
-
+def test_mtm_stats_array_input_2():
+    connections = generate_test_set(sizeA=100,
+                                    sizeB=10000,
+                                    num_connections=10000)
+    a_arr, b_arr = map(np.array, zip(*connections))
+    expected = mtm_stats.mtm_stats(connections)
+    assert mtm_stats.mtm_stats((a_arr, b_arr)) == expected
+    assert mtm_stats.mtm_stats((a_arr, b_arr), dense_input=True) == expected
+    assert mtm_stats.mtm_stats((a_arr, b_arr), chunk_length_64=3) == expected
+
+def test_sba_compress_64_index_arrays_1():
+    connections = generate_test_set(sizeA=50,
+                                    sizeB=5000,
+                                    num_connections=2000)
+    a_arr, b_arr = map(np.array, zip(*connections))
+    setA, setB, ia, ib = mtm_stats.extract_indices_from_arrays(a_arr, b_arr)
+    chunk_length_64 = 2
+    sba_packed = mtm_stats.convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64)
+    sba_list = mtm_stats.sparse_block_array.sba_packed_to_list(sba_packed, chunk_length_64)
+    sba_list_orig = mtm_stats.convert_connections_to_sba_list_space_efficient(connections, setA, setB, chunk_length_64)
+    for sba, sba_orig in zip(sba_list, sba_list_orig):
+        assert np.array_equal(sba['locs'], sba_orig['locs'])
+        assert np.array_equal(sba['array'], sba_orig['array'])
+
+
+def test_parallel_compression_and_counts_1():
+    from mtm_stats.sparse_block_array import sba_compress_64_index_arrays
+    rs = np.random.RandomState(3)
+    ia = rs.randint(0, 9000, 40000)
+    ib = rs.randint(0, 20000, 40000)
+    ia[:5] = 0 # repeats get merged
+    ib[:5] = 7
+    for chunk_length_64 in (1, 3):
+        expected = sba_compress_64_index_arrays(ia, ib, 9010, chunk_length_64)
+        with mtm_stats.ExecutionContext(3) as context:
+            sba_packed = mtm_stats.cy_mtm_stats.cy_compress_index_arrays(ia, ib, 9010, chunk_length_64, context)
+            counts = mtm_stats.cy_mtm_stats.cy_compute_counts(sba_packed, chunk_length_64, context)
+        for name in ('offsets', 'locs', 'array'):
+            assert np.array_equal(sba_packed[name], expected[name])
+        assert np.array_equal(counts, np.bincount(np.unique(ia * 20000 + ib) // 20000, minlength=9010))
+    
+    rows = mtm_stats.convert_indices_to_binary(ia, ib, 9010, 20000)
+    with mtm_stats.ExecutionContext(3) as context:
+        dense_counts = mtm_stats.cy_mtm_stats.cy_compute_counts_dense_input(rows, context)
+    assert np.array_equal(dense_counts, counts)
+    empty = mtm_stats.cy_mtm_stats.cy_compress_index_arrays([], [], 2, 1)
+    assert np.array_equal(empty['offsets'], [0, 0, 0]) and len(empty['locs']) == 0
+
+def test_sba_packed_vs_sba_list_1():
+    connections = generate_test_set(sizeA=100,
+                                    sizeB=10000,
+                                    num_connections=10000)
+    setA, setB = mtm_stats.extract_sets_from_connections(connections)
+    chunk_length_64 = 2
+    sba_list = mtm_stats.convert_connections_to_sba_list_space_efficient(connections, setA, setB, chunk_length_64)
+    sba_packed = mtm_stats.convert_connections_to_sba_packed(connections, setA, setB, chunk_length_64)
+    assert np.array_equal(mtm_stats.cy_mtm_stats.cy_compute_counts(sba_list, chunk_length_64),
+                          mtm_stats.cy_mtm_stats.cy_compute_counts(sba_packed, chunk_length_64))
+    ic_list = mtm_stats.cy_mtm_stats.cy_compute_intersection_counts(sba_list, chunk_length_64)
+    ic_packed = mtm_stats.cy_mtm_stats.cy_compute_intersection_counts(sba_packed, chunk_length_64)
+    assert all(np.array_equal(i, j) for i, j in zip(ic_list, ic_packed))
+
+def test_mtm_stats_postings_engine_1():
+    assert mtm_stats.mtm_stats(TEST_SET_1, engine='postings') == mtm_stats.mtm_stats(TEST_SET_1)
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=15700,
+                                    num_connections=2040)
+    for kwds in [dict(),
+                 dict(upper_only=False),
+                 dict(start_j=50),
+                 dict(indices_a=range(20, 40), upper_only=False),
+                 dict(cutoff=1)]:
+        assert (mtm_stats.mtm_stats(connections, engine='postings', **kwds) ==
+                mtm_stats.mtm_stats(connections, **kwds))
+    assert (mtm_stats.mtm_stats_from_iterator(connections, 10, engine='postings') ==
+            mtm_stats.mtm_stats(connections))
+
+def test_intersection_counts_packed_output_1():
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=1570,
+                                    num_connections=20400)
+    for engine in ['sba', 'dense', 'postings']:
+        setA, setB, base_counts, rows, plan = _mtm_common(connections, 1, False, engine)
+        indices_a = np.arange(3, 100, 2)
+        packed = _mtm_intersection_counts(rows, 1, indices_a, engine=engine, packed_output=True)
+        intersection_counts_list = _mtm_intersection_counts(rows, 1, indices_a, engine=engine)
+        assert len(packed['offsets']) == len(indices_a) + 1
+        unpacked = cy_mtm_stats.unpack_intersection_counts(packed)
+        assert len(unpacked) == len(intersection_counts_list)
+        for a, b in zip(unpacked, intersection_counts_list):
+            assert np.array_equal(a, b)
+        assert ({(i, j): ic for i, j, ic in packed['intersection_counts']} ==
+                {(i, j): ic for i, j, ic in np.concatenate(intersection_counts_list)})
+
+def _brute_force_topk(connections, k, metric, cutoff=0):
+    bcd, iucd = mtm_stats.mtm_stats(connections, upper_only=False, cutoff=cutoff)
+    setA = sorted(bcd)
+    index = {a: i for i, a in enumerate(setA)}
+    neighbours = {a: [] for a in setA}
+    for (a1, a2), (ic, uc) in iucd.items():
+        score = ic / uc if metric == 'jaccard' else float(ic)
+        neighbours[a1].append((-score, index[a2]))
+    return {a: [(setA[j], -score) for score, j in sorted(n)[:k]]
+            for a, n in neighbours.items()}
+
+def test_mtm_topk_1():
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=1570,
+                                    num_connections=5000)
+    for metric in ['jaccard', 'intersection']:
+        for k in [1, 5, 200]:
+            expected = _brute_force_topk(connections, k, metric)
+            for kwds in [dict(), dict(dense_input=True), dict(engine='postings')]:
+                setA, top_indices, top_scores = mtm_stats.mtm_topk(connections, k, metric, **kwds)
+                assert top_indices.shape == top_scores.shape == (len(setA), k)
+                assert mtm_stats.get_topk_dict(setA, top_indices, top_scores) == expected
+    
+    expected = _brute_force_topk(connections, 3, 'intersection', cutoff=2)
+    setA, top_indices, top_scores = mtm_stats.mtm_topk(connections, 3, 'intersection', indices_a=[5, 7], cutoff=2)
+    assert top_indices.shape == (2, 3)
+    assert (mtm_stats.get_topk_dict(setA, top_indices, top_scores, [5, 7]) ==
+            {setA[5]: expected[setA[5]], setA[7]: expected[setA[7]]})
+
+def test_similarity_thresholds_1():
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=300,
+                                    num_connections=3000)
+    bcd, iucd = mtm_stats.mtm_stats(connections)
+    counts = {(a1, a2): (ic, bcd[a1], bcd[a2]) for (a1, a2), (ic, uc) in iucd.items()}
+    for name, threshold, score in [('min_jaccard', 0.1, lambda ic, ci, cj: ic / (ci + cj - ic)),
+                                   ('min_cosine', 0.2, lambda ic, ci, cj: ic / np.sqrt(ci * cj)),
+                                   ('min_overlap', 0.25, lambda ic, ci, cj: ic / min(ci, cj))]:
+        expected = {k: v for k, v in iucd.items() if score(*counts[k]) >= threshold}
+        assert 0 < len(expected) < len(iucd)
+        for kwds in [dict(),
+                     dict(dense_input=True),
+                     dict(engine='postings')]:
+            kwds[name] = threshold
+            assert mtm_stats.mtm_stats(connections, **kwds) == (bcd, expected)
+        assert mtm_stats.mtm_stats_from_iterator(connections, 10, **{name: threshold}) == (bcd, expected)
+    
+    bcd, jaccard_index = mtm_stats.get_Jaccard_index(connections, min_jaccard=0.1)
+    assert jaccard_index and min(jaccard_index.values()) >= 0.1
+
+def test_similarity_thresholds_2():
+    # Nested sets, so the jaccard index is exactly min / max (lots of ties with the threshold)
+    # and most rows are outside the range of counts that can pass
+    connections = [('a{}'.format(i), 'b{}'.format(k))
+                   for i in range(1, 301)
+                   for k in range(i)]
+    bcd, iucd = mtm_stats.mtm_stats(connections)
+    for min_jaccard in [0.5, 0.9]:
+        expected = {k: v for k, v in iucd.items() if v[0] / v[1] >= min_jaccard}
+        for kwds in [dict(), dict(dense_input=True), dict(upper_only=False)]:
+            r = mtm_stats.mtm_stats(connections, min_jaccard=min_jaccard, **kwds)
+            if kwds.get('upper_only') is False:
+                r = (r[0], {k: v for k, v in r[1].items() if k in iucd})
+            assert r == (bcd, expected)
+        setA, setB, base_counts, intersection_counts_list = mtm_stats.mtm_stats_raw(connections, min_jaccard=min_jaccard)
+        for intersection_counts in intersection_counts_list:
+            assert np.all(np.diff(intersection_counts['j'].astype(np.int64)) > 0)
+
+def test_incremental_update_1():
+    connections = set(generate_test_set(sizeA=100,
+                                        sizeB=300,
+                                        num_connections=2000))
+    inc = mtm_stats.incremental.IncrementalMtmStats(list(connections))
+    base_counts_dict, iu_counts_dict = mtm_stats.mtm_stats(list(connections))
+    assert inc.get_mtm_stats() == (base_counts_dict, iu_counts_dict)
+    
+    rng = np.random.RandomState(0)
+    for step in range(5):
+        removed = [sorted(connections)[k] for k in rng.choice(len(connections), 30, replace=False)]
+        added = [('a{}'.format(rng.randint(110)), 'b{}'.format(rng.randint(320)))
+                 for k in range(30)]
+        connections = (connections - set(removed)) | set(added)
+        base_counts_delta, iu_counts_delta = inc.update(added, removed)
+        
+        # Applying the delta gives the same results as starting over
+        base_counts_dict.update(base_counts_delta)
+        base_counts_dict = {k: v for k, v in base_counts_dict.items() if v}
+        for k, v in iu_counts_delta.items():
+            if v is None:
+                del iu_counts_dict[k]
+            else:
+                iu_counts_dict[k] = v
+        expected = mtm_stats.mtm_stats(list(connections))
+        assert (base_counts_dict, iu_counts_dict) == expected
+        assert inc.get_mtm_stats() == expected
+
+def test_plan_shards_1():
+    base_counts = np.random.RandomState(0).randint(1, 100, 500)
+    shards = mtm_stats.sharding.plan_shards(base_counts, 4)
+    assert len(shards) == 4
+    
+    # The tiles cover each pair i < j exactly once
+    covered = np.zeros((500, 500), dtype=int)
+    for shard in shards:
+        for r0, r1, c0, c1 in shard:
+            covered[r0:r1, c0:c1] += 1
+    assert np.array_equal(np.triu(covered, 1), np.triu(np.ones((500, 500), dtype=int), 1))
+    
+    costs = [sum(mtm_stats.sharding.get_tile_cost(base_counts, *tile) for tile in shard)
+             for shard in shards]
+    assert max(costs) < 1.5 * min(costs)
+
+def test_mtm_stats_sharded_1():
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=157,
+                                    num_connections=2040)
+    expected = mtm_stats.mtm_stats(connections)
+    for runner in ['process', 'subprocess']:
+        assert mtm_stats.sharding.mtm_stats_sharded(connections, 3, num_workers=2, runner=runner) == expected
+    setA, setB, base_counts, intersection_counts_list = mtm_stats.mtm_stats_raw(connections, cutoff=1)
+    setA, setB, base_counts, packed = mtm_stats.sharding.mtm_stats_sharded_raw(connections, 5, cutoff=1, num_workers=2)
+    assert np.array_equal(packed['intersection_counts'], np.concatenate(intersection_counts_list))
+    
+    # Labels that need pickle are only loaded with allow_pickle=True
+    # (the workers never load them)
+    big_connections = [(2 ** 70 + int(a[1:]), b) for a, b in connections]
+    assert (mtm_stats.sharding.mtm_stats_sharded(big_connections, 3, num_workers=2) ==
+            mtm_stats.mtm_stats(big_connections))
+    sba_packed = _mtm_common(connections, 1, False, 'sba')[3]
+    store_dir = tempfile.mkdtemp()
+    try:
+        mtm_stats.sharding.save_sba_store(store_dir, setA.astype(object), base_counts, sba_packed, 1)
+        assert mtm_stats.sharding.load_sba_store(store_dir)[0].dtype.kind == 'U'
+        big_labels = np.arange(len(setA)).astype(object) + 2 ** 70
+        mtm_stats.sharding.save_sba_store(store_dir, big_labels, base_counts, sba_packed, 1)
+        try:
+            mtm_stats.sharding.load_sba_store(store_dir)
+            assert False
+        except ValueError:
+            pass
+        assert list(mtm_stats.sharding.load_sba_store(store_dir, allow_pickle=True)[0]) == list(big_labels)
+    finally:
+        shutil.rmtree(store_dir)
+
+def test_schedules_1():
+    # A few very heavy rows among many light ones
+    connections = generate_test_set(sizeA=300,
+                                    sizeB=2000,
+                                    num_connections=3000)
+    connections += [('heavy{}'.format(k), 'b{}'.format(b)) for k in range(3) for b in range(0, 2000, 2 + k)]
+    for engine in ['sba', 'dense', 'postings']:
+        expected = mtm_stats.mtm_stats(connections, engine=engine, schedule='static')
+        for schedule in cy_mtm_stats.SCHEDULES:
+            stats = {}
+            assert mtm_stats.mtm_stats(connections, engine=engine, schedule=schedule, stats=stats) == expected
+            assert stats['schedule'] == schedule
+            assert len(stats['busy_time']) == stats['num_threads']
+            assert stats['imbalance'] >= 1
+    
+    # Force the heavy rows to get split as if there were many threads
+    indices_a = np.arange(303, dtype=np.int32)
+    row_weights = np.ones(303)
+    row_weights[:3] = 100
+    item_rows, item_starts, item_ends, order = cy_mtm_stats._get_work_items(indices_a, 0, 303, True, row_weights, None, 16, 'balanced')
+    assert len(order) > 303
+    assert sorted(order) == list(range(len(order)))
+    assert np.array_equal(np.bincount(item_rows, weights=item_ends - item_starts), 302 - indices_a)
+    assert np.all(item_ends[:-1][item_rows[1:] == item_rows[:-1]] == item_starts[1:][item_rows[1:] == item_rows[:-1]])
+    try:
+        mtm_stats.mtm_stats(connections, schedule='fastest')
+        assert False
+    except ValueError:
+        pass
+    
+    # The OpenMP schedule gets put back after each call
+    omp_schedule = cy_mtm_stats._get_omp_schedule()
+    with cy_mtm_stats.ExecutionContext() as context:
+        for schedule in ['static', 'guided', 'fastest']:
+            try:
+                mtm_stats.mtm_stats(connections, schedule=schedule, context=context)
+            except ValueError:
+                assert schedule == 'fastest'
+            assert cy_mtm_stats._get_omp_schedule() == omp_schedule
+        mtm_stats.mtm_stats(connections, schedule='static', context=context) # not left in use
+
+def test_execution_context_1():
+    connections = generate_test_set(sizeA=300,
+                                    sizeB=2000,
+                                    num_connections=3000)
+    expected = mtm_stats.mtm_stats(connections)
+    assert mtm_stats.get_default_num_threads() >= 1
+    
+    with mtm_stats.ExecutionContext(num_threads=2) as context:
+        assert context.num_threads == 2
+        assert mtm_stats.mtm_stats(connections, context=context) == expected
+        capacity = context.get_buffer_capacity()
+        assert capacity > 0
+        # The partitions and later calls reuse the same buffers
+        assert mtm_stats.mtm_stats_from_iterator(connections, 50, context=context) == expected
+        assert mtm_stats.mtm_stats(connections, engine='postings', context=context) == expected
+        assert context.get_buffer_capacity() >= capacity
+    assert context.get_buffer_capacity() == 0
+    
+    # The compression and the base counts also run in the caller's context
+    class CountingContext(mtm_stats.ExecutionContext):
+        def release(self):
+            self.num_calls = getattr(self, 'num_calls', 0) + 1
+            mtm_stats.ExecutionContext.release(self)
+    
+    context = CountingContext(num_threads=2)
+    _mtm_common(connections, 1, False, 'sba', context=context)
+    assert context.num_calls == 2
+    _mtm_common(connections, 1, False, 'dense', context=context)
+    assert context.num_calls == 3
+    from mtm_stats import streaming
+    context = CountingContext(num_threads=2)
+    streaming.build_sba_streaming(streaming.iter_connection_batches(connections, 1000), context=context)
+    assert context.num_calls == 4 # 3 batches and the base counts
+    
+    if hasattr(os, 'sched_getaffinity'):
+        affinity = os.sched_getaffinity(0)
+        cpu = min(affinity)
+        context = mtm_stats.ExecutionContext(cpu_affinity=[cpu])
+        assert context.num_threads == 1
+        assert mtm_stats.mtm_stats(connections, context=context) == expected
+        assert os.sched_getaffinity(0) == affinity
+    
+    try:
+        mtm_stats.ExecutionContext(num_threads=0)
+        assert False
+    except ValueError:
+        pass
+
+def test_auto_plan_1():
+    sparse_connections = generate_test_set(sizeA=300,
+                                           sizeB=1000000,
+                                           num_connections=3000)
+    dense_connections = generate_test_set(sizeA=200,
+                                          sizeB=200,
+                                          num_connections=8000)
+    for connections in [sparse_connections, dense_connections]:
+        expected = mtm_stats.mtm_stats(connections)
+        stats = {}
+        assert mtm_stats.mtm_stats(connections, 'auto', dense_input='auto', engine='auto', stats=stats) == expected
+        plan = stats['plan']
+        assert plan['predicted_cost'] == min(plan['predicted_costs'].values())
+        assert plan['chunk_length_64'] in mtm_stats.CHUNK_LENGTH_CANDIDATES
+        assert mtm_stats.mtm_stats(connections, 'auto') == expected
+        assert mtm_stats.mtm_stats(connections, dense_input='auto') == expected
+    
+    # Many rows with only a few connections each among a very large set B
+    wide_connections = (np.arange(100000) % 3000, np.arange(100000) * 97)
+    assert _mtm_common(dense_connections, 1, 'auto')[4]['engine'] == 'dense'
+    assert _mtm_common(wide_connections, 1, 'auto')[4]['engine'] == 'sba'
+    assert _mtm_common(sparse_connections, 1, 'auto', 'auto')[4]['engine'] == 'postings'
+    
+    # The block counts match the actual SBA
+    setA, setB, ia, ib = mtm_stats.extract_indices(sparse_connections)
+    block_stats = mtm_stats.get_block_stats(ia, ib, len(setA), len(setB), (1, 4))
+    for chunk_length_64 in (1, 4):
+        sba_packed = mtm_stats.convert_indices_to_sba_packed(ia, ib, len(setA), chunk_length_64)
+        assert block_stats[chunk_length_64]['num_blocks'] == len(sba_packed['locs'])
+    
+    cost_model = mtm_stats.calibrate_cost_model(sizeA=100, sizeB=5000, num_connections=5000)
+    assert all(cost_model[engine + '_seconds_per_unit'] > 0
+               for engine in ('sba', 'dense', 'postings'))
+
+def test_roaring_1():
+    from mtm_stats import roaring
+    # Rows with scattered bits (arrays), long stretches of consecutive
+    # bits (runs) and more than 4096 scattered bits in one container (bitmaps)
+    random_state = np.random.RandomState(0)
+    rows = [random_state.randint(0, 300000, size=40),
+            np.arange(70000, 90000),
+            random_state.choice(65536, 10000, replace=False),
+            np.r_[random_state.randint(0, 300000, size=30), np.arange(131072, 140000)],
+            random_state.choice(65536, 10000, replace=False) + 65536]
+    ia = np.repeat(np.arange(len(rows)), [len(r) for r in rows])
+    ib = np.concatenate(rows)
+    roaring_packed = roaring.roaring_compress_index_arrays(ia, ib, len(rows))
+    assert set(roaring_packed['types'].tolist()) == {roaring.ROARING_ARRAY,
+                                                     roaring.ROARING_BITMAP,
+                                                     roaring.ROARING_RUN}
+    container_stats = roaring.get_container_stats(ia, ib, len(rows), 300000)
+    assert container_stats['num_containers'] == len(roaring_packed['keys'])
+    assert container_stats['sum_sq_containers'] == (np.diff(roaring_packed['offsets']) ** 2).sum()
+    for i, r in enumerate(rows):
+        assert np.array_equal(roaring.roaring_decompress_row(roaring_packed, i), np.unique(r))
+    
+    connections = (np.array(['a{}'.format(i) for i in ia]), ib)
+    for kwds in [{}, {'cutoff': 5}, {'min_jaccard': 0.01}, {'indices_a': [1, 3], 'upper_only': False}]:
+        assert (mtm_stats.mtm_stats(connections, engine='roaring', **kwds) ==
+                mtm_stats.mtm_stats(connections, engine='sba', **kwds))
+    
+    # Smaller than the SBA on power-law data (but not faster, see mtm_stats.ENGINES)
+    connections = generate_test_set(sizeA=200,
+                                    sizeB=20000,
+                                    num_connections=4000)
+    sba_rows = _mtm_common(connections, 1, False, 'sba')[3]
+    roaring_rows = _mtm_common(connections, 1, False, 'roaring')[3]
+    assert roaring.roaring_nbytes(roaring_rows) < roaring.roaring_nbytes(sba_rows)
+    assert mtm_stats.mtm_stats(connections, engine='roaring') == mtm_stats.mtm_stats(connections)
+    
+    # engine='auto' picks it for rows made of long runs
+    random_state = np.random.RandomState(1)
+    starts = random_state.randint(0, 500000, size=100)
+    lengths = random_state.randint(1000, 5000, size=100)
+    ia = np.repeat(np.arange(100), lengths)
+    ib = np.concatenate([np.arange(start, start + length) for start, length in zip(starts, lengths)])
+    plan = _mtm_common((ia, ib), 'auto', False, 'auto')[4]
+    assert plan['engine'] == 'roaring'
+    assert plan['predicted_cost'] == min(plan['predicted_costs'].values())
+    
+    # but mtm_topk has no roaring kernel, so its 'auto' picks something else
+    for metric in ['jaccard', 'intersection']:
+        setA, top_indices, top_scores = mtm_stats.mtm_topk((ia, ib), 5, metric, engine='auto')
+        assert mtm_stats.get_topk_dict(setA, top_indices, top_scores) == _brute_force_topk((ia, ib), 5, metric)
+
+def test_mtm_stats_from_ids_1():
+    random_state = np.random.RandomState(0)
+    a_ids = random_state.randint(0, 300, size=3000) * 7
+    b_ids = random_state.randint(0, 2000, size=3000)
+    base_counts_dict, iu_counts_dict = mtm_stats.mtm_stats((a_ids, b_ids))
+    for compact, engine in [(True, None), (True, 'postings'), (False, None), (False, 'dense')]:
+        setA, base_counts, iu_counts = mtm_stats.mtm_stats_from_ids(a_ids, b_ids, None, None, compact, engine=engine)
+        assert len(setA) == (len(base_counts_dict) if compact else a_ids.max() + 1)
+        assert {setA[i]: c for i, c in enumerate(base_counts) if c} == base_counts_dict
+        assert {(setA[i], setA[j]): (ic, uc)
+                for i, j, ic, uc in iu_counts.tolist()} == iu_counts_dict
+    
+    setA, setB, ia, ib = mtm_stats.extract_indices_from_ids(np.array([0, 3]), np.array([2, 1]), 5, 4)
+    assert setA.tolist() == [0, 1, 2, 3, 4] and setB.tolist() == [0, 1, 2, 3]
+    for a_ids, b_ids, n_a in [([0, -1], [0, 1], None), ([0, 5], [0, 1], 5), ([0., 1.], [0, 1], None)]:
+        try:
+            mtm_stats.extract_indices_from_ids(np.array(a_ids), np.array(b_ids), n_a)
+            assert False
+        except (TypeError, ValueError):
+            pass
+
+def test_mtm_index_query_1():
+    from mtm_stats.query import MtmIndex
+    connections = generate_test_set(sizeA=300,
+                                    sizeB=3000,
+                                    num_connections=5000)
+    base_counts_dict, iu_counts_dict = mtm_stats.mtm_stats(connections)
+    index = MtmIndex.from_connections(connections)
+    a = index.setA[7]
+    for query in [a, [a, index.setA[20], index.setA[3]]]:
+        iu_counts = index.query(query)
+        expected = {k: v for k, v in iu_counts_dict.items()
+                    if set(k) & set(np.atleast_1d(query))}
+        assert {tuple(sorted((index.setA[i], index.setA[j]))): (ic, uc)
+                for i, j, ic, uc in iu_counts.tolist()} == expected
+    
+    # Only the candidates (in the given order), and the query row never matches itself
+    candidates = index.setA[[40, 3, 7, 1]]
+    iu_counts = index.query([a, index.setA[3]], candidates)
+    full = index.query([a, index.setA[3]])
+    assert set(index.setA[iu_counts['j']]) <= set(candidates)
+    assert not (iu_counts['i'] == iu_counts['j']).any()
+    assert set(iu_counts.tolist()) == {iu for iu in full.tolist() if index.setA[iu[1]] in candidates}
+    
+    # An external set of B's (one of them unknown) matches the row it came from
+    b_set = [b for aa, b in connections if aa == a] + ['not_in_b']
+    iu_counts = index.query_b_set(b_set)
+    row = iu_counts[iu_counts['j'] == index.get_rows(a)[0]]
+    assert row['intersection_count'][0] == base_counts_dict[a]
+    assert row['union_count'][0] == base_counts_dict[a] + 1
+    assert len(index.query_b_set([])) == 0
+    
+    try:
+        index.query('not_in_a')
+        assert False
+    except KeyError:
+        pass
+
+def test_mtm_stats_weighted_1():
+    random_state = np.random.RandomState(0)
+    a = random_state.randint(0, 80, size=3000)
+    b = random_state.randint(0, 1000, size=3000)
+    w = random_state.randint(1, 10, size=3000).astype(np.float64)
+    connections = [('a{}'.format(i), j, k) for i, j, k in zip(a.tolist(), b.tolist(), w.tolist())]
+    
+    # Reference in pure python (repeated connections add up)
+    rows = {}
+    for i, j, k in connections:
+        rows.setdefault(i, {}).setdefault(j, 0)
+        rows[i][j] += k
+    expected = {}
+    for i in rows:
+        for j in rows:
+            common = set(rows[i]) & set(rows[j])
+            if i < j and len(common) > 1:
+                min_sum = sum(min(rows[i][k], rows[j][k]) for k in common)
+                expected[(i, j)] = (min_sum, sum(rows[i].values()) + sum(rows[j].values()) - min_sum)
+    
+    for chunk_length_64 in [1, 4]:
+        base_weights_dict, weighted_iu_dict = mtm_stats.mtm_stats_weighted(connections, chunk_length_64, cutoff=1)
+        assert base_weights_dict == {i: sum(r.values()) for i, r in rows.items()}
+        assert set(weighted_iu_dict) == set(expected)
+        assert all(np.allclose(weighted_iu_dict[k], expected[k]) for k in expected)
+    
+    # Array input, and all weights 1 is the same as the plain counts
+    labels = np.array(['a{}'.format(i) for i in a])
+    assert mtm_stats.mtm_stats_weighted((labels, b, w), 1, cutoff=1)[1].keys() == weighted_iu_dict.keys()
+    unique_connections = np.unique(np.c_[a, b % 50], axis=0)
+    ones = np.ones(len(unique_connections))
+    setA, setB, base_counts, row_weights, weighted_iu_counts = mtm_stats.mtm_stats_weighted_raw((unique_connections[:, 0], unique_connections[:, 1], ones))
+    iu_counts = mtm_stats.get_iu_counts_array(*mtm_stats.mtm_stats_raw(unique_connections)[2:])
+    assert np.array_equal(weighted_iu_counts['min_sum'], iu_counts['intersection_count'])
+    
+    jaccard = mtm_stats.get_weighted_Jaccard_index(connections, cutoff=1)[1]
+    assert all(np.isclose(jaccard[k], expected[k][0] / expected[k][1]) for k in expected)
+    # Pairs whose common B's all have a weight of 0
+    assert mtm_stats.get_weighted_Jaccard_index([('a1', 'b1', 0.0), ('a2', 'b1', 0.0)])[1] == {('a1', 'a2'): 0.0}
+    try:
+        mtm_stats.mtm_stats_weighted([('a', 'b', -1.0)])
+        assert False
+    except ValueError:
+        pass
+
+def test_reorder_1():
+    from mtm_stats import reorder
+    # Communities of A's that each use a scattered set of B's
+    random_state = np.random.RandomState(0)
+    community_b = [random_state.choice(20000, 100, replace=False) for _ in range(20)]
+    ia = np.repeat(np.arange(300), 20)
+    ib = np.concatenate([random_state.choice(community_b[random_state.randint(20)], 20, replace=False)
+                         for _ in range(300)])
+    connections = (np.array(['a{}'.format(i) for i in ia]), ib)
+    expected = mtm_stats.mtm_stats(connections)
+    for method in reorder.REORDER_METHODS:
+        for reorder_a in [False, True]:
+            stats = {}
+            assert reorder.mtm_stats_reordered(connections, method, reorder_a, 1, 0, 0, stats) == expected
+            if method != 'degree':
+                assert stats['num_blocks_after'] < stats['num_blocks_before'] / 2
+    
+    setA, setB, ia, ib = mtm_stats.extract_indices(connections)
+    a_order, b_order = reorder.get_reorder_permutations(ia, ib, len(setA), len(setB), 'rcm', True)
+    assert sorted(a_order) == list(range(len(setA)))
+    assert sorted(b_order) == list(range(len(setB)))
+    
+    report = reorder.get_reorder_report(connections, ('minhash',))
+    assert set(report) == {'none', 'minhash'}
+    assert report['minhash']['compression_ratio'] > report['none']['compression_ratio']
+
+def test_profiler_1():
+    connections = generate_test_set(sizeA=80, sizeB=3000, num_connections=2000, seed=4)
+    expected = mtm_stats.mtm_stats(connections, cutoff=1)
+    n = len(expected[0])
+    records = []
+    profiler = mtm_stats.Profiler(callback=records.append)
+    stats = {}
+    assert mtm_stats.mtm_stats(connections, cutoff=1, stats=stats, profiler=profiler) == expected
+    report = profiler.get_report()
+    assert [r['stage'] for r in report['stages']] == ['extraction', 'mapping', 'planning', 'compression',
+                                                       'base_counts', 'intersections', 'output']
+    assert records == report['stages']
+    assert set(report['wall_time']) == {r['stage'] for r in records}
+    intersections = records[5]
+    assert intersections['pairs_evaluated'] == n * (n - 1) // 2
+    assert intersections['pairs_emitted'] == len(expected[1]) == stats['pairs_emitted']
+    assert intersections['pairs_emitted'] + intersections['pairs_cut_off'] == intersections['pairs_evaluated']
+    assert intersections['max_block_merge_steps'] >= intersections['pairs_evaluated']
+    assert len(intersections['thread_time']) == intersections['num_threads']
+    assert records[3]['bytes_allocated'] > 0 and report['bytes_allocated'] >= records[3]['bytes_allocated']
+    
+    for engine in ('dense', 'postings', 'roaring'):
+        profiler.clear()
+        mtm_stats.mtm_stats(connections, engine=engine, profiler=profiler)
+        assert profiler.get_report()['stages'][5]['pairs_evaluated'] == n * (n - 1) // 2
+    profiler.clear()
+    mtm_stats.mtm_stats(connections, indices_a=range(10), profiler=profiler)
+    assert profiler.get_report()['stages'][5]['pairs_evaluated'] == sum(n - 1 - i for i in range(10))
+    profiler.clear()
+    rs = np.random.RandomState(4)
+    mtm_stats.mtm_stats_from_ids(rs.randint(0, 50, 500), rs.randint(0, 400, 500), profiler=profiler)
+    assert [r['stage'] for r in profiler.records] == ['extraction', 'planning', 'compression',
+                                                      'base_counts', 'intersections', 'output']
+
+def test_pair_metrics_1():
+    connections = generate_test_set(sizeA=70, sizeB=800, num_connections=3000, seed=5)
+    setA, setB, base_counts, intersection_counts_list = mtm_stats.mtm_stats_raw(connections)
+    iu = mtm_stats.get_iu_counts_array(base_counts, intersection_counts_list)
+    ic = iu['intersection_count'].astype(np.float64)
+    ci = base_counts[iu['i']].astype(np.float64)
+    cj = base_counts[iu['j']].astype(np.float64)
+    expected = {'union_count': iu['union_count'],
+                'difference_ij_count': ci - ic,
+                'difference_ji_count': cj - ic,
+                'symmetric_difference_count': iu['union_count'] - ic,
+                'jaccard': ic / iu['union_count'],
+                'cosine': ic / np.sqrt(ci * cj),
+                'overlap': ic / np.minimum(ci, cj),
+                'dice': 2 * ic / (ci + cj),
+                'lift': ic * len(setB) / (ci * cj),
+                'pmi': np.log(ic * len(setB) / (ci * cj))}
+    metrics = sorted(mtm_stats.cy_mtm_stats.PAIR_METRICS)
+    for float_dtype, rtol in [(np.float64, 1e-12), (np.float32, 1e-6)]:
+        with mtm_stats.ExecutionContext(2) as context:
+            arr = mtm_stats.get_pair_metrics_array(base_counts, intersection_counts_list, metrics, len(setB), float_dtype, context)
+        assert arr.dtype.names == ('i', 'j', 'intersection_count') + tuple(metrics)
+        assert np.array_equal(arr['i'], iu['i']) and np.array_equal(arr['intersection_count'], iu['intersection_count'])
+        for name in metrics:
+            assert arr.dtype[name] == (np.uint32 if name.endswith('_count') else float_dtype)
+            assert np.allclose(arr[name], expected[name], rtol=rtol, atol=0)
+    
+    setA_m, setB_m, base_counts_m, arr = mtm_stats.mtm_stats_metrics(connections, ('dice', 'union_count'), cutoff=1)
+    assert arr.dtype.names == ('i', 'j', 'intersection_count', 'dice', 'union_count')
+    assert np.array_equal(arr['union_count'], iu['union_count'][iu['intersection_count'] > 1])
+    bcd, cosine = mtm_stats.get_similarity_index(connections, 'cosine')
+    assert cosine == {(setA[i], setA[j]): c for i, j, c in zip(iu['i'], iu['j'], expected['cosine'])}
+    for bad_metrics in [('nope',), ('lift',)]:
+        try:
+            mtm_stats.get_pair_metrics_array(base_counts, intersection_counts_list, bad_metrics)
+            assert False
+        except ValueError:
+            pass
+
+def test_mtm_stats_auto_engine_1():
+    sparse_connections = generate_test_set(sizeA=1000,
+                                           sizeB=1000000,
+                                           num_connections=5000)
+    dense_connections = generate_test_set(sizeA=100,
+                                          sizeB=100,
+                                          num_connections=5000)
+    assert _mtm_common(sparse_connections, engine='auto')[4]['engine'] == 'postings'
+    assert _mtm_common(dense_connections, engine='auto')[4]['engine'] == 'sba'
+    assert (mtm_stats.mtm_stats(sparse_connections, engine='auto') ==
+            mtm_stats.mtm_stats(sparse_connections))
+    
+    # 'auto' only means something to the planner, not to the kernels
+    rows = _mtm_common(sparse_connections)[3]
+    try:
+        _mtm_intersection_counts(rows, engine='auto')
+        assert False
+    except ValueError:
+        pass
+
+def test_popcount_impls_1():
+    connections = generate_test_set(sizeA=100,
+                                    sizeB=10000,
+                                    num_connections=10000)
+    expected = mtm_stats.mtm_stats(connections, chunk_length_64=1)
+    try:
+        for name in mtm_stats.cy_mtm_stats.cy_get_supported_popcount_impls():
+            mtm_stats.cy_mtm_stats.cy_set_popcount_impl(name)
+            assert mtm_stats.cy_mtm_stats.cy_get_popcount_impl() == name
+            for chunk_length_64 in [1, 9, 67]:
+                assert mtm_stats.mtm_stats(connections, chunk_length_64=chunk_length_64) == expected
+            assert mtm_stats.mtm_stats(connections, dense_input=True) == expected
+    finally:
+        mtm_stats.cy_mtm_stats.cy_set_popcount_impl(None)
+
+def test_get_iu_counts_array_1():
+    setA, setB, base_counts, intersection_counts_list = mtm_stats.mtm_stats_raw(TEST_SET_1)
+    iu_counts = mtm_stats.get_iu_counts_array(base_counts, intersection_counts_list)
+    assert ({(setA[i], setA[j]): (ic, uc) for i, j, ic, uc in iu_counts} ==
+            mtm_stats.get_iu_counts_dict(base_counts, intersection_counts_list, setA))
+
+def test_mtm_stats_to_npy_shards_1():
+    connections = generate_test_set(sizeA=143,
+                                    sizeB=157,
+                                    num_connections=20400)
+    output_dir = tempfile.mkdtemp()
+    try:
+        shard_paths = mtm_stats.mtm_stats_to_npy_shards(connections, output_dir, 10)
+        setA, base_counts, iu_counts_shards = mtm_stats.npy_shards.load_npy_shards(output_dir)
+        assert len(shard_paths) == len(iu_counts_shards) == (len(setA) + 9) // 10
+        bcd = mtm_stats.get_base_counts_dict(base_counts, setA)
+        iucd = {(setA[i], setA[j]): (ic, uc)
+                for iu_counts in iu_counts_shards
+                for i, j, ic, uc in iu_counts}
+        assert (bcd, iucd) == mtm_stats.mtm_stats(connections)
+        assert setA.dtype.kind == 'U'
+        
+        # A second (smaller) run into the same directory only has its own shards
+        shard_paths = mtm_stats.mtm_stats_to_npy_shards(connections[:100], output_dir, 50)
+        setA, base_counts, iu_counts_shards = mtm_stats.npy_shards.load_npy_shards(output_dir)
+        assert len(shard_paths) == len(iu_counts_shards) == (len(setA) + 49) // 50
+        
+        # Labels that need pickle are only loaded with allow_pickle=True
+        mtm_stats.mtm_stats_to_npy_shards([(2 ** 70 + len(i), j) for i, j in connections[:100]], output_dir, 50)
+        try:
+            mtm_stats.npy_shards.load_npy_shards(output_dir)
+            assert False
+        except ValueError:
+            pass
+        assert (list(mtm_stats.npy_shards.load_npy_shards(output_dir, allow_pickle=True)[0]) ==
+                sorted({2 ** 70 + len(i) for i, j in connections[:100]}))
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_index_file_1():
+    from mtm_stats import index_file
+    connections = generate_test_set(sizeA=300,
+                                    sizeB=5000,
+                                    num_connections=8000)
+    output_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(output_dir, 'connections.idx')
+        index_file.save_index(path, connections, 4)
+        setA, setB, base_counts, sba_packed, chunk_length_64 = index_file.load_index(path)
+        assert chunk_length_64 == 4
+        assert all(isinstance(arr, np.memmap) for arr in sba_packed.values())
+        for kwds in [{}, {'indices_a': [0, 5, 17], 'upper_only': False}, {'min_jaccard': 0.1}]:
+            expected = mtm_stats.mtm_stats_raw(connections, 4, **kwds)
+            result = index_file.mtm_stats_raw_from_index(path, **kwds)
+            assert list(result[0]) == list(expected[0])
+            assert list(result[2]) == list(expected[2])
+            assert all(np.array_equal(r, e) for r, e in zip(result[3], expected[3]))
+        
+        with open(path, 'r+b') as f:
+            f.seek(len(index_file.MAGIC))
+            f.write(b'\xff')
+        try:
+            index_file.load_index(path)
+            assert False
+        except ValueError:
+            pass
+        
+        # Strings are stored as fixed width labels, anything else
+        # is pickled and only loaded with allow_pickle=True
+        assert setA.dtype.kind == 'U'
+        index_file.save_index(path, [(2 ** 70 + len(a), b) for a, b in connections])
+        try:
+            index_file.load_index(path)
+            assert False
+        except ValueError:
+            pass
+        assert (list(index_file.load_index(path, allow_pickle=True)[0]) ==
+                sorted({2 ** 70 + len(a) for a, b in connections}))
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_benchmark_1():
+    from mtm_stats import benchmark
+    output_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(output_dir, 'benchmarks.json')
+        grid = {'sizeA': [50], 'sizeB': [500], 'num_connections': [500],
+                'chunk_length_64': [1, 2], 'dense_input': [False, True]}
+        benchmarks = benchmark.run_benchmarks(grid, 1, 0, path)
+        assert len(benchmarks['results']) == 4
+        assert benchmark.load_benchmarks(path) == benchmarks
+        assert all(set(result['min']) == set(benchmark.STAGES) for result in benchmarks['results'])
+        assert 'numpy_version' in benchmarks['environment']
+        
+        comparisons = benchmark.compare_benchmarks(path, path)
+        assert len(comparisons) == 4 * len(benchmark.STAGES)
+        assert not any(c['regression'] for c in comparisons)
+        slower = benchmark.load_benchmarks(path)
+        slower['results'][0]['min']['intersections'] = 2 * max(benchmarks['results'][0]['min']['intersections'],
+                                                                benchmark.MIN_COMPARE_TIME)
+        regressions = [c for c in benchmark.compare_benchmarks(benchmarks, slower) if c['regression']]
+        assert [c['stage'] for c in regressions] == ['intersections']
+        assert benchmark.main(['compare', path, path]) == 0
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_streaming_1():
+    from mtm_stats import streaming
+    from mtm_stats.sparse_block_array import sba_compress_64_index_arrays, sba_packed_merge, sba_packed_take_rows
+    connections = generate_test_set(sizeA=60, sizeB=1000, num_connections=2000, seed=1)
+    connections = [('a{}'.format(a), 'b{}'.format(b)) for a, b in connections]
+    base_counts, iu_counts = mtm_stats.mtm_stats(connections, 2)
+    output_dir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(output_dir, 'edges.csv')
+        tsv_path = os.path.join(output_dir, 'edges.tsv')
+        with open(csv_path, 'w') as f:
+            f.write('a,b\n' + ''.join('{},{}\n'.format(a, b) for a, b in connections))
+        with open(tsv_path, 'w') as f:
+            f.write(''.join('{}\t{}\n'.format(a, b) for a, b in connections))
+        sources = [streaming.iter_connection_batches(connections, 300),
+                   streaming.read_delimited_batches(csv_path, 300, skip_header=True),
+                   streaming.read_delimited_batches(tsv_path, 300),
+                   lambda: streaming.read_delimited_batches(tsv_path, 300)]
+        for source in sources:
+            assert streaming.mtm_stats_streaming(source, 2) == (base_counts, iu_counts)
+        
+        int_connections = np.array(generate_test_set(sizeA=40, sizeB=500, num_connections=1000, seed=2))
+        npy_path = os.path.join(output_dir, 'edges.npy')
+        np.save(npy_path, int_connections)
+        expected = mtm_stats.mtm_stats([tuple(c) for c in int_connections.tolist()])
+        for two_pass in (False, True):
+            source = (lambda: streaming.read_npy_batches(npy_path, 128)) if two_pass else streaming.read_npy_batches(npy_path, 128)
+            assert streaming.mtm_stats_streaming(source) == expected
+    finally:
+        shutil.rmtree(output_dir)
+    
+    # Merging batch SBAs is the same as compressing everything at once
+    ia = np.array([0, 0, 1, 3, 3, 0, 2, 3])
+    ib = np.array([1, 70, 5, 200, 3, 2, 9, 201])
+    full = sba_compress_64_index_arrays(ia, ib, 5, 1)
+    merged = sba_packed_merge([sba_compress_64_index_arrays(ia[:4], ib[:4], 4, 1),
+                               sba_compress_64_index_arrays(ia[4:], ib[4:], 4, 1)], 1, 5)
+    for name in ('offsets', 'locs', 'array'):
+        assert np.array_equal(merged[name], full[name])
+    taken = sba_packed_take_rows(full, [3, 0], 1)
+    assert np.array_equal(taken['offsets'], [0, 2, 4])
+    assert np.array_equal(taken['locs'], full['locs'][[4, 5, 0, 1]])
 
 def performance_test_sizeA_100_sizeB_10000_num_connections_10000():
     gt, mt = run_timing_test(sizeA=100,
@@ -226,6 +1030,36 @@ if __name__ == '__main__':
     test_get_Jaccard_index_1()
     test_get_mtm_dense_vs_sparse_1()
     test_get_mtm_with_indices_a_dense_vs_sparse_1()
+    test_mtm_stats_array_input_1()
+    test_mtm_stats_array_input_2()
+    test_sba_compress_64_index_arrays_1()
+    test_parallel_compression_and_counts_1()
+    test_sba_packed_vs_sba_list_1()
+    test_mtm_stats_postings_engine_1()
+    test_intersection_counts_packed_output_1()
+    test_mtm_topk_1()
+    test_similarity_thresholds_1()
+    test_similarity_thresholds_2()
+    test_incremental_update_1()
+    test_plan_shards_1()
+    test_mtm_stats_sharded_1()
+    test_schedules_1()
+    test_execution_context_1()
+    test_auto_plan_1()
+    test_roaring_1()
+    test_mtm_stats_from_ids_1()
+    test_mtm_index_query_1()
+    test_mtm_stats_weighted_1()
+    test_reorder_1()
+    test_profiler_1()
+    test_pair_metrics_1()
+    test_mtm_stats_auto_engine_1()
+    test_popcount_impls_1()
+    test_get_iu_counts_array_1()
+    test_mtm_stats_to_npy_shards_1()
+    test_index_file_1()
+    test_benchmark_1()
+    test_streaming_1()
 
     performance_test_sizeA_100_sizeB_10000_num_connections_10000()
     #performance_test_sizeA_10000_sizeB_1000000_num_connections_1000000()